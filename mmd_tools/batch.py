@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+""" Convert MMD models and motions to .blend files in background.
+
+ Usage:
+    blender -b -P mmd_tools/batch.py -- --manifest manifest.json --workers 4 --report report.json
+
+ The manifest is a JSON file like this. Relative paths are relative to the manifest.
+    {
+        "scale": 0.2,
+        "output_dir": "blend",
+        "jobs": [
+            {"model": "models/a.pmx", "motions": ["motions/dance.vmd"], "output": "a.blend"},
+            {"model": "models/b.pmd"}
+        ]
+    }
+
+ The controller starts the worker Blender processes and dispatches jobs through a work queue.
+ Each worker processes many jobs and starts over with an empty scene for each job.
+ A JSON report which has timings and failures of each job is written at the end.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+RESULT_PREFIX = 'MMD_TOOLS_BATCH_RESULT '
+READY_LINE = 'MMD_TOOLS_BATCH_READY'
+
+
+def _scriptArgs(argv):
+    if '--' in argv:
+        return argv[argv.index('--') + 1:]
+    return argv[1:]
+
+
+def loadManifest(filepath, output_dir=None):
+    """ Load a manifest and return a list of job dicts with absolute paths.
+    """
+    with open(filepath, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+
+    base_dir = os.path.dirname(os.path.abspath(filepath))
+    def abspath(path):
+        return os.path.normpath(os.path.join(base_dir, path))
+
+    output_dir = abspath(output_dir or manifest.get('output_dir', '.'))
+    jobs = []
+    for i, item in enumerate(manifest.get('jobs', [])):
+        if isinstance(item, str):
+            item = {'model': item}
+        job = dict(item)
+        job['id'] = item.get('id', i)
+        job['model'] = abspath(item['model'])
+        job['motions'] = [abspath(m) for m in item.get('motions', [])]
+        job['scale'] = item.get('scale', manifest.get('scale', 0.2))
+        job['frame_margin'] = item.get('frame_margin', manifest.get('frame_margin', 5))
+        output = item.get('output', os.path.splitext(os.path.basename(job['model']))[0] + '.blend')
+        job['output'] = os.path.normpath(os.path.join(output_dir, output))
+        jobs.append(job)
+    return jobs
+
+
+#****************************************
+# Worker
+#****************************************
+def _resetScene():
+    import bpy
+    from mmd_tools import bpyutils
+
+    scene = bpy.context.scene
+    bpyutils.removeObjects(list(scene.objects))
+    for collection in (bpy.data.meshes, bpy.data.armatures, bpy.data.materials, bpy.data.textures,
+                       bpy.data.images, bpy.data.actions, bpy.data.cameras, bpy.data.lamps, bpy.data.groups):
+        for i in list(collection):
+            if i.users == 0:
+                collection.remove(i)
+
+
+def _processJob(job):
+    import bpy
+    import mmd_tools.core.pmd.importer as pmd_importer
+    import mmd_tools.core.pmx.importer as pmx_importer
+    import mmd_tools.core.vmd.importer as vmd_importer
+    import mmd_tools.core.model as mmd_model
+
+    times = {}
+    start = time.time()
+    _resetScene()
+    times['reset'] = time.time() - start
+
+    t = time.time()
+    args = dict(
+        filepath=job['model'],
+        scale=job['scale'],
+        rename_LR_bones=job.get('rename_bones', True),
+        ignore_non_collision_groups=job.get('ignore_non_collision_groups', False),
+        use_mipmap=job.get('use_mipmap', True),
+        sph_blend_factor=job.get('sph_blend_factor', 1.0),
+        spa_blend_factor=job.get('spa_blend_factor', 1.0),
+        )
+    if job['model'].lower().endswith('.pmd'):
+        pmd_importer.import_pmd(**args)
+    else:
+        pmx_importer.PMXImporter().execute(**args)
+    times['import_model'] = time.time() - t
+
+    if len(job['motions']) > 0:
+        t = time.time()
+        roots = [o for o in bpy.context.scene.objects if o.mmd_type == 'ROOT']
+        if len(roots) == 0:
+            raise Exception('No MMD model was imported from %s'%job['model'])
+        rig = mmd_model.Model(roots[0])
+        targets = [rig.armature()] + list(rig.meshes())
+        for motion in job['motions']:
+            importer = vmd_importer.VMDImporter(
+                filepath=motion,
+                scale=roots[0].mmd_root.scale,
+                frame_margin=job['frame_margin'],
+                )
+            importer.assignMany(targets)
+        times['import_motions'] = time.time() - t
+
+    t = time.time()
+    output_dir = os.path.dirname(job['output'])
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    bpy.ops.wm.save_as_mainfile(filepath=job['output'], check_existing=False)
+    times['save'] = time.time() - t
+    times['total'] = time.time() - start
+    return times
+
+
+def _send(result):
+    sys.stdout.write(RESULT_PREFIX + json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+
+def runWorker():
+    """ Process jobs read from stdin as JSON lines until EOF.
+    """
+    import bpy
+    import mmd_tools
+    if not hasattr(bpy.types.Object, 'mmd_type'):
+        mmd_tools.register()
+
+    sys.stdout.write(READY_LINE + '\n')
+    sys.stdout.flush()
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        job = json.loads(line)
+        result = {'id': job['id'], 'model': job['model'], 'output': job['output']}
+        try:
+            result['times'] = _processJob(job)
+            result['status'] = 'ok'
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            result['traceback'] = traceback.format_exc()
+        _send(result)
+
+
+#****************************************
+# Controller
+#****************************************
+class _Worker:
+    def __init__(self, index, command):
+        self.index = index
+        self.command = command
+        self.process = None
+        self.lines = None
+
+    def start(self, timeout=None):
+        """ Start a worker process and wait until it is ready.
+        """
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            bufsize=1,
+            )
+        self.lines = queue.Queue()
+        threading.Thread(target=self.__read, args=(self.process, self.lines), daemon=True).start()
+        start = time.time()
+        while True:
+            remaining = None if timeout is None else max(timeout - (time.time() - start), 0)
+            try:
+                line = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                raise Exception('The worker did not start in %s seconds'%timeout)
+            if line is None:
+                raise Exception('The worker exited with code %s on startup'%self.process.wait())
+            if line.startswith(READY_LINE):
+                return
+
+    @staticmethod
+    def __read(process, lines):
+        for line in process.stdout:
+            if line.startswith(RESULT_PREFIX) or line.startswith(READY_LINE):
+                lines.put(line.strip())
+        lines.put(None)
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=30)
+        except Exception:
+            self.process.kill()
+        self.process = None
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process = None
+
+    @staticmethod
+    def failedResult(job, error):
+        return {'id': job['id'], 'model': job['model'], 'output': job['output'],
+                'status': 'failed', 'error': error}
+
+    def run(self, job, timeout):
+        """ Send a job to the started worker and wait for the result. The worker is killed if it died or timed out.
+        """
+        start = time.time()
+        try:
+            self.process.stdin.write(json.dumps(job) + '\n')
+            self.process.stdin.flush()
+            while True:
+                remaining = None if timeout is None else max(timeout - (time.time() - start), 0)
+                line = self.lines.get(timeout=remaining)
+                if line is None:
+                    raise Exception('The worker exited with code %s'%self.process.wait())
+                if line.startswith(RESULT_PREFIX):
+                    return json.loads(line[len(RESULT_PREFIX):])
+        except queue.Empty:
+            self.kill()
+            return self.failedResult(job, 'Timed out after %s seconds'%timeout)
+        except Exception as e:
+            self.kill()
+            return self.failedResult(job, str(e))
+
+
+def runController(jobs, workers, blender, timeout=None, report=None, startup_timeout=300):
+    """ Process jobs with worker Blender processes and return the report dict.
+
+     The timeout of each job starts after the worker is ready, so the startup of
+     Blender is limited by startup_timeout instead.
+     If a worker can't be started, its job is put back for the other workers and
+     its thread stops. The remaining jobs are recorded as failed only when no
+     worker is left.
+    """
+    script = os.path.abspath(__file__)
+    command = [blender, '-b', '--python', script, '--', '--worker']
+    jobQueue = queue.Queue()
+    for job in jobs:
+        jobQueue.put(job)
+    results = []
+    lock = threading.Lock()
+    numThreads = max(1, min(workers, len(jobs)))
+    alive = [numThreads]
+
+    def record(worker, job, result, t):
+        result['worker'] = worker.index
+        result['wall_time'] = time.time() - t
+        logging.info('[%s] %s: %s', result['status'], job['model'], result.get('error', ''))
+        with lock:
+            results.append(result)
+
+    def work(worker):
+        error = None
+        try:
+            while True:
+                try:
+                    job = jobQueue.get_nowait()
+                except queue.Empty:
+                    break
+                t = time.time()
+                if worker.process is None:
+                    try:
+                        worker.start(startup_timeout)
+                    except Exception as e:
+                        worker.kill()
+                        error = 'Failed to start the worker: %s'%e
+                        logging.warning('Worker %d: %s', worker.index, error)
+                        jobQueue.put(job)
+                        break
+                record(worker, job, worker.run(job, timeout), t)
+        finally:
+            worker.stop()
+            with lock:
+                alive[0] -= 1
+                last = alive[0] == 0
+            # the last worker fails the jobs which no worker is left to process
+            while last:
+                try:
+                    job = jobQueue.get_nowait()
+                except queue.Empty:
+                    break
+                record(worker, job, _Worker.failedResult(job, error or 'No worker is available'), time.time())
+
+    start = time.time()
+    threads = []
+    for i in range(numThreads):
+        thread = threading.Thread(target=work, args=(_Worker(i, command),))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    order = dict((job['id'], i) for i, job in enumerate(jobs))
+    results.sort(key=lambda x:order.get(x['id'], 0))
+    r = {
+        'workers': len(threads),
+        'total_time': time.time() - start,
+        'succeeded': len([i for i in results if i['status'] == 'ok']),
+        'failed': len([i for i in results if i['status'] != 'ok']),
+        'results': results,
+        }
+    if report:
+        with open(report, 'w', encoding='utf-8') as f:
+            json.dump(r, f, indent=2, ensure_ascii=False)
+    return r
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Convert MMD models and motions to .blend files.')
+    parser.add_argument('--manifest', help='the JSON manifest of jobs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='the number of worker processes')
+    parser.add_argument('--report', default='mmd_tools_batch_report.json', help='the JSON report file')
+    parser.add_argument('--output-dir', default=None, help='override the output directory of the manifest')
+    parser.add_argument('--timeout', type=float, default=None, help='the time limit of each job in seconds')
+    parser.add_argument('--startup-timeout', type=float, default=300, help='the time limit of starting a worker in seconds')
+    parser.add_argument('--blender', default=None, help='the Blender executable for workers')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(_scriptArgs(argv))
+
+    if args.worker:
+        runWorker()
+        return 0
+
+    if not args.manifest:
+        parser.error('--manifest is required')
+    blender = args.blender
+    if blender is None:
+        try:
+            import bpy
+            blender = bpy.app.binary_path
+        except ImportError:
+            blender = 'blender'
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    jobs = loadManifest(args.manifest, args.output_dir)
+    r = runController(jobs, args.workers, blender, args.timeout, args.report, args.startup_timeout)
+    logging.info('%d succeeded, %d failed in %.1f seconds. The report is written to %s',
+                 r['succeeded'], r['failed'], r['total_time'], args.report)
+    return 0 if r['failed'] == 0 and len(r['results']) == len(jobs) else 1
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = main(sys.argv)
+    if code != 0:
+        sys.exit(code)
@@ -58,6 +58,39 @@ def setParent(obj, parent):
     obj.hide = ho
     parent.hide = hp
 
+def removeObjects(objects):
+    """ Unlink objects from all scenes and remove them from bpy.data.
+
+     bpy.data.batch_remove is used if it is available.
+    """
+    objects = list(objects)
+    if hasattr(bpy.data, 'batch_remove'):
+        bpy.data.batch_remove(objects)
+        return
+    for obj in objects:
+        for scene in obj.users_scene:
+            scene.objects.unlink(obj)
+        bpy.data.objects.remove(obj)
+
+def applyScale(obj):
+    """ Apply the scale of a mesh object to its mesh data without operators.
+
+     Children are kept in place like bpy.ops.object.transform_apply does.
+    """
+    import mathutils
+    scale = tuple(obj.scale)
+    if scale == (1.0, 1.0, 1.0):
+        return
+    mat = mathutils.Matrix.Identity(4)
+    mat[0][0], mat[1][1], mat[2][2] = scale
+    if obj.data.users > 1:
+        obj.data = obj.data.copy()
+    obj.data.transform(mat)
+    obj.data.update()
+    for child in obj.children:
+        child.matrix_parent_inverse = mat * child.matrix_parent_inverse
+    obj.scale = (1.0, 1.0, 1.0)
+
 def setParentToBone(obj, parent, bone_name):
     import bpy
     select_object(parent)
@@ -3,9 +3,159 @@
 import bpy
 from bpy.types import PoseBone
 import mathutils
+import numpy as np
 
 from mmd_tools import bpyutils
 
+class _BoneIdIndex(object):
+    """ Map from bone IDs to pose bone names of an armature.
+
+     The index is rebuilt lazily when the number of bones changes, a looked up
+     bone was renamed or a bone ID is not found, e.g. it was assigned directly.
+     The next new ID is kept on the armature object so that IDs are never reused.
+    """
+    NEXT_ID_PROP_NAME = 'mmd_next_bone_id'
+
+    __indices = {}
+
+    def __init__(self, armature):
+        self.__armature = armature
+        self.__names = {}
+        self.__num_bones = -1
+        self.__max_id = -1
+
+    @classmethod
+    def get(cls, armature):
+        key = (armature.as_pointer(), armature.name)
+        index = cls.__indices.get(key)
+        if index is None:
+            cls.__prune()
+            index = cls(armature)
+            cls.__indices[key] = index
+        index.__armature = armature
+        if index.__num_bones != len(armature.pose.bones):
+            index.rebuild()
+        return index
+
+    @classmethod
+    def invalidate(cls, armature):
+        cls.__indices.pop((armature.as_pointer(), armature.name), None)
+
+    @classmethod
+    def __prune(cls):
+        """ Drop the indices of removed or renamed armatures.
+        """
+        for key, index in list(cls.__indices.items()):
+            try:
+                valid = (index.__armature.as_pointer(), index.__armature.name) == key
+            except ReferenceError:
+                valid = False
+            if not valid:
+                del cls.__indices[key]
+
+    def rebuild(self):
+        pose_bones = self.__armature.pose.bones
+        self.__names = {}
+        self.__max_id = -1
+        for bone in pose_bones:
+            bone_id = bone.mmd_bone.bone_id
+            if bone_id >= 0:
+                self.__names[bone_id] = bone.name
+                self.__max_id = max(self.__max_id, bone_id)
+        self.__num_bones = len(pose_bones)
+
+    def find(self, bone_id):
+        pose_bones = self.__armature.pose.bones
+        bone = pose_bones.get(self.__names.get(bone_id, ''))
+        if bone is None or bone.mmd_bone.bone_id != bone_id:
+            self.rebuild()
+            bone = pose_bones.get(self.__names.get(bone_id, ''))
+        return bone
+
+    def new_id(self, bone_name):
+        arm = self.__armature
+        bone_id = max(arm.get(self.NEXT_ID_PROP_NAME, 0), self.__max_id + 1)
+        arm[self.NEXT_ID_PROP_NAME] = bone_id + 1
+        self.__names[bone_id] = bone_name
+        self.__max_id = bone_id
+        return bone_id
+
+
+class _AdditionalTransformState(object):
+    """ Cached state of additional transformation of an armature.
+
+     It keeps the dirty bones, the shadow bones and the shadow bone used by each bone,
+     so that updates do not have to scan the whole armature. The state is rebuilt
+     when the number of bones changes. Renaming bones requires invalidate().
+    """
+    __states = {}
+
+    def __init__(self, armature):
+        self.armature = armature
+        self.dirty = set()
+        self.refs = {}          # {bone_name => (source_bone_name, shadow_bone_type)}
+        self.shadow_bones = {}  # {(source_bone_name, shadow_bone_type) => shadow_bone_name}
+        self.num_bones = -1
+
+    @classmethod
+    def get(cls, armature):
+        key = (armature.as_pointer(), armature.name)
+        state = cls.__states.get(key)
+        if state is None:
+            cls.__prune()
+            state = cls(armature)
+            cls.__states[key] = state
+        state.armature = armature
+        if state.num_bones != len(armature.pose.bones):
+            state.rebuild()
+        return state
+
+    @classmethod
+    def invalidate(cls, armature):
+        cls.__states.pop((armature.as_pointer(), armature.name), None)
+
+    @classmethod
+    def __prune(cls):
+        """ Drop the states of removed or renamed armatures.
+        """
+        for key, state in list(cls.__states.items()):
+            try:
+                valid = (state.armature.as_pointer(), state.armature.name) == key
+            except ReferenceError:
+                valid = False
+            if not valid:
+                del cls.__states[key]
+
+    def update_num_bones(self):
+        """ Take the current bones as known after the bones were changed with the state updated.
+        """
+        self.num_bones = len(self.armature.pose.bones)
+
+    def rebuild(self):
+        pose_bones = self.armature.pose.bones
+        self.shadow_bones = {}
+        shadow_keys = {}
+        for p_bone in pose_bones:
+            if p_bone.mmd_shadow_bone_type not in {'ADDITIONAL_TRANSFORM', 'ADDITIONAL_TRANSFORM_INVERT'}:
+                continue
+            for c in p_bone.constraints:
+                key = (c.subtarget, p_bone.mmd_shadow_bone_type)
+                self.shadow_bones.setdefault(key, p_bone.name)
+                shadow_keys.setdefault(p_bone.name, key)
+
+        self.dirty = set()
+        self.refs = {}
+        for p_bone in pose_bones:
+            if p_bone.is_mmd_shadow_bone:
+                continue
+            if p_bone.mmd_bone.is_additional_transform_dirty:
+                self.dirty.add(p_bone.name)
+            rot_constraint = FnBone(p_bone).get_additional_transform_constraints()[0]
+            if rot_constraint and rot_constraint.subtarget in shadow_keys:
+                self.refs[p_bone.name] = shadow_keys[rot_constraint.subtarget]
+        self.update_num_bones()
+
+
 class FnBone(object):
     AT_DUMMY_CONSTRAINT_NAME = 'mmd_tools_at_dummy'
     AT_ROTATION_CONSTRAINT_NAME = 'mmd_tools_at_rotation'
@@ -19,19 +169,25 @@ class FnBone(object):
 
     @classmethod
     def from_bone_id(cls, armature, bone_id):
-        for bone in armature.pose.bones:
-            if bone.mmd_bone.bone_id == bone_id:
-                return cls(bone)
-        return None
+        bone = _BoneIdIndex.get(armature).find(bone_id)
+        if bone is None:
+            return None
+        return cls(bone)
+
+    @staticmethod
+    def invalidate_bone_id_index(armature):
+        """ Discard the cached bone ID index of the armature.
+
+         Call this after renaming, adding or removing bones in bulk.
+        """
+        _BoneIdIndex.invalidate(armature)
 
     @property
     def bone_id(self):
         mmd_bone = self.__bone.mmd_bone
         if mmd_bone.bone_id < 0:
-            max_id = -1
-            for bone in self.__bone.id_data.pose.bones:
-                max_id = max(max_id, bone.mmd_bone.bone_id)
-            mmd_bone.bone_id = max_id + 1
+            index = _BoneIdIndex.get(self.__bone.id_data)
+            mmd_bone.bone_id = index.new_id(self.__bone.name)
         return mmd_bone.bone_id
 
     def __get_pose_bone(self):
@@ -50,23 +206,119 @@ class FnBone(object):
     def apply_additional_transformation(self):
         """ create or update constaints to apply additional transformation
         """
+        self.apply_additional_transformations(self.__bone.id_data, [self.__bone])
+
+    @staticmethod
+    def mark_additional_transform_dirty(pose_bone):
+        """ Mark the bone to be updated by the next update_additional_transformations call.
+        """
+        pose_bone.mmd_bone['is_additional_transform_dirty'] = True
+        _AdditionalTransformState.get(pose_bone.id_data).dirty.add(pose_bone.name)
+
+    @staticmethod
+    def invalidate_additional_transform_state(armature):
+        """ Discard the cached additional transformation state of the armature.
+
+         It must be called after renaming bones, since the state only notices
+         changes of the number of bones.
+        """
+        _AdditionalTransformState.invalidate(armature)
+
+    @classmethod
+    def update_additional_transformations(cls, armature, force=False):
+        """ update constraints of additional transformation of changed bones
+
+         Only the bones marked as dirty since the last update are processed
+         unless force is True. Shadow bones which are no longer used by any bone
+         are removed.
+
+         Args:
+             armature: The armature object.
+             force: Update all bones.
+        """
+        state = _AdditionalTransformState.get(armature)
+        if force:
+            pose_bones = [b for b in armature.pose.bones if not b.is_mmd_shadow_bone]
+        else:
+            pose_bones = [armature.pose.bones[n] for n in sorted(state.dirty) if n in armature.pose.bones]
+        if len(pose_bones) > 0:
+            cls.apply_additional_transformations(armature, pose_bones)
+        cls.__remove_unused_shadow_bones(state)
+
+    @classmethod
+    def apply_additional_transformations(cls, armature, pose_bones=None):
+        """ create or update constraints of additional transformation for many bones at once
+
+         All missing shadow bones are created in a single edit mode session.
+
+         Args:
+             armature: The armature object.
+             pose_bones: The pose bones to update. All pose bones are updated if it is None.
+        """
+        if pose_bones is None:
+            pose_bones = [b for b in armature.pose.bones if not b.is_mmd_shadow_bone]
+        bone_names = [b.name for b in pose_bones]
+        state = _AdditionalTransformState.get(armature)
+        shadow_bones = state.shadow_bones
+
+        requests = {}
+        for name in bone_names:
+            mmd_bone = armature.pose.bones[name].mmd_bone
+            source_bone = mmd_bone.additional_transform_bone
+            if not source_bone or not (mmd_bone.has_additional_rotation or mmd_bone.has_additional_location):
+                continue
+            key = (source_bone, cls.__shadow_bone_type(mmd_bone.additional_transform_influence < 0))
+            requests[name] = key
+
+        missing = sorted(set(requests.values()) - set(shadow_bones.keys()))
+        if len(missing) > 0:
+            created = cls.__create_shadow_edit_bones(armature, missing)
+            for key, shadow_bone_name in zip(missing, created):
+                cls.__setup_shadow_pose_bone(armature, armature.pose.bones[shadow_bone_name], *key)
+                shadow_bones[key] = shadow_bone_name
+            state.update_num_bones()
+
+        fnBone = cls()
+        for name in bone_names:
+            fnBone.pose_bone = armature.pose.bones[name]
+            fnBone.__apply(armature.pose.bones.get(shadow_bones.get(requests.get(name), '')))
+            state.dirty.discard(name)
+            if name in requests:
+                state.refs[name] = requests[name]
+            else:
+                state.refs.pop(name, None)
+
+    @staticmethod
+    def __remove_unused_shadow_bones(state):
+        armature = state.armature
+        used = set(state.refs.values())
+        unused = [k for k in state.shadow_bones.keys() if k not in used]
+        if len(unused) == 0:
+            return
+        names = [state.shadow_bones.pop(k) for k in unused]
+        with bpyutils.edit_object(armature) as data:
+            for name in names:
+                edit_bone = data.edit_bones.get(name)
+                if edit_bone is not None:
+                    data.edit_bones.remove(edit_bone)
+        state.update_num_bones()
+
+    def __apply(self, shadow_bone):
         mmd_bone = self.__bone.mmd_bone
 
         influence = mmd_bone.additional_transform_influence
-        source_bone = mmd_bone.additional_transform_bone
         mute_rotation = not mmd_bone.has_additional_rotation
         mute_location = not mmd_bone.has_additional_location
 
         mmd_bone.is_additional_transform_dirty = False
 
-        if not source_bone or (mute_rotation and mute_location):
+        if shadow_bone is None:
             self.__remove_constraints()
             return
 
         rot_constraint, loc_constraint, parent_constraint = self.__create_constraints()
 
         self.__bone.bone.use_inherit_rotation = False
-        shadow_bone = self.__get_at_shadow_bone(source_bone, influence < 0)
 
         rot_constraint.subtarget = shadow_bone.name
         rot_constraint.influence = abs(influence)
@@ -78,37 +330,32 @@ class FnBone(object):
         rot_constraint.mute = mute_rotation
         loc_constraint.mute = mute_location
 
-    def __get_shadow_bone(self, bone_name, shadow_bone_type):
-        arm = self.__bone.id_data
-        for p_bone in arm.pose.bones:
-            if p_bone.mmd_shadow_bone_type == shadow_bone_type:
-                for c in p_bone.constraints:
-                    if c.subtarget == bone_name:
-                        return p_bone
-        return None
-
-    def __get_at_shadow_bone(self, bone_name, invert=False):
-        arm = self.__bone.id_data
-        mmd_shadow_bone_type = 'ADDITIONAL_TRANSFORM'
+    @staticmethod
+    def __shadow_bone_type(invert):
         if invert:
-            mmd_shadow_bone_type += '_INVERT'
-
-        shadow_bone = self.__get_shadow_bone(bone_name, mmd_shadow_bone_type)
-        if shadow_bone:
-            return shadow_bone
-        with bpyutils.edit_object(arm) as data:
-            src_bone = data.edit_bones[bone_name]
-            shadow_bone = data.edit_bones.new(name='%s.shadow'%(bone_name))
-            shadow_bone.head = mathutils.Vector([0, 0, 0])
-            shadow_bone.tail = src_bone.tail - src_bone.head
-            shadow_bone.layers = (
-                False, False, False, False, False, False, False, False,
-                True , False, False, False, False, False, False, False,
-                False, False, False, False, False, False, False, False,
-                False, False, False, False, False, False, False, False)
-            shadow_bone_name = shadow_bone.name
-
-        shadow_p_bone = arm.pose.bones[shadow_bone_name]
+            return 'ADDITIONAL_TRANSFORM_INVERT'
+        return 'ADDITIONAL_TRANSFORM'
+
+    @staticmethod
+    def __create_shadow_edit_bones(armature, keys):
+        names = []
+        with bpyutils.edit_object(armature) as data:
+            for bone_name, shadow_bone_type in keys:
+                src_bone = data.edit_bones[bone_name]
+                shadow_bone = data.edit_bones.new(name='%s.shadow'%(bone_name))
+                shadow_bone.head = mathutils.Vector([0, 0, 0])
+                shadow_bone.tail = src_bone.tail - src_bone.head
+                shadow_bone.layers = (
+                    False, False, False, False, False, False, False, False,
+                    True , False, False, False, False, False, False, False,
+                    False, False, False, False, False, False, False, False,
+                    False, False, False, False, False, False, False, False)
+                names.append(shadow_bone.name)
+        return names
+
+    @staticmethod
+    def __setup_shadow_pose_bone(arm, shadow_p_bone, bone_name, mmd_shadow_bone_type):
+        invert = mmd_shadow_bone_type.endswith('_INVERT')
         shadow_p_bone.is_mmd_shadow_bone = True
         shadow_p_bone.mmd_shadow_bone_type = mmd_shadow_bone_type
 
@@ -132,18 +379,163 @@ class FnBone(object):
             c.invert_y = True
             c.invert_z = True
 
-        return shadow_p_bone
+    #****************************************
+    # Methods for baking constraints
+    #****************************************
+    @classmethod
+    def get_constraints_to_bake(cls, armature):
+        """ Return (bone names, constraints) of IK and additional transformation.
+
+         The bone names are bones whose pose is changed by the constraints, and
+         the constraints are a list of (pose bone, constraint) which are replaced by baked keys.
+         Only IK constraints, additional transformation constraints and the constraints
+         of shadow bones which copy the source bones are included. Other constraints
+         (e.g. rigid body tracks) are kept.
+        """
+        bone_names = set()
+        constraints = []
+        fnBone = cls()
+        for pose_bone in armature.pose.bones:
+            if pose_bone.is_mmd_shadow_bone:
+                constraints.extend((pose_bone, c) for c in pose_bone.constraints
+                                   if c.type in {'COPY_ROTATION', 'COPY_LOCATION'} and c.target == armature)
+                continue
+            fnBone.pose_bone = pose_bone
+            at_constraints = [c for c in fnBone.get_additional_transform_constraints() if c is not None]
+            if len(at_constraints) > 0:
+                bone_names.add(pose_bone.name)
+                constraints.extend((pose_bone, c) for c in at_constraints)
+            for c in pose_bone.constraints:
+                if c.type != 'IK':
+                    continue
+                constraints.append((pose_bone, c))
+                b = pose_bone
+                n = 0
+                while b is not None and (c.chain_count == 0 or n < c.chain_count):
+                    bone_names.add(b.name)
+                    b = b.parent
+                    n += 1
+        return (sorted(bone_names), constraints)
+
+    @staticmethod
+    def __replace_keys(action, data_path, index, group, frames, values):
+        """ Replace the keyframes in the range of frames. Keyframes out of the range are kept as they are.
+        """
+        fcurve = action.fcurves.find(data_path, index)
+        if fcurve is None:
+            fcurve = action.fcurves.new(data_path=data_path, index=index, action_group=group)
+        keyframe_points = fcurve.keyframe_points
+        co = np.empty(len(keyframe_points) * 2, dtype=np.float32)
+        keyframe_points.foreach_get('co', co)
+        old_frames = co[0::2]
+        for i in reversed(np.flatnonzero((old_frames >= frames[0]) & (old_frames <= frames[-1])).tolist()):
+            keyframe_points.remove(keyframe_points[i], fast=True)
+
+        count = len(keyframe_points)
+        keyframe_points.add(len(frames))
+        co = np.empty(len(keyframe_points) * 2, dtype=np.float32)
+        keyframe_points.foreach_get('co', co)
+        co = co.reshape(-1, 2)
+        co[count:, 0] = frames
+        co[count:, 1] = values
+        keyframe_points.foreach_set('co', co.ravel())
+        fcurve.update()
+
+    @classmethod
+    def bake_constraints(cls, armature, frame_start, frame_end, constraint_mode='MUTE'):
+        """ Bake the pose changed by IK and additional transformation to FK keyframes.
+
+         The scene is evaluated once per frame to read the visual pose of all baked bones,
+         then location and rotation keys are written in bulk in the rotation mode of each bone.
+         Existing keys of the baked channels in the frame range are replaced.
+
+         Args:
+             armature: The armature object.
+             frame_start, frame_end: The frame range to bake.
+             constraint_mode: 'NONE', 'MUTE' or 'REMOVE' the baked constraints.
+
+         Returns:
+             The names of baked bones.
+        """
+        bone_names, constraints = cls.get_constraints_to_bake(armature)
+        if len(bone_names) == 0 or frame_end < frame_start:
+            return bone_names
+
+        scene = bpy.context.scene
+        pose_bones = [armature.pose.bones[n] for n in bone_names]
+        rotation_modes = [b.rotation_mode for b in pose_bones]
+        frames = np.arange(frame_start, frame_end + 1, dtype=np.float64)
+        locations = np.zeros((len(frames), len(pose_bones), 3))
+        rotations = np.zeros((len(frames), len(pose_bones), 4))
+
+        eulers = [None] * len(pose_bones)
+        frame_current = scene.frame_current
+        for i, frame in enumerate(frames):
+            scene.frame_set(int(frame))
+            for j, pose_bone in enumerate(pose_bones):
+                mat = armature.convert_space(pose_bone=pose_bone, matrix=pose_bone.matrix, from_space='POSE', to_space='LOCAL')
+                loc, rot, scale = mat.decompose()
+                locations[i, j] = loc
+                mode = rotation_modes[j]
+                if mode == 'QUATERNION':
+                    rotations[i, j] = rot
+                elif mode == 'AXIS_ANGLE':
+                    axis, angle = rot.to_axis_angle()
+                    rotations[i, j] = (angle, axis[0], axis[1], axis[2])
+                else:
+                    # keep euler angles continuous
+                    eulers[j] = rot.to_euler(mode) if eulers[j] is None else rot.to_euler(mode, eulers[j])
+                    rotations[i, j, :3] = eulers[j]
+        scene.frame_set(frame_current)
+
+        # keep quaternions continuous
+        is_quaternion = np.array([mode == 'QUATERNION' for mode in rotation_modes])
+        dots = np.sum(rotations[1:] * rotations[:-1], axis=-1)
+        signs = np.cumprod(np.where((dots < 0) & is_quaternion, -1.0, 1.0), axis=0)
+        rotations[1:] *= signs[..., np.newaxis]
+
+        a = armature.animation_data_create()
+        if a.action is None:
+            a.action = bpy.data.actions.new(name=armature.name)
+        action = a.action
+        for j, pose_bone in enumerate(pose_bones):
+            data_path = pose_bone.path_from_id('location')
+            for k in range(3):
+                cls.__replace_keys(action, data_path, k, pose_bone.name, frames, locations[:, j, k])
+            mode = rotation_modes[j]
+            if mode == 'QUATERNION':
+                data_path, count = pose_bone.path_from_id('rotation_quaternion'), 4
+            elif mode == 'AXIS_ANGLE':
+                data_path, count = pose_bone.path_from_id('rotation_axis_angle'), 4
+            else:
+                data_path, count = pose_bone.path_from_id('rotation_euler'), 3
+            for k in range(count):
+                cls.__replace_keys(action, data_path, k, pose_bone.name, frames, rotations[:, j, k])
+
+        if constraint_mode == 'MUTE':
+            for pose_bone, c in constraints:
+                c.mute = True
+        elif constraint_mode == 'REMOVE':
+            for pose_bone, c in constraints:
+                pose_bone.constraints.remove(c)
+            cls.invalidate_additional_transform_state(armature)
+        return bone_names
+
+    def get_additional_transform_constraints(self):
+        """ Return a tuple of (rotation, location, parent) constraints of additional transformation.
+        """
+        return self.__get_at_constraints()
 
     def __get_at_constraints(self):
         rot_constraint = None
         loc_constraint = None
         parent_constraint = None
         for c in self.__bone.constraints:
-            if c.name == self.AT_ROTATION_CONSTRAINT_NAME:
+            if c.name in {self.AT_ROTATION_CONSTRAINT_NAME, 'mmd_additional_rotation'}:
                 rot_constraint = c
-            elif c.name == self.AT_LOCATION_CONSTRAINT_NAME:
+            elif c.name in {self.AT_LOCATION_CONSTRAINT_NAME, 'mmd_additional_location'}:
                 loc_constraint = c
-            elif c.name == self.AT_PARENT_CONSTRAINT:
+            elif c.name in {self.AT_PARENT_CONSTRAINT, 'mmd_additional_parent'}:
                 parent_constraint = c
         return (rot_constraint, loc_constraint, parent_constraint)
 
@@ -174,7 +566,7 @@ class FnBone(object):
 
         rot_constraint = self.__bone.constraints.new('CHILD_OF')
         rot_constraint.mute = True
-        rot_constraint.name = 'mmd_additional_rotation'
+        rot_constraint.name = self.AT_ROTATION_CONSTRAINT_NAME
         rot_constraint.target = arm
         rot_constraint.use_location_x = False
         rot_constraint.use_location_y = False
@@ -188,7 +580,7 @@ class FnBone(object):
 
         loc_constraint = self.__bone.constraints.new('CHILD_OF')
         loc_constraint.mute = True
-        loc_constraint.name = 'mmd_additional_location'
+        loc_constraint.name = self.AT_LOCATION_CONSTRAINT_NAME
         loc_constraint.target = arm
         loc_constraint.use_location_x = True
         loc_constraint.use_location_y = True
@@ -204,7 +596,7 @@ class FnBone(object):
         if self.__bone.parent:
             parent_constraint = self.__bone.constraints.new('CHILD_OF')
             parent_constraint.mute = False
-            parent_constraint.name = 'mmd_additional_parent'
+            parent_constraint.name = self.AT_PARENT_CONSTRAINT
             parent_constraint.target = arm
             parent_constraint.subtarget = self.__bone.parent.name
             parent_constraint.use_location_x = False
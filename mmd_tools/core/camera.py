@@ -36,7 +36,7 @@ class MMDCamera:
         empty.mmd_type = 'CAMERA'
         empty.mmd_camera.distance = 0.0
         empty.mmd_camera.angle = 45
-        empty.mmd_camera.persp = True
+        empty.mmd_camera.is_perspective = True
         cameraObj.parent = empty
         cameraObj.data.sensor_fit = 'VERTICAL'
         cameraObj.location = mathutils.Vector((0,0,0))
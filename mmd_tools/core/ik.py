@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+""" Solve MMD IK with numpy.
+
+ IK chains of a pmx.Model are solved by CCD (cyclic coordinate descent) in MMD coordinates,
+ and all frames are solved at once. The results are local rotations of link bones,
+ so they can be used for pose evaluation by pose.Skeleton or baked as FK keys.
+"""
+import logging
+
+import numpy as np
+
+from mmd_tools.core.pose import Skeleton, quaternionToMatrix
+
+
+def quaternionMultiply(a, b):
+    """ Multiply (..., 4) arrays of (x, y, z, w) quaternions.
+    """
+    ax, ay, az, aw = [a[..., i] for i in range(4)]
+    bx, by, bz, bw = [b[..., i] for i in range(4)]
+    return np.stack((
+        aw*bx + ax*bw + ay*bz - az*by,
+        aw*by - ax*bz + ay*bw + az*bx,
+        aw*bz + ax*by - ay*bx + az*bw,
+        aw*bw - ax*bx - ay*by - az*bz,
+        ), axis=-1)
+
+
+def axisAngleToQuaternion(axis, angle):
+    """ Convert (..., 3) arrays of unit axes and (...) arrays of angles to (x, y, z, w) quaternions.
+    """
+    half = np.asarray(angle)[..., np.newaxis] * 0.5
+    return np.concatenate((axis * np.sin(half), np.cos(half)), axis=-1)
+
+
+def _eulerToQuaternion(euler):
+    """ Convert (..., 3) arrays of YXZ euler angles (R = Ry * Rx * Rz) to quaternions.
+    """
+    shape = euler.shape[:-1]
+    x = axisAngleToQuaternion(np.broadcast_to([1.0, 0.0, 0.0], shape + (3,)), euler[..., 0])
+    y = axisAngleToQuaternion(np.broadcast_to([0.0, 1.0, 0.0], shape + (3,)), euler[..., 1])
+    z = axisAngleToQuaternion(np.broadcast_to([0.0, 0.0, 1.0], shape + (3,)), euler[..., 2])
+    return quaternionMultiply(quaternionMultiply(y, x), z)
+
+
+def _quaternionToEuler(q):
+    """ Convert (..., 4) arrays of quaternions to YXZ euler angles (R = Ry * Rx * Rz).
+    """
+    m = quaternionToMatrix(q)
+    x = np.arcsin(np.clip(-m[..., 1, 2], -1.0, 1.0))
+    y = np.arctan2(m[..., 0, 2], m[..., 2, 2])
+    z = np.arctan2(m[..., 1, 0], m[..., 1, 1])
+    return np.stack((x, y, z), axis=-1)
+
+
+class _Chain:
+    def __init__(self, bone_index, bone, skeleton):
+        self.ik = bone_index
+        self.effector = bone.target
+        self.loop_count = max(int(bone.loopCount), 0)
+        self.limit_angle = float(bone.rotationConstraint)
+        self.links = []
+        self.limits = []
+        for link in bone.ik_links:
+            self.links.append(link.target)
+            if link.minimumAngle is not None and link.maximumAngle is not None:
+                lo = np.array(link.minimumAngle, dtype=np.float64)
+                hi = np.array(link.maximumAngle, dtype=np.float64)
+                self.limits.append((np.minimum(lo, hi), np.maximum(lo, hi)))
+            else:
+                self.limits.append(None)
+
+        # bones whose world matrices are needed, sorted by depth
+        bones = set()
+        for i in [self.ik, self.effector] + self.links:
+            while i >= 0 and i not in bones:
+                bones.add(i)
+                i = skeleton.parents[i]
+        self.bones = sorted(bones, key=lambda i:skeleton.depths[i])
+
+
+class IKSolver:
+    """ Solve all IK chains of a pmx.Model.
+
+     Chains are solved in the transform order of IK bones. In each loop, every link
+     is rotated to move the effector toward the IK bone, limited by the rotation
+     constraint of the IK bone and by the angle limits of the link.
+     Limits are applied to YXZ euler angles of the local rotation of the link.
+    """
+    def __init__(self, model, skeleton=None):
+        self.__skeleton = skeleton or Skeleton(model)
+        bones = model.bones
+        count = len(bones)
+        self.__chains = []
+        for i in self.__skeleton.order:
+            bone = bones[i]
+            if not bone.isIK:
+                continue
+            links = [l.target for l in bone.ik_links]
+            if bone.target is None or not 0 <= bone.target < count or len(links) == 0 or not all(0 <= l < count for l in links):
+                logging.warning('Skipped the invalid IK bone %s', bone.name)
+                continue
+            self.__chains.append(_Chain(i, bone, self.__skeleton))
+
+    def skeleton(self):
+        return self.__skeleton
+
+    def __worldMatrices(self, chain, locations, rotations):
+        skeleton = self.__skeleton
+        world = {}
+        for i in chain.bones:
+            mat = np.zeros((len(locations), 4, 4))
+            mat[:, :3, :3] = quaternionToMatrix(rotations[:, i])
+            mat[:, :3, 3] = skeleton.offsets[i] + locations[:, i]
+            mat[:, 3, 3] = 1.0
+            p = skeleton.parents[i]
+            world[i] = mat if p < 0 else np.matmul(world[p], mat)
+        return world
+
+    def __solveChain(self, chain, locations, rotations, tolerance):
+        for loop in range(chain.loop_count):
+            world = self.__worldMatrices(chain, locations, rotations)
+            if np.all(np.linalg.norm(world[chain.effector][:, :3, 3] - world[chain.ik][:, :3, 3], axis=-1) < tolerance):
+                break
+            moved = False
+            for n, (link, limits) in enumerate(zip(chain.links, chain.limits)):
+                if n > 0:
+                    world = self.__worldMatrices(chain, locations, rotations)
+                link_rot = world[link][:, :3, :3]
+                origin = world[link][:, :3, 3]
+                to_effector = world[chain.effector][:, :3, 3] - origin
+                to_target = world[chain.ik][:, :3, 3] - origin
+
+                # vectors in the space of the link
+                e = np.einsum('fji,fj->fi', link_rot, to_effector)
+                t = np.einsum('fji,fj->fi', link_rot, to_target)
+                e_len = np.linalg.norm(e, axis=-1)
+                t_len = np.linalg.norm(t, axis=-1)
+                valid = (e_len > 1e-8) & (t_len > 1e-8)
+                e /= np.where(valid, e_len, 1.0)[:, np.newaxis]
+                t /= np.where(valid, t_len, 1.0)[:, np.newaxis]
+
+                angle = np.arccos(np.clip(np.sum(e * t, axis=-1), -1.0, 1.0))
+                if chain.limit_angle > 0:
+                    angle = np.minimum(angle, chain.limit_angle)
+                axis = np.cross(e, t)
+                axis_len = np.linalg.norm(axis, axis=-1)
+                valid &= (axis_len > 1e-8) & (angle > 1e-6)
+                if not np.any(valid):
+                    continue
+                moved = True
+                axis /= np.where(valid, axis_len, 1.0)[:, np.newaxis]
+                angle = np.where(valid, angle, 0.0)
+
+                q = quaternionMultiply(rotations[:, link], axisAngleToQuaternion(axis, angle))
+                if limits is not None:
+                    q = _eulerToQuaternion(np.clip(_quaternionToEuler(q), limits[0], limits[1]))
+                q /= np.linalg.norm(q, axis=-1)[:, np.newaxis]
+                rotations[:, link] = np.where(valid[:, np.newaxis], q, rotations[:, link])
+            if not moved:
+                break
+
+    def solve(self, locations, rotations, tolerance=1e-4):
+        """ Solve IK for many frames.
+
+        Args:
+            locations: (frames, bones, 3) array of local locations
+            rotations: (frames, bones, 4) array of local (x, y, z, w) rotations
+
+        Returns:
+            A new (frames, bones, 4) array of rotations with IK applied.
+        """
+        locations = np.asarray(locations, dtype=np.float64)
+        rotations = np.array(rotations, dtype=np.float64)
+        for chain in self.__chains:
+            self.__solveChain(chain, locations, rotations, tolerance)
+        return rotations
+
+    def evaluate(self, vmdFile, frames):
+        """ Evaluate world matrices of all bones with IK at the frames of a vmd.File.
+        """
+        locations, rotations = self.__skeleton.evaluateMotion(vmdFile, frames)
+        return self.__skeleton.worldMatrices(locations, self.solve(locations, rotations))
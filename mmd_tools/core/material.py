@@ -10,25 +10,77 @@ SPHERE_MODE_MULT   = 1
 SPHERE_MODE_ADD    = 2
 SPHERE_MODE_SUBTEX = 3
 
+class _MaterialIdIndex(object):
+    """ Map from material IDs to material names in bpy.data.materials.
+
+     The index is rebuilt lazily when the number of materials changes, a looked up
+     material was renamed or a material ID is not found, e.g. it was assigned directly.
+     New IDs are taken from a counter which never decreases in the session, so that
+     IDs of removed materials are not reused.
+    """
+    def __init__(self):
+        self.__names = {}
+        self.__num_materials = -1
+        self.__next_id = 0
+
+    def __validate(self):
+        if self.__num_materials != len(bpy.data.materials):
+            self.rebuild()
+
+    def rebuild(self):
+        self.__names = {}
+        for mat in bpy.data.materials:
+            mat_id = mat.mmd_material.material_id
+            if mat_id >= 0:
+                self.__names[mat_id] = mat.name
+                self.__next_id = max(self.__next_id, mat_id + 1)
+        self.__num_materials = len(bpy.data.materials)
+
+    def invalidate(self):
+        self.__num_materials = -1
+
+    def find(self, material_id):
+        self.__validate()
+        mat = bpy.data.materials.get(self.__names.get(material_id, ''))
+        if mat is None or mat.mmd_material.material_id != material_id:
+            self.rebuild()
+            mat = bpy.data.materials.get(self.__names.get(material_id, ''))
+        return mat
+
+    def new_id(self, material_name):
+        self.__validate()
+        mat_id = self.__next_id
+        self.__next_id += 1
+        self.__names[mat_id] = material_name
+        return mat_id
+
+_material_id_index = _MaterialIdIndex()
+
+
 class FnMaterial(object):
     def __init__(self, material=None):
         self.__material = material
 
     @classmethod
     def from_material_id(cls, material_id):
-        for material in bpy.data.materials:
-            if material.mmd_material.material_id == material_id:
-                return cls(material)
-        return None
+        material = _material_id_index.find(material_id)
+        if material is None:
+            return None
+        return cls(material)
+
+    @staticmethod
+    def invalidate_material_id_index():
+        """ Discard the cached material ID index.
+
+         Call this after renaming, adding or removing materials in bulk.
+        """
+        _material_id_index.invalidate()
 
     @property
     def material_id(self):
         mmd_mat = self.__material.mmd_material
         if mmd_mat.material_id < 0:
-            max_id = -1
-            for mat in bpy.data.materials:
-                max_id = max(max_id, mat.mmd_material.material_id)
-            mmd_mat.material_id = max_id + 1
+            mmd_mat.material_id = _material_id_index.new_id(self.__material.name)
         return mmd_mat.material_id
 
     @property
@@ -21,6 +21,11 @@ def isJointObject(obj):
 def isTemporaryObject(obj):
     return obj.mmd_type in ['TRACK_TARGET', 'NON_COLLISION_CONSTRAINT', 'SPRING_CONSTRAINT', 'SPRING_GOAL']
 
+## SDEF parameters (C, R0, R1) of each vertex are stored in the shape keys with these names.
+SDEF_SHAPE_KEY_NAMES = ('mmd_sdef_c', 'mmd_sdef_r0', 'mmd_sdef_r1')
+## SDEF vertices are the members of the vertex group with this name.
+SDEF_VERTEX_GROUP_NAME = 'mmd_sdef'
+
 
 def getRigidBodySize(obj):
     if not isRigidBodyObject(obj):
@@ -55,6 +60,104 @@ def getRigidBodySize(obj):
 class InvalidRigidSettingException(ValueError):
     pass
 
+class _ObjectIndex:
+    """ Objects of a MMD model bucketed by the child of the root object they belong to and mmd_type.
+
+     The index is rebuilt lazily when the number of objects in bpy.data or in the current
+     scene, or the number of children of the root or its child objects changes.
+     Cached objects are validated on read, and the index is rebuilt if an object was
+     removed, re-parented out of its section or its mmd_type was changed.
+    """
+    __indices = {}
+
+    def __init__(self, root):
+        self.root = root
+        self.signature = None
+        self.children = []  # children of the root
+        self.sections = {}  # {mmd_type or 'ARMATURE' => child object of the root}
+        self.buckets = {}   # {(section_pointer, mmd_type) => [obj, ...]}
+
+    @classmethod
+    def get(cls, root):
+        key = (root.as_pointer(), root.name)
+        index = cls.__indices.get(key)
+        if index is None:
+            cls.__prune()
+            index = cls(root)
+            cls.__indices[key] = index
+        index.root = root
+        if index.signature != index.__signature():
+            index.rebuild()
+        return index
+
+    @classmethod
+    def invalidate(cls, root):
+        cls.__indices.pop((root.as_pointer(), root.name), None)
+
+    @classmethod
+    def __prune(cls):
+        """ Drop the indices of removed or renamed root objects.
+        """
+        for key, index in list(cls.__indices.items()):
+            try:
+                valid = (index.root.as_pointer(), index.root.name) == key and index.root.mmd_type == 'ROOT'
+            except ReferenceError:
+                valid = False
+            if not valid:
+                del cls.__indices[key]
+
+    def __signature(self):
+        try:
+            return (len(bpy.data.objects), len(bpy.context.scene.objects), len(self.root.children),
+                    tuple(len(i.children) for i in self.children))
+        except ReferenceError:
+            return None
+
+    def rebuild(self):
+        self.children = list(self.root.children)
+        self.sections = {}
+        self.buckets = {}
+        for section in self.children:
+            section_key = 'ARMATURE' if section.type == 'ARMATURE' else section.mmd_type
+            self.sections.setdefault(section_key, section)
+            ptr = section.as_pointer()
+            stack = [section]
+            while len(stack) > 0:
+                obj = stack.pop()
+                self.buckets.setdefault((ptr, obj.mmd_type), []).append(obj)
+                stack.extend(reversed(obj.children))
+        self.signature = self.__signature()
+
+    @staticmethod
+    def __isValid(obj, section, mmd_type):
+        try:
+            if obj.mmd_type != mmd_type:
+                return False
+            while obj is not None and obj != section:
+                obj = obj.parent
+            return obj is not None
+        except ReferenceError:
+            return False
+
+    def __objects(self, section, mmd_types):
+        ptr = section.as_pointer()
+        r = []
+        for t in mmd_types:
+            for obj in self.buckets.get((ptr, t), []):
+                if not self.__isValid(obj, section, t):
+                    return None
+                r.append(obj)
+        return r
+
+    def objects(self, section, mmd_types):
+        if section is None:
+            return []
+        r = self.__objects(section, mmd_types)
+        if r is None:
+            self.rebuild()
+            r = self.__objects(section, mmd_types) or []
+        return r
+
 class Model:
     def __init__(self, root_obj):
         if root_obj.mmd_type != 'ROOT':
@@ -169,8 +272,7 @@ class Model:
         obj.draw_type = 'WIRE'
         obj.show_wire = True
 
-        with bpyutils.select_object(obj):
-            bpy.ops.object.transform_apply(location=False, rotation=False, scale=True)
+        bpyutils.applyScale(obj)
 
         if collision_group_number is not None:
             obj.data.materials.append(RigidBodyMaterial.getMaterial(collision_group_number))
@@ -207,6 +309,7 @@ class Model:
 
         obj.parent = self.rigidGroupObject()
         obj.select = False
+        _ObjectIndex.invalidate(self.__root)
         self.__root.mmd_root.is_built = False
         return obj
 
@@ -297,6 +400,7 @@ class Model:
 
         obj.parent = self.jointGroupObject()
         obj.select = False
+        _ObjectIndex.invalidate(self.__root)
         self.__root.mmd_root.is_built = False
         return obj
 
@@ -355,18 +459,22 @@ class Model:
     def rootObject(self):
         return self.__root
 
+    def invalidateObjectIndex(self):
+        """ Discard the cached object index of this model.
+
+         Most changes are detected by the index itself. Call this after moving objects
+         into this model below grandchildren of the root object.
+        """
+        _ObjectIndex.invalidate(self.__root)
+
     def armature(self):
         if self.__arm is None:
-            for i in filter(lambda x: x.type == 'ARMATURE', self.__root.children):
-                self.__arm = i
-                break
+            self.__arm = _ObjectIndex.get(self.__root).sections.get('ARMATURE')
         return self.__arm
 
     def rigidGroupObject(self):
         if self.__rigid_grp is None:
-            for i in filter(lambda x: x.mmd_type == 'RIGID_GRP_OBJ', self.__root.children):
-                self.__rigid_grp = i
-                break
+            self.__rigid_grp = _ObjectIndex.get(self.__root).sections.get('RIGID_GRP_OBJ')
             if self.__rigid_grp is None:
                 rigids = bpy.data.objects.new(name='rigidbodies', object_data=None)
                 rigids.mmd_type = 'RIGID_GRP_OBJ'
@@ -377,9 +485,7 @@ class Model:
         
     def jointGroupObject(self):
         if self.__joint_grp is None:
-            for i in filter(lambda x: x.mmd_type == 'JOINT_GRP_OBJ', self.__root.children):
-                self.__joint_grp = i
-                break
+            self.__joint_grp = _ObjectIndex.get(self.__root).sections.get('JOINT_GRP_OBJ')
             if self.__joint_grp is None:
                 joints = bpy.data.objects.new(name='joints', object_data=None)
                 joints.mmd_type = 'JOINT_GRP_OBJ'
@@ -390,9 +496,7 @@ class Model:
         
     def temporaryGroupObject(self):
         if self.__temporary_grp is None:
-            for i in filter(lambda x: x.mmd_type == 'TEMPORARY_GRP_OBJ', self.__root.children):
-                self.__temporary_grp = i
-                break
+            self.__temporary_grp = _ObjectIndex.get(self.__root).sections.get('TEMPORARY_GRP_OBJ')
             if self.__temporary_grp is None:
                 temporarys = bpy.data.objects.new(name='temporary', object_data=None)
                 temporarys.mmd_type = 'TEMPORARY_GRP_OBJ'
@@ -405,41 +509,96 @@ class Model:
         arm = self.armature()
         if arm is None:
             return []
-        return filter(lambda x: x.type == 'MESH' and x.mmd_type == 'NONE', self.allObjects(arm))
+        objects = _ObjectIndex.get(self.__root).objects(arm, ['NONE'])
+        return filter(lambda x: x.type == 'MESH', objects)
 
     def rigidBodies(self):
-        return filter(isRigidBodyObject, self.allObjects(self.rigidGroupObject()))
+        rigid_grp = self.rigidGroupObject()
+        return iter(_ObjectIndex.get(self.__root).objects(rigid_grp, ['RIGID_BODY']))
 
     def joints(self):
-        return filter(isJointObject, self.allObjects(self.jointGroupObject()))
+        joint_grp = self.jointGroupObject()
+        return iter(_ObjectIndex.get(self.__root).objects(joint_grp, ['JOINT']))
 
     def temporaryObjects(self):
-        return filter(isTemporaryObject, self.allObjects(self.rigidGroupObject())+self.allObjects(self.temporaryGroupObject()))
+        rigid_grp = self.rigidGroupObject()
+        temporary_grp = self.temporaryGroupObject()
+        index = _ObjectIndex.get(self.__root)
+        types = ['TRACK_TARGET', 'NON_COLLISION_CONSTRAINT', 'SPRING_CONSTRAINT', 'SPRING_GOAL']
+        return iter(index.objects(rigid_grp, types) + index.objects(temporary_grp, types))
 
     def renameBone(self, old_bone_name, new_bone_name):
+        return self.renameBones({old_bone_name:new_bone_name}).get(old_bone_name, old_bone_name)
+
+    def renameBones(self, mapping):
+        """ Rename many bones at once.
+
+         Display items and vertex groups which refer to the bones are renamed too.
+         If a new name is already used, a suffix '.001', '.002', ... is added.
+         Bones are processed in the order of armature.pose.bones, so the result
+         does not depend on the order of the mapping.
+
+         Args:
+             mapping: A dict of {old_bone_name => new_bone_name}
+
+         Returns:
+             A dict of {old_bone_name => actual_new_bone_name} of renamed bones.
+        """
         armature = self.armature()
-        bone = armature.pose.bones[old_bone_name]
+        pose_bones = armature.pose.bones
+        old_names = [b.name for b in pose_bones if b.name in mapping and mapping[b.name] != b.name]
+        if len(old_names) == 0:
+            return {}
+
+        renamed = set(old_names)
+        taken = set(b.name for b in pose_bones if b.name not in renamed)
+        new_names = {}
+        for old_name in old_names:
+            base = mapping[old_name]
+            name = base
+            count = 1
+            while name in taken:
+                name = '%s.%03d'%(base, count)
+                count += 1
+            taken.add(name)
+            new_names[old_name] = name
 
         mmd_root = self.rootObject().mmd_root
         for frame in mmd_root.display_item_frames:
             for item in frame.items:
-                if item.type == 'BONE' and item.name == old_bone_name:
-                    item.name = new_bone_name
-        for mesh in self.meshes():
-            if old_bone_name in mesh.vertex_groups:
-                mesh.vertex_groups[old_bone_name].name = new_bone_name
-
-        bone.name = new_bone_name
+                if item.type == 'BONE' and item.name in new_names:
+                    item.name = new_names[item.name]
+
+        # Rename via temporary names so that intermediate names never collide.
+        # Vertex groups are renamed before bones like renameBone did,
+        # so that Blender does not rename them again on bone renaming.
+        temp_names = dict((old_name, '__mmd_tools_rename_%d'%i) for i, old_name in enumerate(old_names))
+        meshes = list(self.meshes())
+        for names in (temp_names, dict((temp_names[k], v) for k, v in new_names.items())):
+            for mesh in meshes:
+                vertex_groups = mesh.vertex_groups
+                for vg in vertex_groups:
+                    if vg.name in names:
+                        vg.name = names[vg.name]
+            for name in list(names.keys()):
+                pose_bones[name].name = names[name]
+
+        FnBone.invalidate_bone_id_index(armature)
+        FnBone.invalidate_additional_transform_state(armature)
+        return new_names
 
     def build(self):
         logging.info('****************************************')
         logging.info(' Build rig')
         logging.info('****************************************')
+        start_time = time.time()
         self.buildRigids()
         self.buildJoints()
         self.__root.mmd_root.is_built = True
+        logging.info(' Finished building in %f seconds.', time.time() - start_time)
 
     def clean(self):
+        start_time = time.time()
         pose_bones = []
         arm = self.armature()
         track_to_bone_map = {}
@@ -451,23 +610,25 @@ class Model:
                 track_to_bone_map[const.target] = i
                 i.constraints.remove(const)
 
+        removed_objects = []
         for i in self.temporaryObjects():
-            if i.mmd_type in ['NON_COLLISION_CONSTRAINT', 'SPRING_GOAL', 'SPRING_CONSTRAINT']:
-                bpy.context.scene.objects.unlink(i)
-                bpy.data.objects.remove(i)
-            elif i.mmd_type == 'TRACK_TARGET':
+            if i.mmd_type == 'TRACK_TARGET':
                 rigid = i.parent
                 bone = track_to_bone_map.get(i)
-                logging.info('Create a "CHILD_OF" constraint for %s', rigid.name)
+                logging.debug('Create a "CHILD_OF" constraint for %s', rigid.name)
                 constraint = rigid.constraints.new('CHILD_OF')
                 constraint.target = arm
                 if bone is not None:
                     constraint.subtarget = bone.name
                 constraint.name = 'mmd_tools_rigid_parent'
                 constraint.mute = True
-                bpy.context.scene.objects.unlink(i)
-                bpy.data.objects.remove(i)
+            removed_objects.append(i)
+        logging.debug(' Restored rigid parents in %f seconds.', time.time() - start_time)
+
+        bpyutils.removeObjects(removed_objects)
+        _ObjectIndex.invalidate(self.__root)
         self.rootObject().mmd_root.is_built = False
+        logging.info(' Removed %d temporary objects in %f seconds.', len(removed_objects), time.time() - start_time)
 
     def updateRigid(self, rigid_obj):
         if rigid_obj.mmd_type != 'RIGID_BODY':
@@ -511,6 +672,7 @@ class Model:
             empty.mmd_type = 'TRACK_TARGET'
             empty.hide = True
             empty.parent = self.temporaryGroupObject()
+            _ObjectIndex.invalidate(self.__root)
 
             rigid_obj.mmd_rigid.bone = relation.subtarget
             rigid_obj.constraints.remove(relation)
@@ -526,12 +688,10 @@ class Model:
             const.name='mmd_tools_rigid_track'
             const.target = empty
 
-        t=rigid_obj.hide
-        with bpyutils.select_object(rigid_obj):
-            bpy.ops.object.transform_apply(location=False, rotation=False, scale=True)
-        rigid_obj.hide = t
+        bpyutils.applyScale(rigid_obj)
 
         rigid_obj.rigid_body.collision_shape = rigid.shape
+        rigid['is_dirty'] = False
 
     def __getRigidRange(self, obj):
         return (mathutils.Vector(obj.bound_box[0]) - mathutils.Vector(obj.bound_box[6])).length
@@ -553,6 +713,7 @@ class Model:
         ncc_obj.mmd_type = 'NON_COLLISION_CONSTRAINT'
         ncc_obj.hide_render = True
         ncc_obj.parent = self.temporaryGroupObject()
+        _ObjectIndex.invalidate(self.__root)
         with bpyutils.select_object(ncc_obj):
             bpy.ops.rigidbody.constraint_add(type='GENERIC')
         rb = ncc_obj.rigid_body_constraint
@@ -585,16 +746,15 @@ class Model:
         logging.debug('--------------------------------')
         logging.debug(' Build riggings of rigid bodies')
         logging.debug('--------------------------------')
+        start_time = time.time()
         rigid_objects = list(self.rigidBodies())
         for i in rigid_objects:
             logging.debug(' Updating rigid body %s', i.name)
             self.updateRigid(i)
-        rigid_object_groups = [[] for i in range(16)]
-        for i in rigid_objects:
-            rigid_object_groups[i.mmd_rigid.collision_group_number].append(i)
-
+        logging.info(' Updated %d rigid bodies in %f seconds.', len(rigid_objects), time.time() - start_time)
         jointMap = {}
         for joint in self.joints():
+            joint.mmd_joint['is_dirty'] = False
             rbc = joint.rigid_body_constraint
             rbc.disable_collisions = False
             jointMap[frozenset((rbc.object1, rbc.object2))] = joint
@@ -602,6 +762,23 @@ class Model:
 
         logging.info('Creating non collision constraints')
         # create non collision constraints
+        nonCollisionJointTable = self.__findNonCollisionPairs(rigid_objects, jointMap, distance_of_ignore_collisions)
+        logging.info(' Found %d non collision pairs in %f seconds.', len(nonCollisionJointTable), time.time() - start_time)
+
+        self.__createNonCollisionConstraint(nonCollisionJointTable)
+        logging.info(' Built rigid bodies in %f seconds.', time.time() - start_time)
+        return rigid_objects
+
+    def __findNonCollisionPairs(self, rigid_objects, jointMap, distance_of_ignore_collisions, targets=None):
+        """ Find pairs of rigid bodies which need non collision constraints.
+
+         Joints between colliding pairs get disable_collisions. If targets is given,
+         only pairs including at least one of targets are processed.
+        """
+        rigid_object_groups = [[] for i in range(16)]
+        for i in rigid_objects:
+            rigid_object_groups[i.mmd_rigid.collision_group_number].append(i)
+
         nonCollisionJointTable = []
         non_collision_pairs = set()
         rigid_object_cnt = len(rigid_objects)
@@ -611,6 +788,8 @@ class Model:
                 if not ignore:
                     continue
                 for obj_b in rigid_object_groups[n]:
+                    if targets is not None and obj_a not in targets and obj_b not in targets:
+                        continue
                     pair = frozenset((obj_a, obj_b))
                     if pair in non_collision_pairs:
                         continue
@@ -622,10 +801,107 @@ class Model:
                         if distance < distance_of_ignore_collisions * (self.__getRigidRange(obj_a) + self.__getRigidRange(obj_b)) * 0.5:
                             nonCollisionJointTable.append((obj_a, obj_b))
                     non_collision_pairs.add(pair)
-                    non_collision_pairs.add(frozenset((obj_b, obj_a)))
-        
+        return nonCollisionJointTable
+
+    def buildChanged(self, distance_of_ignore_collisions=1.5):
+        """ Rebuild only the rigid bodies and joints which were changed since the last build.
+
+         A rigid body is changed if its mmd_rigid.is_dirty is set or its scale is not applied.
+         A joint is changed if its mmd_joint.is_dirty is set, and it makes both of its
+         rigid bodies changed. The track targets, springs and non collision constraints
+         of the changed rigid bodies are rebuilt, and the others are kept as they are.
+
+         Moving a rigid body does not mark it as changed, so clean and build the rig
+         again after moving rigid bodies to update non collision constraints.
+        """
+        if not self.__root.mmd_root.is_built:
+            self.build()
+            return
+
+        start_time = time.time()
+        rigid_objects = list(self.rigidBodies())
+        joints = list(self.joints())
+        targets = set(i for i in rigid_objects if i.mmd_rigid.is_dirty or tuple(i.scale) != (1.0, 1.0, 1.0))
+        for joint in joints:
+            if joint.mmd_joint.is_dirty:
+                rbc = joint.rigid_body_constraint
+                targets.update(i for i in (rbc.object1, rbc.object2) if i is not None)
+                joint.mmd_joint['is_dirty'] = False
+        if len(targets) == 0:
+            logging.info(' No changed rigid bodies.')
+            return
+        logging.info(' Rebuilding %d of %d rigid bodies', len(targets), len(rigid_objects))
+
+        arm = self.armature()
+        # the bone of a rigid body may have been changed, so find track constraints by their targets
+        track_constraints = {}
+        if arm is not None:
+            for b in arm.pose.bones:
+                const = b.constraints.get('mmd_tools_rigid_track')
+                if const is not None:
+                    track_constraints[const.target] = (b, const)
+
+        removed_objects = []
+        springs = []
+        temporary_objects = list(self.temporaryObjects())
+        for i in temporary_objects:
+            if i.mmd_type == 'TRACK_TARGET':
+                rigid = i.parent
+                if rigid not in targets:
+                    continue
+                if i in track_constraints:
+                    b, const = track_constraints[i]
+                    b.constraints.remove(const)
+                bone = None
+                if arm is not None:
+                    bone = arm.pose.bones.get(rigid.mmd_rigid.bone)
+                constraint = rigid.constraints.new('CHILD_OF')
+                constraint.target = arm
+                if bone is not None:
+                    constraint.subtarget = bone.name
+                constraint.name = 'mmd_tools_rigid_parent'
+                constraint.mute = True
+                removed_objects.append(i)
+            elif i.mmd_type == 'NON_COLLISION_CONSTRAINT':
+                rbc = i.rigid_body_constraint
+                if rbc is None or rbc.object1 in targets or rbc.object2 in targets:
+                    removed_objects.append(i)
+            elif i.mmd_type == 'SPRING_CONSTRAINT':
+                rbc = i.rigid_body_constraint
+                goal = rbc.object2 if rbc is not None else None
+                base_obj = goal.parent if goal is not None else None
+                if rbc is None or rbc.object1 in targets or base_obj in targets:
+                    removed_objects.append(i)
+                    if goal is not None:
+                        removed_objects.append(goal)
+                        springs.append((rbc.object1, base_obj))
+        for i in temporary_objects:
+            if i.mmd_type == 'SPRING_GOAL' and i.parent in targets and i not in removed_objects:
+                removed_objects.append(i)
+        bpyutils.removeObjects(removed_objects)
+        _ObjectIndex.invalidate(self.__root)
+        logging.debug(' Removed %d temporary objects in %f seconds.', len(removed_objects), time.time() - start_time)
+
+        for i in rigid_objects:
+            if i in targets:
+                self.updateRigid(i)
+
+        jointMap = {}
+        for joint in joints:
+            rbc = joint.rigid_body_constraint
+            pair = frozenset((rbc.object1, rbc.object2))
+            if rbc.object1 in targets or rbc.object2 in targets:
+                rbc.disable_collisions = False
+            jointMap[pair] = joint
+        nonCollisionJointTable = self.__findNonCollisionPairs(rigid_objects, jointMap, distance_of_ignore_collisions, targets)
         self.__createNonCollisionConstraint(nonCollisionJointTable)
-        return rigid_objects
+
+        for target, base_obj in springs:
+            joint = jointMap.get(frozenset((target, base_obj)))
+            if joint is not None and base_obj.rigid_body.kinematic:
+                self.__makeSpring(target, base_obj, joint.mmd_joint.spring_angular)
+
+        logging.info(' Rebuilt rigid bodies in %f seconds.', time.time() - start_time)
 
     def __makeSpring(self, target, base_obj, spring_stiffness):
         with bpyutils.select_object(target):
@@ -638,6 +914,7 @@ class Model:
         spring_target.rigid_body.kinematic = True
         spring_target.rigid_body.collision_groups = (False, False, False, False, False, False, False, False, False, False, False, False, False, False, False, False, False, False, False, True)
         spring_target.parent = base_obj
+        _ObjectIndex.invalidate(self.__root)
         spring_target.matrix_parent_inverse = mathutils.Matrix(base_obj.matrix_basis).inverted()
         spring_target.hide = True
 
@@ -653,6 +930,7 @@ class Model:
         obj.hide = True
         obj.mmd_type = 'SPRING_CONSTRAINT'
         obj.parent = self.temporaryGroupObject()
+        _ObjectIndex.invalidate(self.__root)
 
         with bpyutils.select_object(obj):
             bpy.ops.rigidbody.constraint_add(type='GENERIC_SPRING')
@@ -680,11 +958,7 @@ class Model:
         pass
 
     def applyAdditionalTransformConstraints(self, force=False):
-        arm = self.armature()
-        fnBone = FnBone()
-        for bone in arm.pose.bones[:]:
-            fnBone.pose_bone = bone
-            fnBone.apply_additional_transformation()
+        FnBone.update_additional_transformations(self.armature(), force)
 
 
 class RigidBodyMaterial:
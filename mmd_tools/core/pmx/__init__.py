@@ -2,6 +2,9 @@
 import struct
 import os
 import logging
+import tempfile
+import threading
+import queue
 
 class InvalidFileError(Exception):
     pass
@@ -241,15 +244,15 @@ class Header:
             self.updateIndexSizes(model)
 
     def updateIndexSizes(self, model):
-        self.vertex_index_size = self.__getIndexSize(len(model.vertices), False)
-        self.texture_index_size = self.__getIndexSize(len(model.textures), True)
-        self.material_index_size = self.__getIndexSize(len(model.materials), True)
-        self.bone_index_size = self.__getIndexSize(len(model.bones), True)
-        self.morph_index_size = self.__getIndexSize(len(model.morphs), True)
-        self.rigid_index_size = self.__getIndexSize(len(model.rigids), True)
+        self.vertex_index_size = self.getIndexSize(len(model.vertices), False)
+        self.texture_index_size = self.getIndexSize(len(model.textures), True)
+        self.material_index_size = self.getIndexSize(len(model.materials), True)
+        self.bone_index_size = self.getIndexSize(len(model.bones), True)
+        self.morph_index_size = self.getIndexSize(len(model.morphs), True)
+        self.rigid_index_size = self.getIndexSize(len(model.rigids), True)
 
     @staticmethod
-    def __getIndexSize(num, signed):
+    def getIndexSize(num, signed):
         s = 1
         if signed:
             s = 2
@@ -571,6 +574,21 @@ class Model:
         logging.info('----- Loaded %d joints.', len(self.joints))
 
     def save(self, fs):
+        self.saveInformation(fs)
+        self.saveVertices(fs)
+        self.saveFaces(fs)
+        self.saveTextures(fs)
+        self.saveMaterials(fs)
+        self.saveBones(fs)
+        self.saveMorphs(fs)
+        self.saveDisplayItems(fs)
+        self.saveRigids(fs)
+        self.saveJoints(fs)
+        logging.info('finished exporting the model.')
+
+    # Each of the following methods writes a section of the model data.
+    # The sections must be written in this order.
+    def saveInformation(self, fs):
         fs.writeStr(self.name)
         fs.writeStr(self.name_e)
 
@@ -586,6 +604,7 @@ comment(english):
 %s
 ''', self.name, self.name_e, self.comment, self.comment_e)
 
+    def saveVertices(self, fs):
         logging.info('exporting vertices...')
         fs.writeInt(len(self.vertices))
         for i in self.vertices:
@@ -593,6 +612,7 @@ comment(english):
         logging.info('the number of vetices: %d', len(self.vertices))
         logging.info('finished exporting vertices.')
 
+    def saveFaces(self, fs):
         logging.info('exporting faces...')
         fs.writeInt(len(self.faces)*3)
         for f3, f2, f1 in self.faces:
@@ -602,6 +622,7 @@ comment(english):
         logging.info('the number of faces: %d', len(self.faces))
         logging.info('finished exporting faces.')
 
+    def saveTextures(self, fs):
         logging.info('exporting textures...')
         fs.writeInt(len(self.textures))
         for i in self.textures:
@@ -609,6 +630,7 @@ comment(english):
         logging.info('the number of textures: %d', len(self.textures))
         logging.info('finished exporting textures.')
 
+    def saveMaterials(self, fs):
         logging.info('exporting materials...')
         fs.writeInt(len(self.materials))
         for i in self.materials:
@@ -616,6 +638,7 @@ comment(english):
         logging.info('the number of materials: %d', len(self.materials))
         logging.info('finished exporting materials.')
 
+    def saveBones(self, fs):
         logging.info('exporting bones...')
         fs.writeInt(len(self.bones))
         for i in self.bones:
@@ -623,6 +646,7 @@ comment(english):
         logging.info('the number of bones: %d', len(self.bones))
         logging.info('finished exporting bones.')
 
+    def saveMorphs(self, fs):
         logging.info('exporting morphs...')
         fs.writeInt(len(self.morphs))
         for i in self.morphs:
@@ -630,6 +654,7 @@ comment(english):
         logging.info('the number of morphs: %d', len(self.morphs))
         logging.info('finished exporting morphs.')
 
+    def saveDisplayItems(self, fs):
         logging.info('exporting display items...')
         fs.writeInt(len(self.display))
         for i in self.display:
@@ -637,6 +662,7 @@ comment(english):
         logging.info('the number of display items: %d', len(self.display))
         logging.info('finished exporting display items.')
 
+    def saveRigids(self, fs):
         logging.info('exporting rigid bodies...')
         fs.writeInt(len(self.rigids))
         for i in self.rigids:
@@ -645,13 +671,13 @@ comment(english):
         logging.info('the number of rigid bodies: %d', len(self.rigids))
         logging.info('finished exporting rigid bodies.')
 
+    def saveJoints(self, fs):
         logging.info('exporting joints...')
         fs.writeInt(len(self.joints))
         for i in self.joints:
             i.save(fs)
         logging.info('the number of joints: %d', len(self.joints))
         logging.info('finished exporting joints.')
-        logging.info('finished exporting the model.')
 
 
     def __repr__(self):
@@ -1590,9 +1616,86 @@ def load(path):
         logging.info('****************************************')
         return model
 
+class ModelWriter:
+    """ Write sections of a pmx model in a background thread.
+
+     Sections are callables which take a FileWriteStream object (e.g. Model.saveVertices)
+     and must be queued in the order of the file format. The data is written to a temporary file
+     in the same directory, and the file is renamed to the destination path when all sections are written.
+
+     It is recommended to use ModelWriter with 'with' statement like the following code.
+
+        with ModelWriter(path, header) as writer:
+            writer.write(model.saveInformation)
+            ...
+    """
+    def __init__(self, path, header, max_queued_sections=4):
+        self.__path = path
+        fd, self.__temp_path = tempfile.mkstemp(
+            prefix=os.path.basename(path) + '.',
+            suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        self.__fs = FileWriteStream(self.__temp_path, header)
+        self.__queue = queue.Queue(maxsize=max_queued_sections)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, name='pmx writer')
+        self.__thread.daemon = True
+        self.__thread.start()
+        self.write(header.save)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    def __run(self):
+        while True:
+            section = self.__queue.get()
+            if section is None:
+                break
+            if self.__error is not None:
+                continue
+            try:
+                section(self.__fs)
+            except Exception as e:
+                logging.exception('Failed to write a section of %s', self.__path)
+                self.__error = e
+
+    def __stop(self):
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+            self.__fs.close()
+
+    def write(self, section):
+        """ Queue a section to write. This method blocks while the queue is full.
+        """
+        if self.__error is not None:
+            raise self.__error
+        self.__queue.put(section)
+
+    def finish(self):
+        """ Wait for all queued sections and rename the temporary file to the destination path.
+        """
+        self.__stop()
+        if self.__error is not None:
+            os.remove(self.__temp_path)
+            raise self.__error
+        os.replace(self.__temp_path, self.__path)
+
+    def abort(self):
+        """ Stop writing and remove the temporary file.
+        """
+        self.__stop()
+        if os.path.isfile(self.__temp_path):
+            os.remove(self.__temp_path)
+
 def save(path, model):
-    with FileWriteStream(path) as fs:
-        header = Header(model)
-        header.save(fs)
-        fs.setHeader(header)
-        model.save(fs)
+    with ModelWriter(path, Header(model)) as writer:
+        writer.write(model.save)
@@ -3,7 +3,12 @@ import os
 import copy
 import logging
 import shutil
+import hashlib
+import zlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import mathutils
 import bpy
 import bmesh
@@ -14,6 +19,41 @@ from mmd_tools import bpyutils
 import mmd_tools.core.model as mmd_model
 
 
+def _file_digest(path, block_size=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block_size), b''):
+            h.update(chunk)
+    return h.digest()
+
+def _is_same_file(src, dest):
+    """ Return True if dest has the same contents as src.
+
+     Files which have the same size and modification time are regarded as the same file
+     without reading them.
+    """
+    if not os.path.isfile(dest):
+        return False
+    src_stat = os.stat(src)
+    dest_stat = os.stat(dest)
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    if int(src_stat.st_mtime) == int(dest_stat.st_mtime):
+        return True
+    return _file_digest(src) == _file_digest(dest)
+
+def _copy_texture(src, dest):
+    """ Copy a texture file unless dest is already up to date.
+
+     Returns:
+         True if the file was copied.
+    """
+    if _is_same_file(src, dest):
+        return False
+    shutil.copy2(src, dest)
+    return True
+
+
 class _Vertex:
     def __init__(self, co, groups, normal, offsets):
         self.co = copy.deepcopy(co)
@@ -22,6 +62,7 @@ class _Vertex:
         self.offsets = copy.deepcopy(offsets)
         self.index = None
         self.uv = None
+        self.sdef = None # (c, r0, r1) or None
 
 class _Face:
     def __init__(self, vertices, normal):
@@ -31,16 +72,71 @@ class _Face:
         self.normal = copy.deepcopy(normal)
 
 class _Mesh:
-    def __init__(self, mesh_data, material_faces, shape_key_names, vertex_group_names, materials):
-        self.mesh_data = mesh_data
+    def __init__(self, material_faces, shape_key_names, vertex_group_names, materials):
         self.material_faces = material_faces # dict of {material_index => [face1, face2, ....]}
         self.shape_key_names = shape_key_names
         self.vertex_group_names = vertex_group_names
         self.materials = materials
 
-    def __del__(self):
-        logging.debug('remove mesh data: %s', str(self.mesh_data))
-        bpy.data.meshes.remove(self.mesh_data)
+class _MeshArrays:
+    """ Triangulated and split mesh data in the PMX coordinate system.
+
+     Vertices are split by UV coordinates. Each split vertex refers to a source vertex
+     which has the coordinate, normal, weights, morph offsets and SDEF data.
+    """
+    def __init__(self):
+        self.co = None          # (num_vertices, 3)
+        self.normals = None     # (num_vertices, 3)
+        self.groups = []        # [[(group_number, weight), ...], ...] not kept in the cache
+        self.offsets = None     # (num_vertices, num_shape_keys, 3)
+        self.sdef = None        # (3, num_vertices, 3) C, R0 and R1 of all vertices
+        self.split_sources = None   # (num_split_vertices,)
+        self.split_uvs = None       # (num_split_vertices, 2)
+        self.faces = None           # (num_faces, 3) indices of split vertices
+        self.face_normals = None    # (num_faces, 3)
+        self.face_materials = None  # (num_faces,)
+        self.shape_key_names = []
+        self.vertex_group_names = []
+        self.material_names = []
+
+class _MeshCache:
+    """ Cache of extracted mesh data to re-export unchanged meshes quickly.
+
+     Entries are kept in memory for the session, and the least recently used
+     entries are discarded when the total size exceeds max_bytes.
+    """
+    def __init__(self, max_bytes=256<<20):
+        self.__entries = collections.OrderedDict()
+        self.__max_bytes = max_bytes
+        self.__total_bytes = 0
+
+    @staticmethod
+    def __size(entry):
+        arrays = [getattr(entry, name) for name in ('co', 'normals', 'offsets', 'sdef', 'split_sources', 'split_uvs',
+                                                    'faces', 'face_normals', 'face_materials')]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def get(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.__total_bytes -= self.__size(old)
+        self.__entries[key] = entry
+        self.__total_bytes += self.__size(entry)
+        while self.__total_bytes > self.__max_bytes and len(self.__entries) > 0:
+            k, old = self.__entries.popitem(last=False)
+            self.__total_bytes -= self.__size(old)
+
+    def clear(self):
+        self.__entries.clear()
+        self.__total_bytes = 0
+
+_mesh_cache = _MeshCache()
 
 
 class __PmxExporter:
@@ -62,69 +158,126 @@ class __PmxExporter:
 
     def __exportMeshes(self, meshes, bone_map):
         mat_map = {}
-        for mesh in meshes:
+        for mesh_index, mesh in enumerate(meshes):
             for index, mat_faces in mesh.material_faces.items():
                 name = mesh.materials[index].name
                 if name not in mat_map:
                     mat_map[name] = []
-                mat_map[name].append((mat_faces, mesh.vertex_group_names))
+                mat_map[name].append((mat_faces, mesh_index))
+
+        # vertex groups which are not related to any bones are mapped to -1.
+        bone_tables = []
+        for mesh in meshes:
+            bone_tables.append([bone_map.get(name, -1) for name in mesh.vertex_group_names])
 
         # export vertices
+        exported_vertices = []
+        vertex_mesh_indices = []
         for mat_name, mat_meshes in mat_map.items():
             face_count = 0
-            for mat_faces, vertex_group_names in mat_meshes:
-                mesh_vertices = []
+            for mat_faces, mesh_index in mat_meshes:
                 for face in mat_faces:
-                    mesh_vertices.extend(face.vertices)
-
-                for v in mesh_vertices:
-                    if v.index is not None:
-                        continue
-
-                    v.index = len(self.__model.vertices)
-                    pv = pmx.Vertex()
-                    pv.co = list(v.co)
-                    pv.normal = v.normal * -1
-                    pv.uv = self.flipUV_V(v.uv)
-
-                    t = len(v.groups)
-                    if t == 0:
-                        weight = pmx.BoneWeight()
-                        weight.type = pmx.BoneWeight.BDEF1
-                        weight.bones = [-1]
-                        pv.weight = weight
-                    elif t == 1:
-                        weight = pmx.BoneWeight()
-                        weight.type = pmx.BoneWeight.BDEF1
-                        weight.bones = [bone_map[vertex_group_names[v.groups[0][0]]]]
-                        pv.weight = weight
-                    elif t == 2:
-                        vg1, vg2 = v.groups
-                        weight = pmx.BoneWeight()
-                        weight.type = pmx.BoneWeight.BDEF2
-                        weight.bones = [
-                            bone_map[vertex_group_names[vg1[0]]],
-                            bone_map[vertex_group_names[vg2[0]]]
-                            ]
-                        weight.weights = [vg1[1]]
-                        pv.weight = weight
-                    else:
-                        weight = pmx.BoneWeight()
-                        weight.type = pmx.BoneWeight.BDEF4
-                        weight.bones = [-1, -1, -1, -1]
-                        weight.weights = [0.0, 0.0, 0.0, 0.0]
-                        for i in range(min(len(v.groups), 4)):
-                            gn, w = v.groups[i]
-                            weight.bones[i] = bone_map[vertex_group_names[gn]]
-                            weight.weights[i] = w
-                        pv.weight = weight
-                    self.__model.vertices.append(pv)
+                    for v in face.vertices:
+                        if v.index is not None:
+                            continue
+
+                        v.index = len(self.__model.vertices)
+                        pv = pmx.Vertex()
+                        pv.co = list(v.co)
+                        pv.normal = v.normal * -1
+                        pv.uv = self.flipUV_V(v.uv)
+                        self.__model.vertices.append(pv)
+                        exported_vertices.append(v)
+                        vertex_mesh_indices.append(mesh_index)
 
                 for face in mat_faces:
                     self.__model.faces.append([x.index for x in face.vertices])
                 face_count += len(mat_faces)
             self.__exportMaterial(bpy.data.materials[mat_name], face_count)
 
+        weights = self.__packVertexWeights(exported_vertices, vertex_mesh_indices, bone_tables)
+        for v, weight in zip(exported_vertices, weights):
+            self.__model.vertices[v.index].weight = weight
+
+    @staticmethod
+    def __packVertexWeights(vertices, vertex_mesh_indices, bone_tables):
+        """ Create pmx.BoneWeight objects from vertex group weights.
+
+         The 4 most influential bones of each vertex are kept and their weights are normalized.
+         Then the weight type is chosen by the number of bones. (BDEF1, BDEF2 or BDEF4)
+         Vertices which have 2 bones and SDEF data are exported as SDEF.
+
+         Args:
+             vertices: A list of _Vertex objects.
+             vertex_mesh_indices: A list of the mesh indices of vertices.
+             bone_tables: A list of lists to map vertex group indices of each mesh to pmx bone indices.
+
+         Returns:
+             A list of pmx.BoneWeight objects.
+        """
+        num_vertices = len(vertices)
+        counts = np.array([len(v.groups) for v in vertices], dtype=np.int64)
+        max_groups = max(4, int(counts.max()) if num_vertices > 0 else 0)
+        bones = np.full((num_vertices, max_groups), -1, dtype=np.int64)
+        weights = np.zeros((num_vertices, max_groups))
+
+        num_groups = int(counts.sum())
+        if num_groups > 0:
+            groups = np.array([x for v in vertices for x in v.groups], dtype=np.float64).reshape(-1, 2)
+            rows = np.repeat(np.arange(num_vertices), counts)
+            cols = np.arange(num_groups) - np.repeat(np.cumsum(counts) - counts, counts)
+
+            table_sizes = [len(t) for t in bone_tables]
+            table_offsets = np.cumsum([0] + table_sizes)[:-1]
+            all_tables = np.array(sum(bone_tables, []), dtype=np.int64)
+            mesh_indices = np.repeat(np.array(vertex_mesh_indices, dtype=np.int64), counts)
+            group_bones = all_tables[table_offsets[mesh_indices] + groups[:, 0].astype(np.int64)]
+
+            valid = group_bones >= 0
+            bones[rows[valid], cols[valid]] = group_bones[valid]
+            weights[rows[valid], cols[valid]] = groups[valid, 1]
+
+        # pick the 4 most influential bones and sort them by weight
+        rows = np.arange(num_vertices)[:, np.newaxis]
+        if max_groups > 4:
+            top = np.argpartition(-weights, 3, axis=1)[:, :4]
+            bones = bones[rows, top]
+            weights = weights[rows, top]
+        order = np.argsort(-weights, axis=1, kind='mergesort')
+        bones = bones[rows, order]
+        weights = weights[rows, order]
+        bones[weights <= 0] = -1
+
+        totals = weights.sum(axis=1)
+        nonzero = totals > 0
+        weights[nonzero] /= totals[nonzero, np.newaxis]
+
+        num_bones = (bones >= 0).sum(axis=1)
+        has_sdef = np.array([v.sdef is not None for v in vertices], dtype=bool)
+        types = np.where(num_bones <= 1, pmx.BoneWeight.BDEF1,
+                         np.where(num_bones == 2,
+                                  np.where(has_sdef, pmx.BoneWeight.SDEF, pmx.BoneWeight.BDEF2),
+                                  pmx.BoneWeight.BDEF4))
+
+        r = []
+        for v, weight_type, b, w in zip(vertices, types.tolist(), bones.tolist(), weights.tolist()):
+            weight = pmx.BoneWeight()
+            weight.type = weight_type
+            if weight_type == pmx.BoneWeight.BDEF1:
+                weight.bones = b[:1]
+            elif weight_type == pmx.BoneWeight.BDEF2:
+                weight.bones = b[:2]
+                weight.weights = w[:1]
+            elif weight_type == pmx.BoneWeight.SDEF:
+                weight.bones = b[:2]
+                c, r0, r1 = v.sdef
+                weight.weights = pmx.BoneWeightSDEF(w[0], c, r0, r1)
+            else:
+                weight.bones = b
+                weight.weights = w
+            r.append(weight)
+        return r
+
     def __exportTexture(self, filepath):
         if filepath.strip() == '':
             return -1
@@ -139,17 +292,78 @@ class __PmxExporter:
             logging.warning('  The texture file does not exist: %s', t.path)
         return len(self.__model.textures) - 1
 
+    @staticmethod
+    def __textureFileNames(paths, tex_dir):
+        """ Create unique file names to copy textures into a directory.
+
+         Textures which have the same file name (case-insensitive) are renamed
+         by adding a hash of their source paths, so the names are stable between exports.
+         The original file name is kept by the texture which was copied to tex_dir
+         with it before, so adding a texture does not rename exported ones.
+
+         Returns:
+             A dictionary to map texture paths to file names.
+        """
+        groups = {}
+        for path in sorted(set(paths)):
+            groups.setdefault(os.path.basename(path).lower(), []).append(path)
+
+        r = {}
+        renamed = []
+        for key in sorted(groups.keys()):
+            group = groups[key]
+            owner = group[0]
+            if len(group) > 1:
+                for path in group:
+                    if os.path.isfile(path) and _is_same_file(path, os.path.join(tex_dir, os.path.basename(path))):
+                        owner = path
+                        break
+            r[owner] = os.path.basename(owner)
+            renamed.extend(path for path in group if path != owner)
+
+        used = set(name.lower() for name in r.values())
+        for path in renamed:
+            name, ext = os.path.splitext(os.path.basename(path))
+            base = '%s_%08x'%(name, zlib.crc32(path.encode('utf-8')) & 0xffffffff)
+            file_name = base + ext
+            i = 1
+            while file_name.lower() in used:
+                file_name = '%s_%d%s'%(base, i, ext)
+                i += 1
+            used.add(file_name.lower())
+            r[path] = file_name
+        return r
+
     def __copy_textures(self, tex_dir):
         if not os.path.isdir(tex_dir):
             os.mkdir(tex_dir)
             logging.info('Create a texture directory: %s', tex_dir)
 
-        for texture in self.__model.textures:
-            path = texture.path
-            dest_path = os.path.join(tex_dir, os.path.basename(path))
-            shutil.copyfile(path, dest_path)
-            logging.info('Copy file %s --> %s', path, dest_path)
-            texture.path = dest_path
+        textures = self.__model.textures
+        if len(textures) == 0:
+            return
+        file_names = self.__textureFileNames([t.path for t in textures], tex_dir)
+
+        copied = 0
+        with ThreadPoolExecutor(max_workers=min(8, len(textures))) as executor:
+            jobs = []
+            for texture in textures:
+                path = texture.path
+                dest_path = os.path.join(tex_dir, file_names[path])
+                if os.path.isfile(path):
+                    jobs.append((texture, dest_path, executor.submit(_copy_texture, path, dest_path)))
+                else:
+                    logging.warning('  The texture file does not exist: %s', path)
+                    texture.path = dest_path
+
+            for texture, dest_path, job in jobs:
+                if job.result():
+                    logging.info('Copy file %s --> %s', texture.path, dest_path)
+                    copied += 1
+                else:
+                    logging.debug('Skip copying an unchanged file %s', texture.path)
+                texture.path = dest_path
+        logging.info('Copied %d of %d textures.', copied, len(textures))
 
     def __exportMaterial(self, material, num_faces):
         p_mat = pmx.Material()
@@ -456,31 +670,30 @@ class __PmxExporter:
          モデル中心座標から離れている位置で使用されているマテリアルほどリストの後ろ側にくるように。
          かなりいいかげんな実装
         """
-        center = mathutils.Vector([0, 0, 0])
-        vertices = self.__model.vertices
-        vert_num = len(vertices)
-        for v in self.__model.vertices:
-            center += mathutils.Vector(v.co) / vert_num
-
+        materials = self.__model.materials
         faces = self.__model.faces
-        offset = 0
-        distances = []
-        for mat in self.__model.materials:
-            d = 0
-            face_num = int(mat.vertex_count / 3)
-            for i in range(offset, offset + face_num):
-                face = faces[i]
-                d += (mathutils.Vector(vertices[face[0]].co) - center).length
-                d += (mathutils.Vector(vertices[face[1]].co) - center).length
-                d += (mathutils.Vector(vertices[face[2]].co) - center).length
-            distances.append((d/mat.vertex_count, mat, offset, face_num))
-            offset += face_num
+        face_counts = np.array([int(mat.vertex_count / 3) for mat in materials], dtype=np.int64)
+
+        vertices = np.array([v.co for v in self.__model.vertices], dtype=np.float64).reshape(-1, 3)
+        face_indices = np.array(faces, dtype=np.int64).reshape(-1, 3)
+
+        sums = np.zeros(len(materials))
+        if len(face_indices) > 0:
+            center = vertices.mean(axis=0)
+            # the sum of distances between the center and the 3 vertices of each face
+            face_distances = np.sqrt(((vertices[face_indices] - center)**2).sum(axis=2)).sum(axis=1)
+            offsets = np.concatenate(([0], np.cumsum(face_counts)[:-1]))
+            used = face_counts > 0
+            sums[used] = np.add.reduceat(face_distances, offsets[used])
+        distances = sums / np.maximum(face_counts * 3, 1)
+
+        offsets = np.concatenate(([0], np.cumsum(face_counts)))
         sorted_faces = []
         sorted_mat = []
-        for mat, offset, vert_count in [(x[1], x[2], x[3]) for x in sorted(distances, key=lambda x: x[0])]:
-            sorted_faces.extend(faces[offset:offset+vert_count])
-            sorted_mat.append(mat)
-            self.__material_name_table.append(mat.name)
+        for i in np.argsort(distances, kind='mergesort'):
+            sorted_faces.extend(faces[offsets[i]:offsets[i+1]])
+            sorted_mat.append(materials[i])
+            self.__material_name_table.append(materials[i].name)
         self.__model.materials = sorted_mat
         self.__model.faces = sorted_faces
 
@@ -618,20 +831,6 @@ class __PmxExporter:
             self.__model.joints.append(p_joint)
 
 
-    @staticmethod
-    def __convertFaceUVToVertexUV(vert_index, uv, vertices_map):
-        vertices = vertices_map[vert_index]
-        for i in vertices:
-            if i.uv is None:
-                i.uv = uv
-                return i
-            elif (i.uv[0] - uv[0])**2 + (i.uv[1] - uv[1])**2 < 0.0001:
-                return i
-        n = copy.deepcopy(i)
-        n.uv = uv
-        vertices.append(n)
-        return n
-
     @staticmethod
     def __triangulate(mesh):
         bm = bmesh.new()
@@ -640,69 +839,210 @@ class __PmxExporter:
         bm.to_mesh(mesh)
         bm.free()
 
+    @staticmethod
+    def __isCacheable(meshObj):
+        """ Only meshes deformed by armatures are cached, so the vertices of the evaluated
+         mesh are the vertices of the mesh data and the fingerprint can cover all modifiers.
+        """
+        return all(mod.type == 'ARMATURE' for mod in meshObj.modifiers)
+
+    def __meshFingerprint(self, meshObj):
+        """ Calculate a hash of all data which affects the extracted mesh data except vertex weights.
+
+         It covers the mesh data, shape keys, vertex group names, materials, armature modifiers,
+         the poses of deforming armatures and the object transform. Everything is read with
+         foreach_get, and vertex weights are loaded again on cache hits.
+        """
+        h = hashlib.sha1()
+        def update(*values):
+            h.update(repr(values).encode('utf-8'))
+        def update_array(collection, attr, size, dtype):
+            a = np.zeros(len(collection) * size, dtype=dtype)
+            if len(a) > 0:
+                collection.foreach_get(attr, a)
+            h.update(a.tobytes())
+
+        mesh = meshObj.data
+        update(self.__scale, [tuple(r) for r in meshObj.matrix_world])
+        update_array(mesh.vertices, 'co', 3, np.float32)
+        update_array(mesh.loops, 'vertex_index', 1, np.int32)
+        update_array(mesh.polygons, 'loop_total', 1, np.int32)
+        update_array(mesh.polygons, 'material_index', 1, np.int32)
+        if mesh.uv_layers.active is not None:
+            update_array(mesh.uv_layers.active.data, 'uv', 2, np.float32)
+        update([i.name for i in meshObj.material_slots])
+        update([i.name for i in meshObj.vertex_groups])
+
+        if mesh.shape_keys is not None:
+            for key in mesh.shape_keys.key_blocks:
+                update(key.name, key.relative_key.name, key.mute, key.vertex_group, key.slider_min, key.slider_max)
+                update_array(key.data, 'co', 3, np.float32)
+
+        for mod in meshObj.modifiers:
+            update(mod.name, mod.show_viewport, mod.object.name if mod.object else None, mod.vertex_group,
+                   mod.use_vertex_groups, mod.use_bone_envelopes, mod.use_deform_preserve_volume,
+                   mod.use_multi_modifier, mod.invert_vertex_group)
+            if mod.object is not None:
+                update([tuple(r) for r in mod.object.matrix_world])
+                update_array(mod.object.pose.bones, 'matrix', 16, np.float32)
+        return h.hexdigest()
+
+    @staticmethod
+    def __loadVertexGroups(mesh):
+        return [[(x.group, x.weight) for x in v.groups if x.weight > 0] for v in mesh.vertices]
+
     def __loadMeshData(self, meshObj):
+        key = None
+        if self.__use_mesh_cache and self.__isCacheable(meshObj):
+            key = self.__meshFingerprint(meshObj)
+            arrays = _mesh_cache.get(key)
+            if arrays is not None:
+                logging.info('Reuse the cached mesh data of %s', meshObj.name)
+                return self.__createMesh(arrays, self.__loadVertexGroups(meshObj.data))
+
+        arrays = self.__extractMeshArrays(meshObj)
+        groups = arrays.groups
+        if key is not None:
+            arrays.groups = None
+            _mesh_cache.put(key, arrays)
+        return self.__createMesh(arrays, groups)
+
+    def __extractMeshArrays(self, meshObj):
+        """ Evaluate, triangulate and split a mesh object.
+
+         Returns:
+             A _MeshArrays object.
+        """
+        r = _MeshArrays()
+        shape_keys = meshObj.data.shape_keys
+        key_blocks = shape_keys.key_blocks if shape_keys is not None else []
         shape_key_weights = []
-        for i in meshObj.data.shape_keys.key_blocks:
+        for i in key_blocks:
             shape_key_weights.append(i.value)
             i.value = 0.0
 
-        vertex_group_names = list(map(lambda x: x.name, meshObj.vertex_groups))
-
-        base_mesh = meshObj.to_mesh(bpy.context.scene, True, 'PREVIEW', False)
-        base_mesh.transform(meshObj.matrix_world)
-        base_mesh.transform(self.TO_PMX_MATRIX*self.__scale)
-        self.__triangulate(base_mesh)
-        base_mesh.update(calc_tessface=True)
-
-        base_vertices = {}
-        for v in base_mesh.vertices:
-            base_vertices[v.index] = [_Vertex(
-                v.co,
-                list([(x.group, x.weight) for x in v.groups if x.weight > 0]),
-                v.normal,
-                [])]
+        r.vertex_group_names = list(map(lambda x: x.name, meshObj.vertex_groups))
 
-        # calculate offsets
-        shape_key_names = []
-        for i in meshObj.data.shape_keys.key_blocks[1:]:
-            shape_key_names.append(i.name)
-            i.value = 1.0
+        def to_pmx_mesh():
             mesh = meshObj.to_mesh(bpy.context.scene, True, 'PREVIEW', False)
             mesh.transform(meshObj.matrix_world)
             mesh.transform(self.TO_PMX_MATRIX*self.__scale)
-            mesh.update(calc_tessface=True)
-            for key in base_vertices.keys():
-                base = base_vertices[key][0]
-                v = mesh.vertices[key]
-                base.offsets.append(mathutils.Vector(v.co) - mathutils.Vector(base.co))
-            bpy.data.meshes.remove(mesh)
-            i.value = 0.0
+            return mesh
+
+        def get_array(collection, attr, size, dtype=np.float32):
+            a = np.zeros(len(collection) * size, dtype=dtype)
+            if len(a) > 0:
+                collection.foreach_get(attr, a)
+            return a.reshape(-1, size) if size > 1 else a
+
+        try:
+            base_mesh = to_pmx_mesh()
+            try:
+                self.__triangulate(base_mesh)
+                base_mesh.update(calc_tessface=True)
+
+                r.co = get_array(base_mesh.vertices, 'co', 3)
+                r.normals = get_array(base_mesh.vertices, 'normal', 3)
+                r.groups = self.__loadVertexGroups(base_mesh)
+                r.material_names = [getattr(i, 'name', None) for i in base_mesh.materials]
+
+                # SDEF parameters are evaluated like morphs, so they follow the vertices of the evaluated mesh
+                sdef_keys = [key_blocks.get(name) for name in mmd_model.SDEF_SHAPE_KEY_NAMES] if shape_keys else []
+                if mmd_model.SDEF_VERTEX_GROUP_NAME in meshObj.vertex_groups and len(sdef_keys) > 0 and all(sdef_keys):
+                    r.sdef = np.zeros((3, len(r.co), 3), dtype=np.float32)
+                    for index, i in enumerate(sdef_keys):
+                        i.value = 1.0
+                        mesh = to_pmx_mesh()
+                        r.sdef[index] = get_array(mesh.vertices, 'co', 3)
+                        bpy.data.meshes.remove(mesh)
+                        i.value = 0.0
+
+                # calculate offsets
+                morph_keys = [i for i in key_blocks[1:] if i.name not in mmd_model.SDEF_SHAPE_KEY_NAMES]
+                r.shape_key_names = [i.name for i in morph_keys]
+                r.offsets = np.zeros((len(r.co), len(morph_keys), 3), dtype=np.float32)
+                for index, i in enumerate(morph_keys):
+                    i.value = 1.0
+                    mesh = to_pmx_mesh()
+                    mesh.update(calc_tessface=True)
+                    r.offsets[:, index] = get_array(mesh.vertices, 'co', 3) - r.co
+                    bpy.data.meshes.remove(mesh)
+                    i.value = 0.0
+
+                # load face data
+                tessfaces = base_mesh.tessfaces
+                face_vertices = get_array(tessfaces, 'vertices_raw', 4, np.int32)
+                if np.any(face_vertices[:, 3] != 0):
+                    raise Exception('The mesh %s is not triangulated.'%meshObj.name)
+                face_uvs = get_array(base_mesh.tessface_uv_textures.active.data, 'uv_raw', 8).reshape(-1, 4, 2)
+                r.face_normals = get_array(tessfaces, 'normal', 3)
+                r.face_materials = get_array(tessfaces, 'material_index', 1, np.int32)
+            finally:
+                bpy.data.meshes.remove(base_mesh)
+        finally:
+            for i, sk in enumerate(key_blocks):
+                sk.value = shape_key_weights[i]
+
+        # split vertices which have different UVs in faces
+        split_sources = []
+        split_uvs = []
+        vertex_splits = {}
+        corners = []
+        for vert_index, (u, v) in zip(face_vertices[:, :3].ravel().tolist(), face_uvs[:, :3].reshape(-1, 2).tolist()):
+            splits = vertex_splits.setdefault(vert_index, [])
+            for split_index in splits:
+                su, sv = split_uvs[split_index]
+                if (su - u)**2 + (sv - v)**2 < 0.0001:
+                    break
+            else:
+                split_index = len(split_sources)
+                split_sources.append(vert_index)
+                split_uvs.append((u, v))
+                splits.append(split_index)
+            corners.append(split_index)
+
+        r.split_sources = np.array(split_sources, dtype=np.int64)
+        r.split_uvs = np.array(split_uvs, dtype=np.float64).reshape(-1, 2)
+        r.faces = np.array(corners, dtype=np.int64).reshape(-1, 3)
+        return r
 
-        # load face data
-        materials = {}
-        for face, uv in zip(base_mesh.tessfaces, base_mesh.tessface_uv_textures.active.data):
-            if len(face.vertices) != 3:
-                raise Exception
-            v1 = self.__convertFaceUVToVertexUV(face.vertices[0], uv.uv1, base_vertices)
-            v2 = self.__convertFaceUVToVertexUV(face.vertices[1], uv.uv2, base_vertices)
-            v3 = self.__convertFaceUVToVertexUV(face.vertices[2], uv.uv3, base_vertices)
+    @staticmethod
+    def __createMesh(arrays, groups):
+        """ Create a _Mesh object from a _MeshArrays object and vertex weights.
+        """
+        co = arrays.co.tolist()
+        normals = arrays.normals.tolist()
+        offsets = arrays.offsets.tolist()
+
+        # vertices in the SDEF vertex group have SDEF data
+        sdef = {}
+        if arrays.sdef is not None and mmd_model.SDEF_VERTEX_GROUP_NAME in arrays.vertex_group_names:
+            sdef_group = arrays.vertex_group_names.index(mmd_model.SDEF_VERTEX_GROUP_NAME)
+            indices = [i for i, g in enumerate(groups) if any(x[0] == sdef_group for x in g)]
+            c, r0, r1 = [arrays.sdef[k, indices].tolist() for k in range(3)]
+            sdef = dict(zip(indices, zip(c, r0, r1)))
+
+        vertices = []
+        for src, uv in zip(arrays.split_sources.tolist(), arrays.split_uvs.tolist()):
+            v = _Vertex(co[src], groups[src], mathutils.Vector(normals[src]), offsets[src])
+            v.uv = uv
+            v.sdef = sdef.get(src)
+            vertices.append(v)
 
+        materials = {}
+        for (v1, v2, v3), normal, material_index in zip(arrays.faces.tolist(), arrays.face_normals.tolist(), arrays.face_materials.tolist()):
             t = _Face(
-                [v1, v2, v3],
-                face.normal)
-            if face.material_index not in materials:
-                materials[face.material_index] = []
-            materials[face.material_index].append(t)
-
-        for i, sk in enumerate(meshObj.data.shape_keys.key_blocks):
-            sk.value = shape_key_weights[i]
+                [vertices[v1], vertices[v2], vertices[v3]],
+                normal)
+            if material_index not in materials:
+                materials[material_index] = []
+            materials[material_index].append(t)
 
         return _Mesh(
-            base_mesh,
             materials,
-            shape_key_names,
-            vertex_group_names,
-            base_mesh.materials)
+            arrays.shape_key_names,
+            arrays.vertex_group_names,
+            [bpy.data.materials.get(name) if name else None for name in arrays.material_names])
 
 
     def execute(self, filepath, **args):
@@ -718,9 +1058,10 @@ class __PmxExporter:
 
         meshes = args.get('meshes', [])
         self.__armature = args.get('armature', None)
-        rigid_bodeis = args.get('rigid_bodies', [])
+        rigid_bodeis = list(args.get('rigid_bodies', []))
         joints = args.get('joints', [])        
         self.__copyTextures = args.get('copy_textures', False)
+        self.__use_mesh_cache = args.get('use_mesh_cache', True)
         self.__filepath = filepath
 
         self.__scale = 1.0/float(args.get('scale', 0.2))
@@ -734,20 +1075,43 @@ class __PmxExporter:
             mesh_data.append(self.__loadMeshData(i))
 
         self.__exportMeshes(mesh_data, nameMap)
-        self.__exportVertexMorphs(mesh_data, root)
-        self.__sortMaterials()
-        rigid_map = self.__exportRigidBodies(rigid_bodeis, nameMap)
-        self.__exportJoints(joints, rigid_map)
-        if root is not None:
-            self.__exportDisplayItems(root, nameMap)
-            self.__export_bone_morphs(root)
-            self.__export_material_morphs(root)
 
-        if self.__copyTextures:
-            tex_dir = os.path.join(os.path.dirname(filepath), 'textures')
-            self.__copy_textures(tex_dir)
-
-        pmx.save(filepath, self.__model)
+        # The numbers of all items which decide the index sizes are fixed here.
+        # Finished sections are written in a background thread while the rest of the data is exported.
+        num_morphs = len(set(name for mesh in mesh_data for name in mesh.shape_key_names))
+        if root is not None:
+            num_morphs += len(root.mmd_root.bone_morphs) + len(root.mmd_root.material_morphs)
+        header = pmx.Header(self.__model)
+        header.morph_index_size = pmx.Header.getIndexSize(num_morphs, True)
+        header.rigid_index_size = pmx.Header.getIndexSize(len(rigid_bodeis), True)
+
+        with pmx.ModelWriter(filepath, header) as writer:
+            writer.write(self.__model.saveInformation)
+            writer.write(self.__model.saveVertices)
+
+            self.__exportVertexMorphs(mesh_data, root)
+            self.__sortMaterials()
+            writer.write(self.__model.saveFaces)
+
+            if self.__copyTextures:
+                tex_dir = os.path.join(os.path.dirname(filepath), 'textures')
+                self.__copy_textures(tex_dir)
+            writer.write(self.__model.saveTextures)
+            writer.write(self.__model.saveMaterials)
+            writer.write(self.__model.saveBones)
+
+            rigid_map = self.__exportRigidBodies(rigid_bodeis, nameMap)
+            self.__exportJoints(joints, rigid_map)
+            if root is not None:
+                self.__exportDisplayItems(root, nameMap)
+                self.__export_bone_morphs(root)
+                self.__export_material_morphs(root)
+            if len(self.__model.morphs) != num_morphs:
+                raise Exception('The number of morphs is changed: %d -> %d'%(num_morphs, len(self.__model.morphs)))
+            writer.write(self.__model.saveMorphs)
+            writer.write(self.__model.saveDisplayItems)
+            writer.write(self.__model.saveRigids)
+            writer.write(self.__model.saveJoints)
 
 def export(filepath, **kwargs):
     exporter = __PmxExporter()
@@ -7,6 +7,7 @@ import re
 
 import bpy
 import mathutils
+import numpy as np
 
 import mmd_tools.core.model as mmd_model
 import mmd_tools.core.pmx as pmx
@@ -81,6 +82,7 @@ class PMXImporter:
         self.__armObj = self.__rig.armature()
         self.__armObj.hide = True
         self.__meshObj.parent = self.__armObj
+        self.__rig.invalidateObjectIndex()
 
     def __createGroups(self):
         pmxModel = self.__model
@@ -473,6 +475,36 @@ class PMXImporter:
                 offset = mathutils.Vector(md.offset) * self.TO_BLE_MATRIX
                 shapeKeyPoint.co = shapeKeyPoint.co + offset * self.__scale
 
+    def __importSdefData(self):
+        """ Store SDEF parameters in the shape keys named by mmd_model.SDEF_SHAPE_KEY_NAMES.
+
+         SDEF vertices are added to the vertex group named by mmd_model.SDEF_VERTEX_GROUP_NAME,
+         and the shape keys of the other vertices have the basis coordinates.
+         R0 is stored for the bone of the larger weight, as the exporter expects.
+        """
+        sdef = [(i, pv.weight.weights) for i, pv in enumerate(self.__model.vertices) if isinstance(pv.weight.weights, pmx.BoneWeightSDEF)]
+        if len(sdef) == 0:
+            return
+
+        mesh = self.__meshObj.data
+        basis = np.zeros(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', basis)
+        basis = basis.reshape(-1, 3)
+
+        indices = np.array([i for i, w in sdef], dtype=np.int64)
+        swap = np.array([w.weight < 0.5 for i, w in sdef], dtype=bool)[:, np.newaxis]
+        c = np.array([w.c for i, w in sdef], dtype=np.float64)
+        r0 = np.array([w.r0 for i, w in sdef], dtype=np.float64)
+        r1 = np.array([w.r1 for i, w in sdef], dtype=np.float64)
+        r0, r1 = np.where(swap, r1, r0), np.where(swap, r0, r1)
+        vertex_group = self.__meshObj.vertex_groups.new(name=mmd_model.SDEF_VERTEX_GROUP_NAME)
+        vertex_group.add(index=indices.tolist(), weight=1.0, type='REPLACE')
+        for name, values in zip(mmd_model.SDEF_SHAPE_KEY_NAMES, (c, r0, r1)):
+            co = basis.copy()
+            co[indices] = values[:, [0, 2, 1]] * self.__scale
+            shapeKey = self.__meshObj.shape_key_add(name=name, from_mix=False)
+            shapeKey.data.foreach_set('co', co.ravel())
+
     def __importMaterialMorphs(self):
         mmd_root = self.__rig.rootObject().mmd_root
         categories = {
@@ -555,12 +587,13 @@ class PMXImporter:
 
     def __renameLRBones(self):
         pose_bones = self.__armObj.pose.bones
+        mapping = {}
         for i in pose_bones:
             if i.is_mmd_shadow_bone:
                 continue
             i.mmd_bone.name_j = i.name
-            self.__rig.renameBone(i.name, utils.convertNameToLR(i.name))
-            # self.__meshObj.vertex_groups[i.mmd_bone.name_j].name = i.name
+            mapping[i.name] = utils.convertNameToLR(i.name)
+        self.__rig.renameBones(mapping)
 
     def execute(self, **args):
         if 'pmx' in args:
@@ -595,6 +628,7 @@ class PMXImporter:
         self.__importDisplayFrames()
 
         self.__importVertexMorphs()
+        self.__importSdefData()
         self.__importBoneMorphs()
         self.__importMaterialMorphs()
 
@@ -612,7 +646,7 @@ class PMXImporter:
 
         bpy.context.scene.gravity[2] = -9.81 * 10 * self.__scale
         self.__rig.rootObject().mmd_root.show_meshes = True
-        self.__rig.applyAdditionalTransformConstraints()
+        self.__rig.applyAdditionalTransformConstraints(force=True)
 
         logging.info(' Finished importing the model in %f seconds.', time.time() - start_time)
         logging.info('----------------------------------------')
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+""" Evaluate bone poses of a pmx.Model and a vmd.File with numpy.
+
+ Everything is in MMD coordinates, and Blender is not required.
+ Poses of many frames are evaluated at once. Matrices are (frames, bones, 4, 4) arrays
+ and the bones of each hierarchy level are transformed in one pass.
+"""
+import logging
+
+import numpy as np
+
+from mmd_tools.core.vmd import interpolation
+
+
+def quaternionToMatrix(q):
+    """ Convert (..., 4) arrays of (x, y, z, w) quaternions to (..., 3, 3) rotation matrices.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    q = q / np.linalg.norm(q, axis=-1)[..., np.newaxis]
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    m = np.empty(q.shape[:-1] + (3, 3))
+    m[..., 0, 0] = 1 - 2*(y*y + z*z)
+    m[..., 0, 1] = 2*(x*y - z*w)
+    m[..., 0, 2] = 2*(x*z + y*w)
+    m[..., 1, 0] = 2*(x*y + z*w)
+    m[..., 1, 1] = 1 - 2*(x*x + z*z)
+    m[..., 1, 2] = 2*(y*z - x*w)
+    m[..., 2, 0] = 2*(x*z - y*w)
+    m[..., 2, 1] = 2*(y*z + x*w)
+    m[..., 2, 2] = 1 - 2*(x*x + y*y)
+    return m
+
+
+class Skeleton:
+    """ The bone hierarchy of a pmx.Model as arrays.
+
+    Attributes:
+        names: bone names
+        parents: parent indices (-1 for root bones)
+        rest_locations: (bones, 3) array of bone heads at the rest pose
+        order: bone indices sorted by transform_order. A parent is always before its children.
+        levels: a list of bone index arrays of each hierarchy level, from the roots.
+    """
+    def __init__(self, model):
+        bones = model.bones
+        count = len(bones)
+        self.names = [b.name for b in bones]
+        self.rest_locations = np.array([b.location for b in bones], dtype=np.float64).reshape(count, 3)
+
+        parents = np.full(count, -1, dtype=int)
+        for i, b in enumerate(bones):
+            if b.parent is not None and 0 <= b.parent < count and b.parent != i:
+                parents[i] = b.parent
+        self.parents = parents
+
+        for i in range(count):
+            seen = set([i])
+            j = i
+            while parents[j] >= 0:
+                if parents[j] in seen:
+                    logging.warning('Bone hierarchy has a loop at %s', self.names[j])
+                    parents[j] = -1
+                    break
+                j = parents[j]
+                seen.add(j)
+
+        depths = np.full(count, -1, dtype=int)
+        for i in range(count):
+            chain = []
+            j = i
+            while j >= 0 and depths[j] < 0:
+                chain.append(j)
+                j = parents[j]
+            depth = depths[j] if j >= 0 else -1
+            for k in reversed(chain):
+                depth += 1
+                depths[k] = depth
+        self.depths = depths
+
+        transform_orders = np.array([b.transform_order for b in bones], dtype=int)
+        self.order = np.lexsort((np.arange(count), depths, transform_orders))
+        self.order = self.__fixOrder(self.order)
+        self.levels = [np.flatnonzero(depths == d) for d in range(depths.max() + 1)] if count else []
+
+        self.offsets = self.rest_locations.copy()
+        has_parent = parents >= 0
+        self.offsets[has_parent] -= self.rest_locations[parents[has_parent]]
+
+    def __fixOrder(self, order):
+        """ Move parents before their children if transform_order says otherwise.
+        """
+        done = np.zeros(len(order), dtype=bool)
+        result = []
+
+        def visit(i):
+            if done[i]:
+                return
+            p = self.parents[i]
+            if p >= 0:
+                visit(p)
+            done[i] = True
+            result.append(i)
+
+        for i in order:
+            visit(i)
+        return np.array(result, dtype=int)
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def evaluateMotion(self, vmdFile, frames):
+        """ Evaluate bone tracks of a vmd.File.
+
+        Returns:
+            (locations, rotations): (frames, bones, 3) and (frames, bones, 4) arrays of (x, y, z, w).
+            Bones without tracks are at the rest pose.
+        """
+        frames = np.asarray(frames, dtype=np.float64).reshape(-1)
+        count = len(self.names)
+        locations = np.zeros((len(frames), count, 3))
+        rotations = np.zeros((len(frames), count, 4))
+        rotations[..., 3] = 1.0
+        indices = dict((name, i) for i, name in enumerate(self.names))
+        for name, keyFrames in vmdFile.boneAnimation.items():
+            i = indices.get(name, None)
+            if i is None or len(keyFrames) == 0:
+                continue
+            locations[:, i], rotations[:, i] = interpolation.evaluateBoneTrack(keyFrames, frames)
+        return locations, rotations
+
+    def localMatrices(self, locations, rotations):
+        """ Return (frames, bones, 4, 4) matrices from the parent space to the bone space.
+        """
+        locations = np.asarray(locations, dtype=np.float64)
+        mats = np.zeros(locations.shape[:-1] + (4, 4))
+        mats[..., :3, :3] = quaternionToMatrix(rotations)
+        mats[..., :3, 3] = self.offsets + locations
+        mats[..., 3, 3] = 1.0
+        return mats
+
+    def worldMatrices(self, locations, rotations):
+        """ Return (frames, bones, 4, 4) matrices from the bone space to the model space.
+        """
+        world = self.localMatrices(locations, rotations)
+        for level in self.levels[1:]:
+            world[:, level] = np.matmul(world[:, self.parents[level]], world[:, level])
+        return world
+
+    def skinningMatrices(self, world):
+        """ Return (frames, bones, 4, 4) matrices which move vertices from the rest pose to the pose.
+        """
+        skinning = world.copy()
+        skinning[..., :3, 3] -= np.einsum('...ij,...j->...i', world[..., :3, :3], self.rest_locations)
+        return skinning
+
+    def evaluate(self, vmdFile, frames):
+        """ Evaluate world matrices of all bones at the frames of a vmd.File.
+        """
+        return self.worldMatrices(*self.evaluateMotion(vmdFile, frames))
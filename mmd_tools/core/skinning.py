@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+""" Deform vertices by bone matrices with numpy.
+
+ BDEF1, BDEF2 and BDEF4 vertices are deformed by linear blend skinning, and SDEF vertices
+ are deformed by spherical deformation as MMD does. Blender is not required, so this can be
+ used headless with pose.Skeleton, or for previews in Blender (see skinning_preview).
+"""
+import numpy as np
+
+import mmd_tools.core.pmx as pmx
+from mmd_tools.core.pose import quaternionToMatrix
+from mmd_tools.core.vmd.interpolation import slerp
+
+
+def matrixToQuaternion(m):
+    """ Convert (..., 3, 3) arrays of rotation matrices to (x, y, z, w) quaternions.
+    """
+    m = np.asarray(m, dtype=np.float64)
+    m00, m11, m22 = m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]
+    w = np.sqrt(np.maximum(0.0, 1.0 + m00 + m11 + m22)) * 0.5
+    x = np.sqrt(np.maximum(0.0, 1.0 + m00 - m11 - m22)) * 0.5
+    y = np.sqrt(np.maximum(0.0, 1.0 - m00 + m11 - m22)) * 0.5
+    z = np.sqrt(np.maximum(0.0, 1.0 - m00 - m11 + m22)) * 0.5
+    x = np.copysign(x, m[..., 2, 1] - m[..., 1, 2])
+    y = np.copysign(y, m[..., 0, 2] - m[..., 2, 0])
+    z = np.copysign(z, m[..., 1, 0] - m[..., 0, 1])
+    q = np.stack((x, y, z, w), axis=-1)
+    return q / np.linalg.norm(q, axis=-1)[..., np.newaxis]
+
+
+class Skinning:
+    """ Deform vertices of a mesh by skinning matrices.
+
+     Skinning matrices move vertices from the rest pose to the pose,
+     e.g. pose.Skeleton.skinningMatrices().
+
+    Args:
+        co: (vertices, 3) array of rest coordinates
+        bones: (vertices, 4) array of bone indices (-1 for unused)
+        weights: (vertices, 4) array of bone weights
+        sdef_indices: indices of SDEF vertices. The first two bones and weights of them are used.
+        sdef_c, sdef_r0, sdef_r1: (SDEF vertices, 3) arrays of SDEF parameters
+    """
+    def __init__(self, co, bones, weights, sdef_indices=None, sdef_c=None, sdef_r0=None, sdef_r1=None):
+        self.co = np.asarray(co, dtype=np.float32).reshape(-1, 3)
+        bones = np.asarray(bones, dtype=np.int64).reshape(len(self.co), -1)
+        weights = np.asarray(weights, dtype=np.float32).reshape(bones.shape)
+        weights = np.where(bones >= 0, weights, 0.0).astype(np.float32)
+        totals = weights.sum(axis=1)
+        weights[totals > 0] /= totals[totals > 0, np.newaxis]
+        self.bones = np.maximum(bones, 0)
+        self.weights = weights
+        # vertices without weights are not deformed
+        self.unweighted = np.flatnonzero(totals <= 0)
+
+        if sdef_indices is None or len(sdef_indices) == 0:
+            self.sdef_indices = np.zeros(0, dtype=np.int64)
+            return
+
+        # SDEF parameters which don't depend on the pose
+        idx = np.asarray(sdef_indices, dtype=np.int64)
+        self.sdef_indices = idx
+        w0 = weights[idx, 0:1].astype(np.float64)
+        w1 = 1.0 - w0
+        c = np.asarray(sdef_c, dtype=np.float64)
+        r0 = np.asarray(sdef_r0, dtype=np.float64)
+        r1 = np.asarray(sdef_r1, dtype=np.float64)
+        rw = r0 * w0 + r1 * w1
+        self.__sdef_c = c
+        self.__sdef_cr0 = (c + (c + r0 - rw)) * 0.5
+        self.__sdef_cr1 = (c + (c + r1 - rw)) * 0.5
+        self.__sdef_w0 = w0
+        self.__sdef_bones = self.bones[idx, :2]
+
+    @classmethod
+    def fromPmx(cls, model):
+        """ Create a Skinning of all vertices of a pmx.Model in MMD coordinates.
+        """
+        count = len(model.vertices)
+        bones = np.full((count, 4), -1, dtype=np.int64)
+        weights = np.zeros((count, 4), dtype=np.float32)
+        sdef_indices = []
+        sdef = []
+        for i, v in enumerate(model.vertices):
+            weight = v.weight
+            if isinstance(weight.weights, pmx.BoneWeightSDEF):
+                w = weight.weights
+                bones[i, :2] = weight.bones[:2]
+                weights[i, :2] = (w.weight, 1.0 - w.weight)
+                sdef_indices.append(i)
+                sdef.append((w.c, w.r0, w.r1))
+            elif len(weight.bones) == 1:
+                bones[i, 0] = weight.bones[0]
+                weights[i, 0] = 1.0
+            elif len(weight.bones) == 2:
+                bones[i, :2] = weight.bones
+                weights[i, :2] = (weight.weights[0], 1.0 - weight.weights[0])
+            else:
+                bones[i, :len(weight.bones)] = weight.bones[:4]
+                weights[i, :len(weight.weights)] = weight.weights[:4]
+        sdef = np.array(sdef, dtype=np.float64).reshape(-1, 3, 3)
+        co = np.array([v.co for v in model.vertices], dtype=np.float32).reshape(-1, 3)
+        return cls(co, bones, weights, sdef_indices, sdef[:, 0], sdef[:, 1], sdef[:, 2])
+
+    def deform(self, matrices, co=None):
+        """ Deform vertices.
+
+        Args:
+            matrices: (bones, 4, 4) or (frames, bones, 4, 4) array of skinning matrices
+            co: rest coordinates to deform instead of the original ones, e.g. with morphs applied
+
+        Returns:
+            (vertices, 3) or (frames, vertices, 3) array of deformed coordinates.
+        """
+        matrices = np.asarray(matrices)
+        if matrices.ndim == 4:
+            return np.array([self.deform(m, co) for m in matrices])
+        co = self.co if co is None else np.asarray(co, dtype=np.float32).reshape(-1, 3)
+
+        m = matrices[:, :3, :].astype(np.float32)
+        blended = np.einsum('vk,vkij->vij', self.weights, m[self.bones])
+        result = np.einsum('vij,vj->vi', blended[:, :, :3], co) + blended[:, :, 3]
+        result[self.unweighted] = co[self.unweighted]
+
+        if len(self.sdef_indices) > 0:
+            result[self.sdef_indices] = self.__deformSdef(np.asarray(matrices, dtype=np.float64), co[self.sdef_indices])
+        return result
+
+    def __deformSdef(self, matrices, co):
+        b0, b1 = self.__sdef_bones[:, 0], self.__sdef_bones[:, 1]
+        w0 = self.__sdef_w0
+        q = matrixToQuaternion(matrices[:, :3, :3])
+        rot = quaternionToMatrix(slerp(q[b1], q[b0], w0[:, 0]))
+
+        def transform(mats, v):
+            return np.einsum('vij,vj->vi', mats[:, :3, :3], v) + mats[:, :3, 3]
+
+        return (np.einsum('vij,vj->vi', rot, co - self.__sdef_c)
+                + transform(matrices[b0], self.__sdef_cr0) * w0
+                + transform(matrices[b1], self.__sdef_cr1) * (1.0 - w0))
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+""" Preview MMD skinning (BDEF and SDEF) of meshes in Blender.
+
+ A preview object is created for each mesh and the original mesh is hidden.
+ The preview object is not parented into the model, so it is not a mesh of the model
+ (e.g. for PMX export), and it follows the world transform of the original mesh.
+ A frame change handler deforms the rest coordinates with vertex morphs applied
+ by core/skinning, and writes them to the preview mesh with foreach_set.
+"""
+import logging
+
+import bpy
+from bpy.app.handlers import persistent
+import numpy as np
+
+import mmd_tools.core.model as mmd_model
+from mmd_tools.core.skinning import Skinning
+
+
+class _Preview:
+    def __init__(self, meshObj, armObj, previewObj):
+        self.mesh_name = meshObj.name
+        self.armature_name = armObj.name
+        self.preview_name = previewObj.name
+        self.bone_names = [b.name for b in armObj.pose.bones]
+        self.bind = np.linalg.inv(np.array([np.array(b.bone.matrix_local) for b in armObj.pose.bones]))
+        self.pose_buffer = np.zeros(len(self.bone_names) * 16, dtype=np.float32)
+
+        mesh = meshObj.data
+        num_vertices = len(mesh.vertices)
+        shape_keys = mesh.shape_keys
+
+        def load_co(data):
+            co = np.zeros(num_vertices * 3, dtype=np.float32)
+            data.foreach_get('co', co)
+            return co.reshape(-1, 3)
+
+        self.rest = load_co(mesh.vertices if shape_keys is None else shape_keys.reference_key.data)
+
+        # the 4 most influential bones of each vertex, sorted by weight.
+        # The sort is stable so that ties keep the order of v.groups like the exporter,
+        # e.g. R0 of SDEF vertices with 0.5 weights belongs to the first bone.
+        bone_indices = dict((name, i) for i, name in enumerate(self.bone_names))
+        group_bones = [bone_indices.get(g.name, -1) for g in meshObj.vertex_groups]
+        sdef_group = meshObj.vertex_groups.get(mmd_model.SDEF_VERTEX_GROUP_NAME)
+        sdef_group = sdef_group.index if sdef_group is not None else -1
+        bones = np.full((num_vertices, 4), -1, dtype=np.int64)
+        weights = np.zeros((num_vertices, 4), dtype=np.float32)
+        in_sdef_group = np.zeros(num_vertices, dtype=bool)
+        for v in mesh.vertices:
+            groups = sorted([(g.weight, group_bones[g.group]) for g in v.groups if group_bones[g.group] >= 0], key=lambda x: -x[0])[:4]
+            for k, (w, b) in enumerate(groups):
+                bones[v.index, k] = b
+                weights[v.index, k] = w
+            in_sdef_group[v.index] = any(g.group == sdef_group and g.weight > 0 for g in v.groups)
+
+        sdef_indices = None
+        sdef = (None, None, None)
+        self.morphs = []
+        if shape_keys is not None:
+            key_blocks = shape_keys.key_blocks
+            if all(name in key_blocks for name in mmd_model.SDEF_SHAPE_KEY_NAMES):
+                sdef = [load_co(key_blocks[name].data) for name in mmd_model.SDEF_SHAPE_KEY_NAMES]
+                has_sdef = in_sdef_group & (bones[:, 1] >= 0) & (bones[:, 2] < 0)
+                sdef_indices = np.flatnonzero(has_sdef)
+                sdef = [i[sdef_indices] for i in sdef]
+            for key_block in key_blocks[1:]:
+                if key_block.name in mmd_model.SDEF_SHAPE_KEY_NAMES:
+                    continue
+                delta = load_co(key_block.data) - load_co(key_block.relative_key.data)
+                indices = np.flatnonzero(np.any(np.abs(delta) > 1e-6, axis=1))
+                if len(indices) > 0:
+                    self.morphs.append((key_block.name, indices, delta[indices]))
+
+        self.skinning = Skinning(self.rest, bones, weights, sdef_indices, *sdef)
+
+    def update(self):
+        meshObj = bpy.data.objects.get(self.mesh_name)
+        armObj = bpy.data.objects.get(self.armature_name)
+        previewObj = bpy.data.objects.get(self.preview_name)
+        if meshObj is None or armObj is None or previewObj is None:
+            return False
+        if len(previewObj.data.vertices) != len(self.rest) or len(armObj.pose.bones) != len(self.bone_names):
+            return False
+
+        co = self.rest
+        key_blocks = meshObj.data.shape_keys.key_blocks if meshObj.data.shape_keys else {}
+        for name, indices, delta in self.morphs:
+            key_block = key_blocks.get(name)
+            if key_block is None or key_block.mute or key_block.value == 0:
+                continue
+            if co is self.rest:
+                co = self.rest.copy()
+            co[indices] += delta * key_block.value
+
+        # matrices are read in column-major order
+        armObj.pose.bones.foreach_get('matrix', self.pose_buffer)
+        pose = self.pose_buffer.reshape(-1, 4, 4).transpose(0, 2, 1).astype(np.float64)
+        to_armature = np.array(armObj.matrix_world.inverted() * meshObj.matrix_world)
+        matrices = np.matmul(np.linalg.inv(to_armature), np.matmul(np.matmul(pose, self.bind), to_armature))
+
+        deformed = self.skinning.deform(matrices, co)
+        previewObj.data.vertices.foreach_set('co', deformed.ravel())
+        previewObj.data.update()
+        previewObj.matrix_world = meshObj.matrix_world
+        return True
+
+
+_previews = {}
+
+
+def _findArmature(meshObj):
+    for m in meshObj.modifiers:
+        if m.type == 'ARMATURE' and m.object is not None:
+            return m.object
+    return None
+
+
+@persistent
+def _frameChangeHandler(scene):
+    for name, preview in list(_previews.items()):
+        if not preview.update():
+            logging.info('Stop the skinning preview of %s', name)
+            del _previews[name]
+    if len(_previews) == 0:
+        _removeHandler()
+
+
+@persistent
+def _loadPreHandler(dummy):
+    # previews are looked up by object names, so they must not survive loading another file
+    for name in list(_previews.keys()):
+        meshObj = bpy.data.objects.get(name)
+        if meshObj is not None:
+            disable(meshObj)
+    _previews.clear()
+    _removeHandler()
+
+
+def _removeHandler():
+    if _frameChangeHandler in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.remove(_frameChangeHandler)
+    if _loadPreHandler in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(_loadPreHandler)
+
+
+def isEnabled(meshObj):
+    return meshObj.name in _previews
+
+
+def enable(meshObj, scene=None):
+    """ Start the skinning preview of a mesh object which has an armature modifier.
+    """
+    if isEnabled(meshObj):
+        return
+    armObj = _findArmature(meshObj)
+    if armObj is None:
+        logging.warning('%s has no armature modifier', meshObj.name)
+        return
+    scene = scene or bpy.context.scene
+
+    mesh = meshObj.to_mesh(scene, False, 'PREVIEW')
+    mesh.name = meshObj.data.name + '.skinning'
+    previewObj = bpy.data.objects.new(name=meshObj.name + '.skinning', object_data=mesh)
+    previewObj.matrix_world = meshObj.matrix_world
+    scene.objects.link(previewObj)
+
+    preview = _Preview(meshObj, armObj, previewObj)
+    _previews[meshObj.name] = preview
+    meshObj.hide = True
+    preview.update()
+
+    if _frameChangeHandler not in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.append(_frameChangeHandler)
+    if _loadPreHandler not in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.append(_loadPreHandler)
+
+
+def disable(meshObj):
+    """ Stop the skinning preview of a mesh object and remove the preview object.
+    """
+    preview = _previews.pop(meshObj.name, None)
+    if preview is None:
+        return
+    previewObj = bpy.data.objects.get(preview.preview_name)
+    if previewObj is not None:
+        mesh = previewObj.data
+        for scene in bpy.data.scenes:
+            if previewObj.name in scene.objects:
+                scene.objects.unlink(previewObj)
+        bpy.data.objects.remove(previewObj)
+        if mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+    meshObj.hide = False
+    if len(_previews) == 0:
+        _removeHandler()
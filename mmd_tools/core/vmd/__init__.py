@@ -12,8 +12,18 @@ def _toShiftJisString(byteString):
         # discard truncated sjis char
         return byteString[:-1].decode("shift_jis")
 
+## stringをvmd仕様の文字列に変換
+def _toShiftJisBytes(string, length):
+    byteString = string.encode('shift_jis', errors='replace')
+    while len(byteString) > length:
+        string = string[:-1]
+        byteString = string.encode('shift_jis', errors='replace')
+    return byteString.ljust(length, b'\x00')
+
 
 class Header:
+    VMD_SIGNATURE = b'Vocaloid Motion Data 0002'
+
     def __init__(self):
         self.signature = None
         self.model_name = ''
@@ -22,11 +32,17 @@ class Header:
         self.signature, = struct.unpack('<30s', fin.read(30))
         self.model_name = _toShiftJisString(struct.unpack('<20s', fin.read(20))[0])
 
+    def save(self, fout):
+        fout.write(struct.pack('<30s', self.VMD_SIGNATURE))
+        fout.write(_toShiftJisBytes(self.model_name, 20))
+
     def __repr__(self):
         return '<Header model_name %s>'%(self.model_name)
 
 
 class BoneFrameKey:
+    STRUCT = struct.Struct('<L3f4f64b')
+
     def __init__(self):
         self.frame_number = 0
         self.location = []
@@ -39,6 +55,9 @@ class BoneFrameKey:
         self.rotation = list(struct.unpack('<ffff', fin.read(4*4)))
         self.interp = list(struct.unpack('<64b', fin.read(64)))
 
+    def pack(self):
+        return self.STRUCT.pack(self.frame_number, *(list(self.location) + list(self.rotation) + list(self.interp)))
+
     def __repr__(self):
         return '<BoneFrameKey frame %s, loa %s, rot %s>'%(
             str(self.frame_number),
@@ -48,6 +67,8 @@ class BoneFrameKey:
 
 
 class ShapeKeyFrameKey:
+    STRUCT = struct.Struct('<Lf')
+
     def __init__(self):
         self.frame_number = 0
         self.weight = 0.0
@@ -56,6 +77,9 @@ class ShapeKeyFrameKey:
         self.frame_number, = struct.unpack('<L', fin.read(4))
         self.weight, = struct.unpack('<f', fin.read(4))
 
+    def pack(self):
+        return self.STRUCT.pack(self.frame_number, self.weight)
+
     def __repr__(self):
         return '<ShapeKeyFrameKey frame %s, weight %s>'%(
             str(self.frame_number),
@@ -64,6 +88,8 @@ class ShapeKeyFrameKey:
 
 
 class CameraKeyFrameKey:
+    STRUCT = struct.Struct('<Lf3f3f24bLb')
+
     def __init__(self):
         self.frame_number = 0
         self.distance = 0.0
@@ -81,7 +107,12 @@ class CameraKeyFrameKey:
         self.interp = list(struct.unpack('<24b', fin.read(24)))
         self.angle, = struct.unpack('<L', fin.read(4))
         self.persp, = struct.unpack('<b', fin.read(1))
-        self.persp = (self.persp == 1)
+        self.persp = (self.persp == 0)
+
+    def pack(self):
+        return self.STRUCT.pack(self.frame_number, self.distance,
+                                *(list(self.location) + list(self.rotation) + list(self.interp)
+                                  + [int(self.angle), 0 if self.persp else 1]))
 
     def __repr__(self):
         return '<CameraKeyFrameKey frame %s, distance %s, loc %s, rot %s, angle %s, persp %s>'%(
@@ -95,6 +126,8 @@ class CameraKeyFrameKey:
 
 
 class LampKeyFrameKey:
+    STRUCT = struct.Struct('<L3f3f')
+
     def __init__(self):
         self.frame_number = 0
         self.color = []
@@ -105,6 +138,9 @@ class LampKeyFrameKey:
         self.color = list(struct.unpack('<fff', fin.read(4*3)))
         self.direction = list(struct.unpack('<fff', fin.read(4*3)))
 
+    def pack(self):
+        return self.STRUCT.pack(self.frame_number, *(list(self.color) + list(self.direction)))
+
     def __repr__(self):
         return '<LampKeyFrameKey frame %s, color %s, direction %s>'%(
             str(self.frame_number),
@@ -130,6 +166,17 @@ class _AnimationBase(collections.defaultdict):
             frameKey.load(fin)
             self[name].append(frameKey)
 
+    def save(self, fout):
+        """ Write all keys of this section in one buffer.
+        """
+        buf = [struct.pack('<L', sum(len(i) for i in self.values()))]
+        for name, frameKeys in self.items():
+            name = _toShiftJisBytes(name, 15)
+            for frameKey in frameKeys:
+                buf.append(name)
+                buf.append(frameKey.pack())
+        fout.write(b''.join(buf))
+
             
 class BoneAnimation(_AnimationBase):
     def __init__(self):
@@ -166,6 +213,11 @@ class CameraAnimation(list):
             frameKey.load(fin)
             self.append(frameKey)
 
+    def save(self, fout):
+        buf = [struct.pack('<L', len(self))]
+        buf.extend(frameKey.pack() for frameKey in self)
+        fout.write(b''.join(buf))
+
 
 class LampAnimation(list):
     def __init__(self):
@@ -184,6 +236,11 @@ class LampAnimation(list):
             frameKey.load(fin)
             self.append(frameKey)
 
+    def save(self, fout):
+        buf = [struct.pack('<L', len(self))]
+        buf.extend(frameKey.pack() for frameKey in self)
+        fout.write(b''.join(buf))
+
 
 class File:
     def __init__(self):
@@ -213,3 +270,20 @@ class File:
                 self.lampAnimation.load(fin)
             except struct.error:
                 pass # no valid camera/lamp data
+
+    def save(self, **args):
+        path = args.get('filepath', self.filepath)
+
+        header = self.header or Header()
+        boneAnimation = self.boneAnimation or BoneAnimation()
+        shapeKeyAnimation = self.shapeKeyAnimation or ShapeKeyAnimation()
+        cameraAnimation = self.cameraAnimation or CameraAnimation()
+        lampAnimation = self.lampAnimation or LampAnimation()
+
+        with open(path, 'wb') as fout:
+            self.filepath = path
+            header.save(fout)
+            boneAnimation.save(fout)
+            shapeKeyAnimation.save(fout)
+            cameraAnimation.save(fout)
+            lampAnimation.save(fout)
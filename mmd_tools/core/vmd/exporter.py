@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import re
+
+import numpy as np
+
+import mmd_tools.core.camera as mmd_camera
+import mmd_tools.core.lamp as mmd_lamp
+import mmd_tools.core.vmd as vmd
+from mmd_tools import utils
+
+
+# interpolation bytes (x1, y1, x2, y2) of a linear curve
+_LINEAR_INTERP = np.array([20, 20, 107, 107])
+
+
+class _Channel:
+    """ Keyframes of a F-Curve read in bulk.
+    """
+    def __init__(self, fcurve):
+        self.fcurve = fcurve
+        points = fcurve.keyframe_points
+        n = len(points)
+        co = np.zeros(n * 2, dtype=np.float32)
+        handle_left = np.zeros(n * 2, dtype=np.float32)
+        handle_right = np.zeros(n * 2, dtype=np.float32)
+        if n > 0:
+            points.foreach_get('co', co)
+            points.foreach_get('handle_left', handle_left)
+            points.foreach_get('handle_right', handle_right)
+        co = co.reshape(-1, 2)
+        order = np.argsort(co[:, 0], kind='mergesort')
+        self.frames = co[order, 0].astype(np.float64)
+        self.values = co[order, 1].astype(np.float64)
+        self.handle_left = handle_left.reshape(-1, 2)[order].astype(np.float64)
+        self.handle_right = handle_right.reshape(-1, 2)[order].astype(np.float64)
+        interpolations = [p.interpolation for p in points]
+        self.linear = np.array([interpolations[i] != 'BEZIER' for i in order], dtype=bool)
+
+    def interpolation(self):
+        """ Fit MMD interpolation bytes to the Bezier handles of each segment.
+
+        Returns:
+            (num_keys, 4) array of (x1, y1, x2, y2). The row of the key i is the curve from key i-1 to key i.
+        """
+        r = np.tile(_LINEAR_INTERP, (len(self.frames), 1))
+        if len(self.frames) < 2:
+            return r
+        f0, f1 = self.frames[:-1], self.frames[1:]
+        v0, v1 = self.values[:-1], self.values[1:]
+        dx = f1 - f0
+        dy = v1 - v0
+        valid = (dx > 0) & (np.abs(dy) > 1e-6) & ~self.linear[:-1]
+        dx = np.where(valid, dx, 1.0)
+        dy = np.where(valid, dy, 1.0)
+        fitted = np.stack([
+            (self.handle_right[:-1, 0] - f0) / dx,
+            (self.handle_right[:-1, 1] - v0) / dy,
+            (self.handle_left[1:, 0] - f0) / dx,
+            (self.handle_left[1:, 1] - v0) / dy,
+            ], axis=1)
+        fitted = np.round(np.clip(fitted, 0.0, 1.0) * 127).astype(int)
+        r[1:] = np.where(valid[:, np.newaxis], fitted, _LINEAR_INTERP)
+        return r
+
+    def sample(self, frames):
+        """ Return values and interpolation bytes at frames.
+
+         Frames which are not keys of this channel are evaluated by the F-Curve,
+         and the segments ending at them get linear interpolation.
+        """
+        n = len(frames)
+        values = np.zeros(n)
+        interp = np.tile(_LINEAR_INTERP, (n, 1))
+        if len(self.frames) == 0:
+            for i in range(n):
+                values[i] = self.fcurve.evaluate(frames[i])
+            return values, interp
+
+        idx = np.clip(np.searchsorted(self.frames, frames), 0, len(self.frames) - 1)
+        present = self.frames[idx] == frames
+        values[present] = self.values[idx[present]]
+        for i in np.flatnonzero(~present):
+            values[i] = self.fcurve.evaluate(frames[i])
+
+        consecutive = np.zeros(n, dtype=bool)
+        consecutive[1:] = present[1:] & present[:-1] & (idx[1:] == idx[:-1] + 1)
+        interp[consecutive] = self.interpolation()[idx[consecutive]]
+        return values, interp
+
+
+def _channels(action, rePath):
+    """ Return a dict of {(match groups) => {array_index => _Channel}}
+    """
+    r = {}
+    if action is None:
+        return r
+    for fcurve in action.fcurves:
+        m = rePath.match(fcurve.data_path)
+        if m:
+            r.setdefault(m.groups(), {})[fcurve.array_index] = _Channel(fcurve)
+    return r
+
+
+def _unionFrames(channels):
+    frames = [c.frames for c in channels if len(c.frames) > 0]
+    if len(frames) == 0:
+        return np.zeros(0)
+    return np.unique(np.concatenate(frames))
+
+
+def _largestChange(values, interps):
+    """ Pick interpolation bytes of the channel which changes most in each segment.
+
+    Args:
+        values: (num_channels, num_keys) array
+        interps: (num_channels, num_keys, 4) array
+    """
+    change = np.zeros(values.shape)
+    change[:, 1:] = np.abs(np.diff(values, axis=1))
+    best = np.argmax(change, axis=0)
+    return interps[best, np.arange(values.shape[1])]
+
+
+class VMDExporter:
+    def __init__(self):
+        self.__scale = 1.0
+        self.__model_scale = 1.0
+        self.__frame_offset = 6
+
+    def __toVMDFrames(self, frames):
+        return np.round(frames).astype(int) - self.__frame_offset
+
+    @staticmethod
+    def __boneInterpolation(x_axis, y_axis, z_axis, rotation):
+        """ Build 64 bytes of interpolation of a bone key from (x1, y1, x2, y2) of 4 channels.
+        """
+        base = [0] * 16
+        for channel, interp in enumerate((x_axis, y_axis, z_axis, rotation)):
+            for i in range(4):
+                base[channel + 4 * i] = int(interp[i])
+        return base + base[1:] + [1] + base[2:] + [1, 0] + base[3:] + [1, 0, 0]
+
+    def __exportBones(self, armObj):
+        boneAnim = vmd.BoneAnimation()
+        if armObj is None or armObj.animation_data is None:
+            return boneAnim
+
+        names = {}
+        for name, pose_bone in utils.makePmxBoneMap(armObj).items():
+            names[pose_bone.name] = name
+
+        rePath = re.compile(r'^pose\.bones\["(.+)"\]\.(location|rotation_quaternion)$')
+        channels = _channels(armObj.animation_data.action, rePath)
+        bone_channels = {}
+        for (bone_name, prop), c in channels.items():
+            bone_channels.setdefault(bone_name, {})[prop] = c
+
+        swap_yz = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0]])
+        for bone_name, props in bone_channels.items():
+            pose_bone = armObj.pose.bones.get(bone_name)
+            if pose_bone is None or pose_bone.is_mmd_shadow_bone:
+                continue
+            loc_channels = props.get('location', {})
+            rot_channels = props.get('rotation_quaternion', {})
+            frames = _unionFrames(list(loc_channels.values()) + list(rot_channels.values()))
+            vmd_frames = self.__toVMDFrames(frames)
+            valid = vmd_frames >= 0
+            if not np.any(valid):
+                continue
+
+            n = len(frames)
+            locations = np.zeros((3, n))
+            loc_interps = np.tile(_LINEAR_INTERP, (3, n, 1))
+            for i, c in loc_channels.items():
+                locations[i], loc_interps[i] = c.sample(frames)
+            rotations = np.zeros((4, n))
+            rotations[0] = 1.0
+            rot_interps = np.tile(_LINEAR_INTERP, (4, n, 1))
+            for i, c in rot_channels.items():
+                rotations[i], rot_interps[i] = c.sample(frames)
+
+            # invert VMDImporter.makeVMDBoneLocationToBlenderMatrix and convertVMDBoneRotationToBlender
+            axes = np.array(pose_bone.bone.matrix_local.to_3x3()).T
+            to_vmd_loc = np.linalg.inv(np.dot(axes, swap_yz))
+            vmd_locations = np.dot(to_vmd_loc, locations).T / self.__model_scale
+            u = np.dot(np.linalg.inv(axes), rotations[1:4])
+            vmd_rotations = np.stack([-u[0], -u[2], -u[1], rotations[0]], axis=1)
+            rot_interp = _largestChange(rotations, rot_interps)
+
+            keys = boneAnim[names.get(bone_name, bone_name)]
+            for i in np.flatnonzero(valid):
+                key = vmd.BoneFrameKey()
+                key.frame_number = int(vmd_frames[i])
+                key.location = vmd_locations[i].tolist()
+                key.rotation = vmd_rotations[i].tolist()
+                key.interp = self.__boneInterpolation(loc_interps[0, i], loc_interps[2, i], loc_interps[1, i], rot_interp[i])
+                keys.append(key)
+        return boneAnim
+
+    def __exportShapeKeys(self, meshes):
+        shapeKeyAnim = vmd.ShapeKeyAnimation()
+        rePath = re.compile(r'^key_blocks\["(.+)"\]\.value$')
+        for meshObj in meshes:
+            shape_keys = meshObj.data.shape_keys
+            if shape_keys is None or shape_keys.animation_data is None:
+                continue
+            for (name,), c in _channels(shape_keys.animation_data.action, rePath).items():
+                c = c[0]
+                vmd_frames = self.__toVMDFrames(c.frames)
+                keys = shapeKeyAnim[name]
+                for frame, weight in zip(vmd_frames.tolist(), c.values.tolist()):
+                    if frame < 0:
+                        continue
+                    key = vmd.ShapeKeyFrameKey()
+                    key.frame_number = frame
+                    key.weight = weight
+                    keys.append(key)
+        return shapeKeyAnim
+
+    def __exportCamera(self, cameraObj):
+        cameraAnim = vmd.CameraAnimation()
+        if cameraObj is None:
+            return cameraAnim
+        mmdCamera = mmd_camera.MMDCamera(cameraObj)
+        empty = mmdCamera.object()
+        camera = mmdCamera.camera()
+
+        rePath = re.compile(r'^(location|rotation_euler|mmd_camera\.angle)$')
+        channels = {}
+        if empty.animation_data is not None:
+            channels = _channels(empty.animation_data.action, rePath)
+        distance_channels = {}
+        if camera.animation_data is not None:
+            distance_channels = _channels(camera.animation_data.action, re.compile(r'^(location)$')).get(('location',), {})
+        loc_channels = channels.get(('location',), {})
+        rot_channels = channels.get(('rotation_euler',), {})
+        angle_channels = channels.get(('mmd_camera.angle',), {})
+        all_channels = list(loc_channels.values()) + list(rot_channels.values()) + list(angle_channels.values())
+        if 1 in distance_channels:
+            all_channels.append(distance_channels[1])
+        frames = _unionFrames(all_channels)
+        n = len(frames)
+        if n == 0:
+            return cameraAnim
+
+        def sample(channels, index, default):
+            if index in channels:
+                return channels[index].sample(frames)
+            return np.full(n, default, dtype=np.float64), np.tile(_LINEAR_INTERP, (n, 1))
+
+        locations = [sample(loc_channels, i, empty.location[i]) for i in range(3)]
+        rotations = [sample(rot_channels, i, empty.rotation_euler[i]) for i in range(3)]
+        angle = sample(angle_channels, 0, empty.mmd_camera.angle)
+        distance = sample(distance_channels, 1, camera.location[1])
+        rot_interp = _largestChange(np.array([r[0] for r in rotations]), np.array([r[1] for r in rotations]))
+
+        vmd_frames = self.__toVMDFrames(frames)
+        for i in np.flatnonzero(vmd_frames >= 0):
+            key = vmd.CameraKeyFrameKey()
+            key.frame_number = int(vmd_frames[i])
+            key.location = [locations[0][0][i] / self.__scale, locations[2][0][i] / self.__scale, locations[1][0][i] / self.__scale]
+            key.rotation = [rotations[0][0][i], rotations[2][0][i], rotations[1][0][i]]
+            key.distance = distance[0][i] / self.__scale
+            key.angle = int(round(math.degrees(angle[0][i])))
+            key.persp = empty.mmd_camera.is_perspective
+            interp = []
+            # (x1, x2, y1, y2) of X, Y, Z, rotation, distance and angle
+            for x1, y1, x2, y2 in (locations[0][1][i], locations[2][1][i], locations[1][1][i], rot_interp[i], distance[1][i], angle[1][i]):
+                interp.extend([int(x1), int(x2), int(y1), int(y2)])
+            key.interp = interp
+            cameraAnim.append(key)
+        return cameraAnim
+
+    def __exportLamp(self, lampObj):
+        lampAnim = vmd.LampAnimation()
+        if lampObj is None:
+            return lampAnim
+        mmdLamp = mmd_lamp.MMDLamp(lampObj).object()
+        lamp = None
+        armature = None
+        for obj in mmdLamp.children:
+            if obj.type == 'LAMP':
+                lamp = obj
+            elif obj.type == 'ARMATURE':
+                armature = obj
+        if lamp is None or armature is None:
+            return lampAnim
+
+        color_channels = {}
+        if lamp.data.animation_data is not None:
+            color_channels = _channels(lamp.data.animation_data.action, re.compile(r'^(color)$')).get(('color',), {})
+        bone = armature.pose.bones[0]
+        loc_channels = {}
+        if armature.animation_data is not None:
+            rePath = re.compile(r'^pose\.bones\["%s"\]\.(location)$'%re.escape(bone.name))
+            loc_channels = _channels(armature.animation_data.action, rePath).get(('location',), {})
+        frames = _unionFrames(list(color_channels.values()) + list(loc_channels.values()))
+        n = len(frames)
+        if n == 0:
+            return lampAnim
+
+        def sample(channels, index, default):
+            if index in channels:
+                return channels[index].sample(frames)[0]
+            return np.full(n, default, dtype=np.float64)
+
+        colors = np.stack([sample(color_channels, i, lamp.data.color[i]) for i in range(3)], axis=1)
+        locations = np.stack([sample(loc_channels, i, bone.location[i]) for i in range(3)], axis=1)
+        directions = -locations[:, [0, 2, 1]]
+
+        vmd_frames = self.__toVMDFrames(frames)
+        for i in np.flatnonzero(vmd_frames >= 0):
+            key = vmd.LampKeyFrameKey()
+            key.frame_number = int(vmd_frames[i])
+            key.color = colors[i].tolist()
+            key.direction = directions[i].tolist()
+            lampAnim.append(key)
+        return lampAnim
+
+    def export(self, **args):
+        """ Export animations to a VMD file.
+
+        Args:
+            filepath: the path of the VMD file
+            scale: the scale used on importing the camera and the lamp
+            model_name: the model name written in the header
+            model_scale: the scale of the model (defaults to scale)
+            frame_margin: the frame margin used on importing
+            armature: an armature object
+            meshes: mesh objects which have shape key animations
+            camera: a MMD camera object
+            lamp: a MMD lamp object
+        """
+        self.__scale = args.get('scale', 1.0)
+        self.__model_scale = args.get('model_scale', self.__scale)
+        self.__frame_offset = args.get('frame_margin', 5) + 1
+
+        vmdFile = vmd.File()
+        vmdFile.header = vmd.Header()
+        vmdFile.header.model_name = args.get('model_name', '')
+        vmdFile.boneAnimation = self.__exportBones(args.get('armature', None))
+        vmdFile.shapeKeyAnimation = self.__exportShapeKeys(args.get('meshes', []))
+        vmdFile.cameraAnimation = self.__exportCamera(args.get('camera', None))
+        vmdFile.lampAnimation = self.__exportLamp(args.get('lamp', None))
+        vmdFile.save(filepath=args['filepath'])
+
+        logging.info('Exported %d bone keys, %d shape keys, %d camera keys and %d lamp keys.',
+            sum(len(i) for i in vmdFile.boneAnimation.values()),
+            sum(len(i) for i in vmdFile.shapeKeyAnimation.values()),
+            len(vmdFile.cameraAnimation),
+            len(vmdFile.lampAnimation))
+
+
+def export(**args):
+    VMDExporter().export(**args)
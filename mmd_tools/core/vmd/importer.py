@@ -1,25 +1,133 @@
 # -*- coding: utf-8 -*-
 import mathutils
 import bpy
-import math
-import re
 import os
+import collections
+
+import numpy as np
 
 import mmd_tools.core.camera as mmd_camera
 import mmd_tools.core.lamp as mmd_lamp
 import mmd_tools.core.vmd as vmd
+from mmd_tools.core.vmd import reducer
 from mmd_tools import utils
 
+
+_RestAxes = collections.namedtuple('_RestAxes', 'x_axis y_axis z_axis')
+
+
+def _lastKeysOfFrames(frames):
+    """ Return indices of the last keys of each frame in the sorted frame array.
+
+     keyframe_insert overwrites a key of the same frame, so the last one wins.
+    """
+    frames = np.asarray(frames)
+    _, idx = np.unique(frames[::-1], return_index=True)
+    return len(frames) - 1 - idx
+
+
+def _getAction(id_data, action_name):
+    """ Return the action of id_data. A new action is created if action_name is given.
+    """
+    a = id_data.animation_data_create()
+    if action_name is not None or a.action is None:
+        a.action = bpy.data.actions.new(name=action_name or id_data.name)
+    return a.action
+
+
+def _newFCurve(action, data_path, index=0, group=''):
+    """ Create an empty F-curve. An existing F-curve of the same path is replaced.
+    """
+    fcurve = action.fcurves.find(data_path, index)
+    if fcurve is not None:
+        action.fcurves.remove(fcurve)
+    return action.fcurves.new(data_path=data_path, index=index, action_group=group)
+
+
+def _fillFCurve(fcurve, frames, values):
+    """ Add keyframe points of the frame and value arrays to an empty F-curve at once.
+    """
+    co = np.empty(len(frames) * 2, dtype=np.float32)
+    co[0::2] = frames
+    co[1::2] = values
+    fcurve.keyframe_points.add(len(frames))
+    fcurve.keyframe_points.foreach_set('co', co)
+    fcurve.update()
+
+
+def _setBezierInterpolation(fcurve, bezier, offset=0):
+    """ Set MMD interpolation curves to the segments of a filled F-curve.
+
+    Args:
+        fcurve: an F-curve of sorted keys
+        bezier: (segments, 4) array of (x1, y1, x2, y2) in 0-127 for each segment
+        offset: the index of the first key of the first segment
+    """
+    kps = fcurve.keyframe_points
+    count = len(kps)
+    if count < 2 + offset:
+        return
+    bezier = np.asarray(bezier, dtype=np.float64)
+    linear = (bezier[:, 0] == bezier[:, 1]) & (bezier[:, 2] == bezier[:, 3])
+    segments = np.flatnonzero(~linear) + offset
+    linear = np.flatnonzero(linear) + offset
+
+    # enum properties can't be set by foreach_set
+    for i in linear:
+        kps[int(i)].interpolation = 'LINEAR'
+    for i in segments:
+        kps[int(i)].interpolation = 'BEZIER'
+        kps[int(i)].handle_right_type = 'FREE'
+        kps[int(i)+1].handle_left_type = 'FREE'
+    if len(segments) == 0:
+        return
+
+    co = np.empty(count * 2, dtype=np.float32)
+    left = np.empty(count * 2, dtype=np.float32)
+    right = np.empty(count * 2, dtype=np.float32)
+    kps.foreach_get('co', co)
+    kps.foreach_get('handle_left', left)
+    kps.foreach_get('handle_right', right)
+    co, left, right = co.reshape(-1, 2), left.reshape(-1, 2), right.reshape(-1, 2)
+    d = (co[segments + 1] - co[segments]) / 127.0
+    right[segments] = co[segments] + d * bezier[segments - offset][:, [0, 1]]
+    left[segments + 1] = co[segments] + d * bezier[segments - offset][:, [2, 3]]
+    kps.foreach_set('handle_left', left.ravel())
+    kps.foreach_set('handle_right', right.ravel())
+
+
+def _setCutInterpolation(fcurve, threshold):
+    """ Set CONSTANT interpolation to keys whose value jumps more than the threshold within one frame.
+    """
+    kps = fcurve.keyframe_points
+    co = np.empty(len(kps) * 2, dtype=np.float32)
+    kps.foreach_get('co', co)
+    co = co.reshape(-1, 2)
+    order = np.argsort(co[:, 0])
+    diff = np.diff(co[order], axis=0)
+    cuts = (diff[:, 0] <= 1.0) & (np.abs(diff[:, 1]) > threshold)
+    for i in order[:-1][cuts]:
+        kps[int(i)].interpolation = 'CONSTANT'
+
+
 class VMDImporter:
-    def __init__(self, filepath, scale=1.0, use_pmx_bonename=True, convert_mmd_camera=True, convert_mmd_lamp=True, frame_margin=5):
+    def __init__(self, filepath, scale=1.0, use_pmx_bonename=True, convert_mmd_camera=True, convert_mmd_lamp=True, frame_margin=5,
+                 reduce_keyframes=False, location_tolerance=0.005, rotation_tolerance=0.005, weight_tolerance=0.005):
         self.__vmdFile = vmd.File()
         self.__vmdFile.load(filepath=filepath)
+        if reduce_keyframes:
+            reducer.reduceKeyFrames(self.__vmdFile, location_tolerance, rotation_tolerance, weight_tolerance)
         self.__scale = scale
         self.__convert_mmd_camera = convert_mmd_camera
         self.__convert_mmd_lamp = convert_mmd_lamp
         self.__use_pmx_bonename = use_pmx_bonename
         self.__frame_margin = frame_margin + 1
+        self.__bone_tracks = {}
 
+        for keyFrames in self.__vmdFile.boneAnimation.values():
+            keyFrames.sort(key=lambda x:x.frame_number)
+        for keyFrames in self.__vmdFile.shapeKeyAnimation.values():
+            keyFrames.sort(key=lambda x:x.frame_number)
 
     @staticmethod
     def makeVMDBoneLocationToBlenderMatrix(blender_bone):
@@ -74,89 +182,108 @@ class VMDImporter:
         return res
 
     @staticmethod
-    def __setInterpolation(bezier, kp0, kp1):
-        if bezier[0] == bezier[1] and bezier[2] == bezier[3]:
-            kp0.interpolation = 'LINEAR'
-        else:
-            kp0.interpolation = 'BEZIER'
-            kp0.handle_right_type = 'FREE'
-            kp1.handle_left_type = 'FREE'
-            d = (kp1.co - kp0.co) / 127.0
-            kp0.handle_right = kp0.co + mathutils.Vector((d.x * bezier[0], d.y * bezier[1]))
-            kp1.handle_left = kp0.co + mathutils.Vector((d.x * bezier[2], d.y * bezier[3]))
-
-    def __assignToArmature(self, armObj, action_name=None):
-        if action_name is not None:
-            act = bpy.data.actions.new(name=action_name)
-            a = armObj.animation_data_create()
-            a.action = act
-
-        if self.__frame_margin > 1:
-            utils.selectAObject(armObj)
-            bpy.context.scene.frame_current = 1
-            bpy.ops.object.mode_set(mode='POSE')
-            hiddenBones = []
-            for i in armObj.data.bones:
-                if i.hide:
-                    hiddenBones.append(i)
-                    i.hide = False
-                i.select = True
-            bpy.ops.pose.transforms_clear()
-            bpy.ops.anim.keyframe_insert_menu(type='LocRotScale', confirm_success=False, always_prompt=False)
-            bpy.ops.object.mode_set(mode='OBJECT')
-            for i in hiddenBones:
-                i.hide = True
-            
+    def __restAxes(pose_bone):
+        mat = pose_bone.bone.matrix_local.to_3x3()
+        return _RestAxes(mat.col[0], mat.col[1], mat.col[2])
+
+    def __boneTracks(self, armObj):
+        """ Return (signature, tracks) of the armature.
+
+         Each track is a tuple of arrays (bone name, frames, locations, rotations, interpolations),
+         and the frames are unique VMD frame numbers.
+         The converted values only depend on the bone names and the rest axes,
+         so they are computed once for each signature and shared by identical rigs.
+        """
         boneAnim = self.__vmdFile.boneAnimation
 
         pose_bones = armObj.pose.bones
         if self.__use_pmx_bonename:
             pose_bones = utils.makePmxBoneMap(armObj)
-        for name, keyFrames in boneAnim.items():
+        matched = []
+        for name in sorted(boneAnim.keys()):
             if name not in pose_bones:
                 print("WARNING: not found bone %s"%str(name))
                 continue
-
-            keyFrames.sort(key=lambda x:x.frame_number)
             bone = pose_bones[name]
-            frameNumbers = map(lambda x: x.frame_number, keyFrames)
-            mat = self.makeVMDBoneLocationToBlenderMatrix(bone)
-            locations = map(lambda x: mat * mathutils.Vector(x.location) * self.__scale, keyFrames)
-            rotations = map(lambda x: self.convertVMDBoneRotationToBlender(bone, x.rotation), keyFrames)
-            rotations = self.__fixRotations(rotations)
-
-            for frame, location, rotation in zip(frameNumbers, locations, rotations):
-                bone.location = location
-                bone.rotation_quaternion = rotation
-                bone.keyframe_insert(data_path='location',
-                                     group=name,
-                                     frame=frame+self.__frame_margin)
-                bone.keyframe_insert(data_path='rotation_quaternion',
-                                     group=name,
-                                     frame=frame+self.__frame_margin)
-
-        rePath = re.compile(r'^pose\.bones\["(.+)"\]\.([a-z_]+)$')
-        for fcurve in act.fcurves:
-            m = rePath.match(fcurve.data_path)
-            if m and m.group(2) in ['location', 'rotation_quaternion']:
-                bone = armObj.pose.bones[m.group(1)]
-                keyFrames = boneAnim[bone.get('name_j', bone.name)]
-                if m.group(2) == 'location':
-                    idx = [0, 2, 1][fcurve.array_index]
-                else:
-                    idx = 3
-                frames = list(fcurve.keyframe_points)
-                frames.sort(key=lambda kp:kp.co.x)
-                if self.__frame_margin > 1:
-                    del frames[0]
-                for i in range(1, len(keyFrames)):
-                    self.__setInterpolation(keyFrames[i].interp[idx:16:4], frames[i - 1], frames[i])
+            matched.append((name, bone.name, self.__restAxes(bone)))
+
+        signature = tuple((name, bone_name, tuple(round(v, 5) for axis in axes for v in axis)) for name, bone_name, axes in matched)
+        tracks = self.__bone_tracks.get(signature, None)
+        if tracks is None:
+            tracks = []
+            for name, bone_name, axes in matched:
+                keyFrames = boneAnim[name]
+                if len(keyFrames) == 0:
+                    continue
+                mat = self.makeVMDBoneLocationToBlenderMatrix(axes)
+                locations = [mat * mathutils.Vector(x.location) * self.__scale for x in keyFrames]
+                rotations = self.__fixRotations(self.convertVMDBoneRotationToBlender(axes, x.rotation) for x in keyFrames)
+                frames = np.array([x.frame_number for x in keyFrames], dtype=np.float64)
+                idx = _lastKeysOfFrames(frames)
+                tracks.append((
+                    bone_name,
+                    frames[idx],
+                    np.array(locations, dtype=np.float64)[idx],
+                    np.array(rotations, dtype=np.float64)[idx],
+                    np.array([x.interp for x in keyFrames], dtype=np.float64)[idx],
+                    ))
+            self.__bone_tracks[signature] = tracks
+        return signature, tracks
+
+    def __assignToArmature(self, armObj, action_name=None, tracks=None):
+        act = _getAction(armObj, action_name)
+
+        if tracks is None:
+            signature, tracks = self.__boneTracks(armObj)
+
+        # the rest pose is keyed at frame 1 when there is a margin
+        use_rest_key = self.__frame_margin > 1
+        rest_frame = np.array([1.0])
+
+        animated = set()
+        for bone_name, frames, locations, rotations, interps in tracks:
+            animated.add(bone_name)
+            bone = armObj.pose.bones[bone_name]
+            frames = frames + self.__frame_margin
+            offset = 0
+            if use_rest_key:
+                frames = np.concatenate((rest_frame, frames))
+                locations = np.concatenate(([[0.0, 0.0, 0.0]], locations))
+                rotations = np.concatenate(([[1.0, 0.0, 0.0, 0.0]], rotations))
+                offset = 1
+
+            data_path = bone.path_from_id('location')
+            for i in range(3):
+                fcurve = _newFCurve(act, data_path, i, bone_name)
+                _fillFCurve(fcurve, frames, locations[:, i])
+                channel = [0, 2, 1][i]
+                _setBezierInterpolation(fcurve, interps[1:, channel:16:4], offset)
+
+            data_path = bone.path_from_id('rotation_quaternion')
+            for i in range(4):
+                fcurve = _newFCurve(act, data_path, i, bone_name)
+                _fillFCurve(fcurve, frames, rotations[:, i])
+                _setBezierInterpolation(fcurve, interps[1:, 3:16:4], offset)
+
+        if use_rest_key:
+            for bone in armObj.pose.bones:
+                channels = [('scale', (1.0, 1.0, 1.0))]
+                if bone.name not in animated:
+                    channels.append(('location', (0.0, 0.0, 0.0)))
+                    if bone.rotation_mode == 'QUATERNION':
+                        channels.append(('rotation_quaternion', (1.0, 0.0, 0.0, 0.0)))
+                    elif bone.rotation_mode == 'AXIS_ANGLE':
+                        channels.append(('rotation_axis_angle', (0.0, 0.0, 1.0, 0.0)))
+                    else:
+                        channels.append(('rotation_euler', (0.0, 0.0, 0.0)))
+                for prop, values in channels:
+                    data_path = bone.path_from_id(prop)
+                    for i, value in enumerate(values):
+                        fcurve = _newFCurve(act, data_path, i, bone.name)
+                        _fillFCurve(fcurve, rest_frame, [value])
 
     def __assignToMesh(self, meshObj, action_name=None):
-        if action_name is not None:
-            act = bpy.data.actions.new(name=action_name)
-            a = meshObj.data.shape_keys.animation_data_create()
-            a.action = act
+        act = _getAction(meshObj.data.shape_keys, action_name)
 
         shapeKeyAnim = self.__vmdFile.shapeKeyAnimation
 
@@ -168,76 +295,64 @@ class VMDImporter:
             if name not in shapeKeyDict:
                 print("WARNING: not found shape key %s"%str(name))
                 continue
-            shapeKey = shapeKeyDict[name]
-            for i in keyFrames:
-                shapeKey.value = i.weight
-                shapeKey.keyframe_insert(data_path='value',
-                                         group=name,
-                                         frame=i.frame_number+self.__frame_margin)
+            if len(keyFrames) == 0:
+                continue
+            fcurve = _newFCurve(act, shapeKeyDict[name].path_from_id('value'), group=name)
+
+            frames = np.array([i.frame_number for i in keyFrames], dtype=np.float64)
+            weights = np.array([i.weight for i in keyFrames], dtype=np.float64)
+            idx = _lastKeysOfFrames(frames)
+            _fillFCurve(fcurve, frames[idx] + self.__frame_margin, weights[idx])
 
     @staticmethod
     def detectCameraChange(fcurve, threshold=10.0):
-        frames = list(fcurve.keyframe_points)
-        frameCount = len(frames)
-        frames.sort(key=lambda x:x.co[0])
-        for i, f in enumerate(frames):
-            if i+1 < frameCount:
-                n = frames[i+1]
-                if n.co[0] - f.co[0] <= 1.0 and abs(f.co[1] - n.co[1]) > threshold:
-                    f.interpolation = 'CONSTANT'
+        _setCutInterpolation(fcurve, threshold)
 
     def __assignToCamera(self, cameraObj, action_name=None):
         mmdCameraInstance = mmd_camera.MMDCamera.convertToMMDCamera(cameraObj)
         mmdCamera = mmdCameraInstance.object()
-        if action_name is not None:
-            act = bpy.data.actions.new(name=action_name)
-            a = mmdCamera.animation_data_create()
-            a.action = act
-
         cameraObj = mmdCameraInstance.camera()
+        act = _getAction(mmdCamera, action_name)
+        distance_act = _getAction(cameraObj, None if action_name is None else action_name + '_distance')
+
         cameraAnim = self.__vmdFile.cameraAnimation
         cameraAnim.sort(key=lambda x:x.frame_number)
-        for keyFrame in cameraAnim:
-            mmdCamera.mmd_camera.angle = math.radians(keyFrame.angle)
-            cameraObj.location[1] = keyFrame.distance * self.__scale
-            mmdCamera.location = mathutils.Vector((keyFrame.location[0], keyFrame.location[2], keyFrame.location[1])) * self.__scale
-            mmdCamera.rotation_euler = mathutils.Vector((keyFrame.rotation[0], keyFrame.rotation[2], keyFrame.rotation[1]))
-            mmdCamera.keyframe_insert(data_path='mmd_camera.angle',
-                                           frame=keyFrame.frame_number+self.__frame_margin)
-            cameraObj.keyframe_insert(data_path='location', index=1,
-                                      frame=keyFrame.frame_number+self.__frame_margin)
-            mmdCamera.keyframe_insert(data_path='location',
-                                      frame=keyFrame.frame_number+self.__frame_margin)
-            mmdCamera.keyframe_insert(data_path='rotation_euler',
-                                      frame=keyFrame.frame_number+self.__frame_margin)
-
-        paths = ['rotation_euler', 'mmd_camera.angle', 'location']
-        for fcurve in act.fcurves:
-            if fcurve.data_path in paths:
-                if fcurve.data_path =='location':
-                    idx = [0, 2, 1][fcurve.array_index] * 4
-                else:
-                    idx = (paths.index(fcurve.data_path) + 3) * 4
-                frames = list(fcurve.keyframe_points)
-                frames.sort(key=lambda kp:kp.co.x)
-                for i in range(1, len(cameraAnim)):
-                    interp = cameraAnim[i].interp
-                    self.__setInterpolation([interp[idx + j] for j in [0, 2, 1, 3]], frames[i - 1], frames[i])
-
-        for fcurve in mmdCamera.animation_data.action.fcurves:
-            if fcurve.data_path == 'rotation_euler':
+        if len(cameraAnim) == 0:
+            return
+
+        frames = np.array([k.frame_number for k in cameraAnim], dtype=np.float64)
+        idx = _lastKeysOfFrames(frames)
+        frames = frames[idx] + self.__frame_margin
+        locations = np.array([k.location for k in cameraAnim], dtype=np.float64)[idx] * self.__scale
+        rotations = np.array([k.rotation for k in cameraAnim], dtype=np.float64)[idx]
+        distances = np.array([k.distance for k in cameraAnim], dtype=np.float64)[idx] * self.__scale
+        angles = np.radians(np.array([k.angle for k in cameraAnim], dtype=np.float64)[idx])
+        # the interpolation of camera keys has 6 channels of (x1, x2, y1, y2):
+        # X, Y, Z, rotation, distance and angle
+        interps = np.array([k.interp for k in cameraAnim], dtype=np.float64)[idx].reshape(-1, 6, 4)[:, :, [0, 2, 1, 3]]
+
+        group = 'Object Transforms'
+        channels = [
+            # (action, data path, index, group, values, interpolation channel)
+            (act, 'location', 0, group, locations[:, 0], 0),
+            (act, 'location', 1, group, locations[:, 2], 2),
+            (act, 'location', 2, group, locations[:, 1], 1),
+            (act, 'rotation_euler', 0, group, rotations[:, 0], 3),
+            (act, 'rotation_euler', 1, group, rotations[:, 2], 3),
+            (act, 'rotation_euler', 2, group, rotations[:, 1], 3),
+            (act, 'mmd_camera.angle', 0, '', angles, 5),
+            (distance_act, 'location', 1, group, distances, 4),
+            ]
+        for action, data_path, index, group, values, channel in channels:
+            fcurve = _newFCurve(action, data_path, index, group)
+            _fillFCurve(fcurve, frames, values)
+            _setBezierInterpolation(fcurve, interps[1:, channel])
+            if action == act and data_path == 'rotation_euler':
                 self.detectCameraChange(fcurve)
 
     @staticmethod
     def detectLampChange(fcurve, threshold=0.1):
-        frames = list(fcurve.keyframe_points)
-        frameCount = len(frames)
-        frames.sort(key=lambda x:x.co[0])
-        for i, f in enumerate(frames):
-            if i+1 < frameCount:
-                n = frames[i+1]
-                if n.co[0] - f.co[0] <= 1.0 and abs(f.co[1] - n.co[1]) > threshold:
-                    f.interpolation = 'CONSTANT'
+        _setCutInterpolation(fcurve, threshold)
 
     def __assignToLamp(self, lampObj, action_name=None):
         mmdLamp = mmd_lamp.MMDLamp.convertToMMDLamp(lampObj).object()
@@ -250,28 +365,27 @@ class VMDImporter:
                 bone = armature.pose.bones[0]
                 bone_data_path = 'pose.bones["' + bone.name + '"].location'
 
-        if action_name is not None:
-            act = bpy.data.actions.new(name=action_name + '_color')
-            a = lamp.data.animation_data_create()
-            a.action = act
-            act = bpy.data.actions.new(name=action_name + '_location')
-            a = armature.animation_data_create()
-            a.action = act
+        color_act = _getAction(lamp.data, None if action_name is None else action_name + '_color')
+        location_act = _getAction(armature, None if action_name is None else action_name + '_location')
 
         lampAnim = self.__vmdFile.lampAnimation
-        for keyFrame in lampAnim:
-            lamp.data.color = mathutils.Vector(keyFrame.color)
-            bone.location = -(mathutils.Vector((keyFrame.direction[0], keyFrame.direction[2], keyFrame.direction[1])))
-            lamp.data.keyframe_insert(data_path='color',
-                                      frame=keyFrame.frame_number+self.__frame_margin)
-            bone.keyframe_insert(data_path='location',
-                                 frame=keyFrame.frame_number+self.__frame_margin)
-
-        for fcurve in armature.animation_data.action.fcurves:
-            if fcurve.data_path == bone_data_path:
-                self.detectLampChange(fcurve)
-
-
+        lampAnim.sort(key=lambda x:x.frame_number)
+        if len(lampAnim) == 0:
+            return
+
+        frames = np.array([k.frame_number for k in lampAnim], dtype=np.float64)
+        idx = _lastKeysOfFrames(frames)
+        frames = frames[idx] + self.__frame_margin
+        colors = np.array([k.color for k in lampAnim], dtype=np.float64)[idx]
+        locations = -np.array([k.direction for k in lampAnim], dtype=np.float64)[idx][:, [0, 2, 1]]
+
+        for i in range(3):
+            fcurve = _newFCurve(color_act, 'color', i)
+            _fillFCurve(fcurve, frames, colors[:, i])
+        for i in range(3):
+            fcurve = _newFCurve(location_act, bone_data_path, i, bone.name)
+            _fillFCurve(fcurve, frames, locations[:, i])
+            self.detectLampChange(fcurve)
 
     def assign(self, obj, action_name=None):
         if action_name is None:
@@ -294,3 +408,41 @@ class VMDImporter:
         else:
             pass
 
+    def assignMany(self, objects, action_name=None):
+        """ Assign the motion to many objects at once.
+
+         Armatures which have the same bones, rotation modes and rest axes of animated bones
+         share one action, and meshes which have the same animated shape keys share one action.
+         Cameras and lamps are assigned one by one.
+        """
+        if action_name is None:
+            action_name = os.path.splitext(os.path.basename(self.__vmdFile.filepath))[0]
+
+        shapeKeyAnim = self.__vmdFile.shapeKeyAnimation
+        armature_actions = {}
+        mesh_actions = {}
+        for obj in objects:
+            if obj.type == 'ARMATURE' and not mmd_camera.MMDCamera.isMMDCamera(obj) and not mmd_lamp.MMDLamp.isMMDLamp(obj):
+                signature, tracks = self.__boneTracks(obj)
+                # the action has rest keys of all bones in their rotation modes
+                signature = (signature, tuple((b.name, b.rotation_mode) for b in obj.pose.bones))
+                act = armature_actions.get(signature, None)
+                if act is None:
+                    self.__assignToArmature(obj, action_name+'_bone', tracks)
+                    armature_actions[signature] = obj.animation_data.action
+                else:
+                    obj.animation_data_create().action = act
+            elif obj.type == 'MESH' and not mmd_camera.MMDCamera.isMMDCamera(obj) and not mmd_lamp.MMDLamp.isMMDLamp(obj):
+                shape_keys = obj.data.shape_keys
+                if shape_keys is None:
+                    continue
+                signature = tuple(sorted(i.name for i in shape_keys.key_blocks if i.name in shapeKeyAnim))
+                act = mesh_actions.get(signature, None)
+                if act is None:
+                    self.__assignToMesh(obj, action_name+'_facial')
+                    mesh_actions[signature] = shape_keys.animation_data.action
+                else:
+                    shape_keys.animation_data_create().action = act
+            else:
+                self.assign(obj, action_name)
+
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+""" Evaluate interpolation curves of VMD motions with numpy.
+
+ An interpolation curve of MMD is a cubic Bezier curve from (0, 0) to (1, 1)
+ with two control points (x1, y1) and (x2, y2) in the range of 0-127.
+ It maps the elapsed fraction of frames between two keys to the progress of the value.
+
+ Tracks of vmd.File can be evaluated at arbitrary frames without Blender.
+"""
+import numpy as np
+
+
+def bezierProgress(x1, y1, x2, y2, s, iterations=24):
+    """ Calculate the progress of MMD interpolation curves.
+
+     x(t) of the curve is monotonic, so t is solved by bisection for all samples at once.
+
+    Args:
+        x1, y1, x2, y2: control points (0-127). arrays which are broadcastable to s.
+        s: elapsed fractions of frames (0.0-1.0)
+
+    Returns:
+        numpy array of the progress.
+    """
+    x1, y1, x2, y2 = [np.asarray(i, dtype=np.float64) / 127.0 for i in (x1, y1, x2, y2)]
+    s = np.clip(np.asarray(s, dtype=np.float64), 0.0, 1.0)
+    x1, y1, x2, y2, s = np.broadcast_arrays(x1, y1, x2, y2, s)
+
+    lo = np.zeros(s.shape)
+    hi = np.ones(s.shape)
+    for i in range(iterations):
+        t = (lo + hi) * 0.5
+        u = 1.0 - t
+        x = 3*u*u*t*x1 + 3*u*t*t*x2 + t*t*t
+        greater = x > s
+        hi = np.where(greater, t, hi)
+        lo = np.where(greater, lo, t)
+    t = np.where(s <= 0.0, 0.0, np.where(s >= 1.0, 1.0, (lo + hi) * 0.5))
+    u = 1.0 - t
+    return 3*u*u*t*y1 + 3*u*t*t*y2 + t*t*t
+
+
+def slerp(q0, q1, p):
+    """ Spherical linear interpolation of quaternions.
+
+    Args:
+        q0, q1: (..., 4) arrays of quaternions
+        p: (...) array of the progress
+
+    Returns:
+        (..., 4) array of normalized quaternions.
+    """
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    p = np.asarray(p, dtype=np.float64)[..., np.newaxis]
+    dot = np.sum(q0 * q1, axis=-1)[..., np.newaxis]
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    near = sin_theta < 1e-6
+    safe = np.where(near, 1.0, sin_theta)
+    w0 = np.where(near, 1.0 - p, np.sin((1.0 - p) * theta) / safe)
+    w1 = np.where(near, p, np.sin(p * theta) / safe)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=-1)[..., np.newaxis]
+
+
+def quaternionAngle(q0, q1):
+    """ Return the rotation angles between quaternions in radians.
+    """
+    dot = np.abs(np.sum(np.asarray(q0) * np.asarray(q1), axis=-1))
+    dot /= np.linalg.norm(q0, axis=-1) * np.linalg.norm(q1, axis=-1)
+    return 2.0 * np.arccos(np.clip(dot, -1.0, 1.0))
+
+
+def boneBezier(interps, channel):
+    """ Return (x1, y1, x2, y2) arrays of a channel of bone interpolations.
+
+    Args:
+        interps: (keys, 64) array of BoneFrameKey.interp
+        channel: 0-3 for X, Y, Z and rotation
+    """
+    interps = np.asarray(interps, dtype=np.float64)
+    return tuple(interps[:, channel + i] for i in range(0, 16, 4))
+
+
+def cameraBezier(interps, channel):
+    """ Return (x1, y1, x2, y2) arrays of a channel of camera interpolations.
+
+    Args:
+        interps: (keys, 24) array of CameraKeyFrameKey.interp
+        channel: 0-5 for X, Y, Z, rotation, distance and angle
+    """
+    interps = np.asarray(interps, dtype=np.float64)
+    return tuple(interps[:, channel*4 + i] for i in (0, 2, 1, 3))
+
+
+def sortedKeys(keyFrames):
+    """ Sort key frames by frame number. If a frame has several keys, the last one is kept.
+    """
+    keyFrames = list(keyFrames)
+    frames = np.array([k.frame_number for k in keyFrames], dtype=np.float64)
+    order = np.argsort(frames, kind='mergesort')
+    frames = frames[order]
+    last = np.ones(len(frames), dtype=bool)
+    last[:-1] = frames[1:] != frames[:-1]
+    return [keyFrames[i] for i in order[last]]
+
+
+def segments(key_frames, frames):
+    """ Find the segment of sorted keys for each frame.
+
+    Returns:
+        (a, b, s): indices of the keys before and after each frame, and the elapsed fractions.
+        Frames out of the range of keys are clamped to the first or the last key.
+    """
+    key_frames = np.asarray(key_frames, dtype=np.float64)
+    frames = np.asarray(frames, dtype=np.float64)
+    if len(key_frames) < 2:
+        zeros = np.zeros(frames.shape, dtype=int)
+        return zeros, zeros, np.zeros(frames.shape)
+    b = np.clip(np.searchsorted(key_frames, frames, side='right'), 1, len(key_frames) - 1)
+    a = b - 1
+    length = key_frames[b] - key_frames[a]
+    s = np.where(length > 0, (frames - key_frames[a]) / np.maximum(length, 1e-6), 1.0)
+    return a, b, np.clip(s, 0.0, 1.0)
+
+
+def evaluateScalarTrack(key_frames, values, frames, bezier=None):
+    """ Evaluate a scalar track at arbitrary frames.
+
+    Args:
+        key_frames: sorted frame numbers of keys
+        values: values of keys
+        frames: frames to evaluate
+        bezier: (x1, y1, x2, y2) arrays of keys, or None for linear interpolation.
+            The curve of a key is used for the segment which ends at the key.
+
+    Returns:
+        numpy array of values.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    a, b, s = segments(key_frames, frames)
+    if bezier is not None:
+        x1, y1, x2, y2 = [np.asarray(i, dtype=np.float64)[b] for i in bezier]
+        s = bezierProgress(x1, y1, x2, y2, s)
+    return values[a] + (values[b] - values[a]) * s
+
+
+def evaluateBoneTrack(keyFrames, frames):
+    """ Evaluate a bone track at arbitrary frames.
+
+    Args:
+        keyFrames: a list of vmd.BoneFrameKey
+        frames: frames to evaluate
+
+    Returns:
+        (locations, rotations): (frames, 3) array and (frames, 4) array of (x, y, z, w) in MMD coordinates.
+    """
+    keyFrames = sortedKeys(keyFrames)
+    key_frames = np.array([k.frame_number for k in keyFrames], dtype=np.float64)
+    locations = np.array([k.location for k in keyFrames], dtype=np.float64)
+    rotations = np.array([k.rotation for k in keyFrames], dtype=np.float64)
+    interps = np.array([k.interp for k in keyFrames], dtype=np.float64)
+
+    loc = np.column_stack([evaluateScalarTrack(key_frames, locations[:, i], frames, boneBezier(interps, i)) for i in range(3)])
+    a, b, s = segments(key_frames, frames)
+    x1, y1, x2, y2 = [i[b] for i in boneBezier(interps, 3)]
+    rot = slerp(rotations[a], rotations[b], bezierProgress(x1, y1, x2, y2, s))
+    return loc, rot
+
+
+def evaluateShapeKeyTrack(keyFrames, frames):
+    """ Evaluate a shape key track of vmd.ShapeKeyFrameKey at arbitrary frames. Shape keys are interpolated linearly.
+    """
+    keyFrames = sortedKeys(keyFrames)
+    key_frames = [k.frame_number for k in keyFrames]
+    return evaluateScalarTrack(key_frames, [k.weight for k in keyFrames], frames)
+
+
+def evaluateCameraTrack(keyFrames, frames):
+    """ Evaluate a camera track of vmd.CameraKeyFrameKey at arbitrary frames.
+
+    Returns:
+        A dict of arrays: 'location' (frames, 3), 'rotation' (frames, 3), 'distance' and 'angle'.
+        Values are in MMD coordinates and the angle is in degrees.
+    """
+    keyFrames = sortedKeys(keyFrames)
+    key_frames = np.array([k.frame_number for k in keyFrames], dtype=np.float64)
+    locations = np.array([k.location for k in keyFrames], dtype=np.float64)
+    rotations = np.array([k.rotation for k in keyFrames], dtype=np.float64)
+    interps = np.array([k.interp for k in keyFrames], dtype=np.float64)
+
+    def track(values, channel):
+        return evaluateScalarTrack(key_frames, values, frames, cameraBezier(interps, channel))
+
+    return {
+        'location': np.column_stack([track(locations[:, i], i) for i in range(3)]),
+        'rotation': np.column_stack([track(rotations[:, i], 3) for i in range(3)]),
+        'distance': track([k.distance for k in keyFrames], 4),
+        'angle': track([k.angle for k in keyFrames], 5),
+        }
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+""" Remove redundant keys of VMD motions.
+
+ A key is redundant if the interpolation curve between its neighbouring keys
+ reproduces the key within the tolerance.
+"""
+import logging
+
+import numpy as np
+
+from mmd_tools.core.vmd.interpolation import bezierProgress, slerp, quaternionAngle
+
+
+def _reduce(frames, isBad):
+    """ Find keys to keep.
+
+     Every other kept key is removed at once, then all original keys are checked
+     against the new segments and the removed keys of bad segments are restored.
+     Because removed keys are not adjacent, each new segment has exactly one removed key.
+     This repeats until no more keys can be removed.
+
+    Args:
+        frames: sorted frame numbers of keys
+        isBad: function(a, b, j) which returns a boolean array of keys j
+            which are not reproduced by the segments from keys a to keys b.
+
+    Returns:
+        boolean array of keys to keep.
+    """
+    n = len(frames)
+    keep = np.ones(n, dtype=bool)
+    if n < 3:
+        return keep
+
+    indices = np.arange(n)
+    parity = 0
+    failures = 0
+    while failures < 2:
+        kept = np.flatnonzero(keep)
+        candidates = kept[1+parity:-1:2]
+        parity ^= 1
+        if len(candidates) == 0:
+            failures += 1
+            continue
+
+        keep[candidates] = False
+        kept = np.flatnonzero(keep)
+        seg = np.clip(np.searchsorted(kept, indices, side='right') - 1, 0, len(kept) - 2)
+        bad = isBad(kept[seg], kept[seg + 1], indices)
+        bad_segs = np.zeros(len(kept) - 1, dtype=bool)
+        bad_segs[seg[bad]] = True
+        candidate_segs = np.searchsorted(kept, candidates, side='right') - 1
+        restore = candidates[bad_segs[candidate_segs]]
+        keep[restore] = True
+
+        if len(restore) == len(candidates):
+            failures += 1
+        else:
+            failures = 0
+    return keep
+
+
+def _fractions(frames, a, b, j):
+    length = frames[b] - frames[a]
+    return np.where(length > 0, (frames[j] - frames[a]) / np.maximum(length, 1e-6), 1.0)
+
+
+def reduceBoneKeyFrames(keyFrames, location_tolerance, rotation_tolerance):
+    """ Remove redundant keys of a bone track.
+
+    Args:
+        keyFrames: a list of vmd.BoneFrameKey. It is sorted and reduced in place.
+        location_tolerance: the max error of each location component in MMD units
+        rotation_tolerance: the max error of rotation in radians
+    """
+    keyFrames.sort(key=lambda x:x.frame_number)
+    if len(keyFrames) < 3:
+        return
+
+    frames = np.array([k.frame_number for k in keyFrames], dtype=np.float64)
+    locations = np.array([k.location for k in keyFrames], dtype=np.float64)
+    rotations = np.array([k.rotation for k in keyFrames], dtype=np.float64)
+    interps = np.array([k.interp for k in keyFrames], dtype=np.float64)
+
+    def isBad(a, b, j):
+        s = _fractions(frames, a, b, j)
+        ib = interps[b]
+        bad = np.zeros(len(j), dtype=bool)
+        for axis in range(3):
+            p = bezierProgress(ib[:, axis], ib[:, axis+4], ib[:, axis+8], ib[:, axis+12], s)
+            loc = locations[a, axis] + (locations[b, axis] - locations[a, axis]) * p
+            bad |= np.abs(loc - locations[j, axis]) > location_tolerance
+        p = bezierProgress(ib[:, 3], ib[:, 7], ib[:, 11], ib[:, 15], s)
+        rot = slerp(rotations[a], rotations[b], p)
+        bad |= quaternionAngle(rot, rotations[j]) > rotation_tolerance
+        return bad
+
+    keep = _reduce(frames, isBad)
+    keyFrames[:] = [k for k, i in zip(keyFrames, keep) if i]
+
+
+def reduceShapeKeyKeyFrames(keyFrames, weight_tolerance):
+    """ Remove redundant keys of a shape key track. Shape keys are interpolated linearly.
+
+    Args:
+        keyFrames: a list of vmd.ShapeKeyFrameKey. It is sorted and reduced in place.
+        weight_tolerance: the max error of weight
+    """
+    keyFrames.sort(key=lambda x:x.frame_number)
+    if len(keyFrames) < 3:
+        return
+
+    frames = np.array([k.frame_number for k in keyFrames], dtype=np.float64)
+    weights = np.array([k.weight for k in keyFrames], dtype=np.float64)
+
+    def isBad(a, b, j):
+        s = _fractions(frames, a, b, j)
+        w = weights[a] + (weights[b] - weights[a]) * s
+        return np.abs(w - weights[j]) > weight_tolerance
+
+    keep = _reduce(frames, isBad)
+    keyFrames[:] = [k for k, i in zip(keyFrames, keep) if i]
+
+
+def reduceKeyFrames(vmdFile, location_tolerance=0.005, rotation_tolerance=0.005, weight_tolerance=0.005):
+    """ Remove redundant keys of all bone and shape key tracks of a vmd.File.
+
+    Returns:
+        A tuple of (key count before, key count after).
+    """
+    before = 0
+    after = 0
+    for keyFrames in vmdFile.boneAnimation.values():
+        before += len(keyFrames)
+        reduceBoneKeyFrames(keyFrames, location_tolerance, rotation_tolerance)
+        after += len(keyFrames)
+    for keyFrames in vmdFile.shapeKeyAnimation.values():
+        before += len(keyFrames)
+        reduceShapeKeyKeyFrames(keyFrames, weight_tolerance)
+        after += len(keyFrames)
+    logging.info('Reduced keyframes: %d -> %d', before, after)
+    return (before, after)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import logging
 import re
 import traceback
@@ -14,6 +15,9 @@ import mmd_tools.core.pmd.importer as pmd_importer
 import mmd_tools.core.pmx.importer as pmx_importer
 import mmd_tools.core.pmx.exporter as pmx_exporter
 import mmd_tools.core.vmd.importer as vmd_importer
+import mmd_tools.core.vmd.exporter as vmd_exporter
+import mmd_tools.core.camera as mmd_camera
+import mmd_tools.core.lamp as mmd_lamp
 import mmd_tools.core.model as mmd_model
 
 
@@ -109,11 +113,22 @@ class ImportVmd(Operator, ImportHelper):
     scale = bpy.props.FloatProperty(name='Scale', default=0.2)
     margin = bpy.props.IntProperty(name='Margin', default=5, min=0)
     update_scene_settings = bpy.props.BoolProperty(name='Update scene settings', default=True)
+    reduce_keyframes = bpy.props.BoolProperty(name='Reduce keyframes', default=False)
+    location_tolerance = bpy.props.FloatProperty(name='Location tolerance', default=0.005, min=0, precision=4)
+    rotation_tolerance = bpy.props.FloatProperty(name='Rotation tolerance', default=0.005, min=0, precision=4, subtype='ANGLE')
+    weight_tolerance = bpy.props.FloatProperty(name='Shape key tolerance', default=0.005, min=0, precision=4)
 
     def execute(self, context):
-        importer = vmd_importer.VMDImporter(filepath=self.filepath, scale=self.scale, frame_margin=self.margin)
-        for i in context.selected_objects:
-            importer.assign(i)
+        importer = vmd_importer.VMDImporter(
+            filepath=self.filepath,
+            scale=self.scale,
+            frame_margin=self.margin,
+            reduce_keyframes=self.reduce_keyframes,
+            location_tolerance=self.location_tolerance,
+            rotation_tolerance=self.rotation_tolerance,
+            weight_tolerance=self.weight_tolerance,
+            )
+        importer.assignMany(context.selected_objects)
         if self.update_scene_settings:
             auto_scene_setup.setupFrameRanges()
             auto_scene_setup.setupFps()
@@ -137,22 +152,41 @@ class ImportVmdToMMDModel(Operator, ImportHelper):
 
     margin = bpy.props.IntProperty(name='Margin', default=5, min=0)
     update_scene_settings = bpy.props.BoolProperty(name='Update scene settings', default=True)
+    reduce_keyframes = bpy.props.BoolProperty(name='Reduce keyframes', default=False)
+    location_tolerance = bpy.props.FloatProperty(name='Location tolerance', default=0.005, min=0, precision=4)
+    rotation_tolerance = bpy.props.FloatProperty(name='Rotation tolerance', default=0.005, min=0, precision=4, subtype='ANGLE')
+    weight_tolerance = bpy.props.FloatProperty(name='Shape key tolerance', default=0.005, min=0, precision=4)
+    use_selected_models = bpy.props.BoolProperty(name='All selected models', description='Import the motion to all selected models instead of the active model', default=False)
 
     def execute(self, context):
-        obj = context.active_object
-        root = mmd_model.Model.findRoot(obj)
-        rig = mmd_model.Model(root)
-        importer = vmd_importer.VMDImporter(filepath=self.filepath, scale=root.mmd_root.scale, frame_margin=self.margin)
-        arm = rig.armature()
-        t = arm.hide
-        arm.hide = False
-        importer.assign(arm)
-        arm.hide = t
-        for i in rig.meshes():
-            t = i.hide
-            i.hide = False
-            importer.assign(i)
-            i.hide = t
+        # models of the same scale share one importer
+        objects = [context.active_object]
+        if self.use_selected_models:
+            objects += list(context.selected_objects)
+        roots = collections.OrderedDict()
+        for obj in [i for i in objects if i is not None]:
+            root = mmd_model.Model.findRoot(obj)
+            if root is not None:
+                roots[root.name] = root
+        rigs_by_scale = collections.OrderedDict()
+        for root in roots.values():
+            rigs_by_scale.setdefault(root.mmd_root.scale, []).append(mmd_model.Model(root))
+
+        for scale, rigs in rigs_by_scale.items():
+            importer = vmd_importer.VMDImporter(
+                filepath=self.filepath,
+                scale=scale,
+                frame_margin=self.margin,
+                reduce_keyframes=self.reduce_keyframes,
+                location_tolerance=self.location_tolerance,
+                rotation_tolerance=self.rotation_tolerance,
+                weight_tolerance=self.weight_tolerance,
+                )
+            targets = []
+            for rig in rigs:
+                targets.append(rig.armature())
+                targets.extend(rig.meshes())
+            importer.assignMany(targets)
         if self.update_scene_settings:
             auto_scene_setup.setupFrameRanges()
             auto_scene_setup.setupFps()
@@ -211,3 +245,42 @@ class ExportPmx(Operator, ImportHelper):
         wm = context.window_manager
         wm.fileselect_add(self)
         return {'RUNNING_MODAL'}
+
+
+class ExportVmd(Operator, ImportHelper):
+    bl_idname = 'mmd_tools.export_vmd'
+    bl_label = 'Export VMD file (.vmd)'
+    bl_description = 'Export motions of the selected MMD model, camera and lamp to a VMD file (.vmd)'
+    bl_options = {'PRESET'}
+
+    filename_ext = '.vmd'
+    filter_glob = bpy.props.StringProperty(default='*.vmd', options={'HIDDEN'})
+
+    scale = bpy.props.FloatProperty(name='Scale', description='Used for cameras and lamps. Models use the scale of the model.', default=0.2)
+    margin = bpy.props.IntProperty(name='Margin', default=5, min=0)
+
+    def execute(self, context):
+        args = {
+            'filepath': self.filepath,
+            'scale': self.scale,
+            'frame_margin': self.margin,
+            }
+        for obj in context.selected_objects:
+            root = mmd_model.Model.findRoot(obj)
+            if root is not None and 'armature' not in args:
+                rig = mmd_model.Model(root)
+                args['armature'] = rig.armature()
+                args['meshes'] = list(rig.meshes())
+                args['model_name'] = root.mmd_root.name
+                args['model_scale'] = root.mmd_root.scale
+            elif mmd_camera.MMDCamera.isMMDCamera(obj):
+                args['camera'] = obj
+            elif mmd_lamp.MMDLamp.isMMDLamp(obj):
+                args['lamp'] = obj
+        vmd_exporter.export(**args)
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        wm = context.window_manager
+        wm.fileselect_add(self)
+        return {'RUNNING_MODAL'}
@@ -4,6 +4,8 @@ import bpy
 from bpy.types import Operator
 
 from mmd_tools import bpyutils
+from mmd_tools.core.bone import FnBone
+import mmd_tools.core.skinning_preview as skinning_preview
 import mmd_tools.core.model as mmd_model
 
 
@@ -22,14 +24,17 @@ class CleanRiggingObjects(Operator):
 class BuildRig(Operator):
     bl_idname = 'mmd_tools.build_rig'
     bl_label = 'Build'
-    bl_description = ''
+    bl_description = 'Build the rig, or rebuild changed rigid bodies and joints if it is built. Clean the rig before building after moving rigid bodies'
     bl_options = {'PRESET'}
 
     def execute(self, context):
         obj = context.active_object
         root = mmd_model.Model.findRoot(context.active_object)
         rig = mmd_model.Model(root)
-        rig.build()
+        if root.mmd_root.is_built:
+            rig.buildChanged()
+        else:
+            rig.build()
         context.scene.objects.active = obj
         return {'FINISHED'}
 
@@ -45,8 +50,64 @@ class ApplyAdditionalTransformConstraints(Operator):
 
     def execute(self, context):
         root = mmd_model.Model.findRoot(context.active_object)
-        mmd_model.Model(root)
-        #context.scene.objects.active = obj
+        rig = mmd_model.Model(root)
+        rig.applyAdditionalTransformConstraints()
+        return {'FINISHED'}
+
+class BakeConstraints(Operator):
+    bl_idname = 'mmd_tools.bake_constraints'
+    bl_label = 'Bake Constraints'
+    bl_description = 'Bake IK and additional transformation of the model to FK keyframes'
+    bl_options = {'PRESET'}
+
+    frame_start = bpy.props.IntProperty(name='Start Frame', default=1)
+    frame_end = bpy.props.IntProperty(name='End Frame', default=250)
+    constraint_mode = bpy.props.EnumProperty(
+        name='Constraints',
+        description='What to do with the baked constraints',
+        items = [
+            ('NONE', 'Keep', 'Keep the constraints', 0),
+            ('MUTE', 'Mute', 'Mute the constraints', 1),
+            ('REMOVE', 'Remove', 'Remove the constraints', 2),
+            ],
+        default='MUTE',
+        )
+
+    @classmethod
+    def poll(cls, context):
+        return mmd_model.Model.findRoot(context.active_object)
+
+    def invoke(self, context, event):
+        self.frame_start = context.scene.frame_start
+        self.frame_end = context.scene.frame_end
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        root = mmd_model.Model.findRoot(context.active_object)
+        rig = mmd_model.Model(root)
+        FnBone.bake_constraints(rig.armature(), self.frame_start, self.frame_end, self.constraint_mode)
+        return {'FINISHED'}
+
+class ToggleSkinningPreview(Operator):
+    bl_idname = 'mmd_tools.toggle_skinning_preview'
+    bl_label = 'Toggle Skinning Preview'
+    bl_description = 'Preview the deformation of meshes including SDEF by MMD skinning'
+    bl_options = {'PRESET'}
+
+    @classmethod
+    def poll(cls, context):
+        return mmd_model.Model.findRoot(context.active_object)
+
+    def execute(self, context):
+        root = mmd_model.Model.findRoot(context.active_object)
+        rig = mmd_model.Model(root)
+        meshes = list(rig.meshes())
+        if any(skinning_preview.isEnabled(i) for i in meshes):
+            for i in meshes:
+                skinning_preview.disable(i)
+        else:
+            for i in meshes:
+                skinning_preview.enable(i, context.scene)
         return {'FINISHED'}
 
 class CreateMMDModelRoot(Operator):
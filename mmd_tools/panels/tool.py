@@ -50,6 +50,8 @@ class MMDToolsObjectPanel(_PanelBase, Panel):
 
         col.label('Bone Constraints:')
         col.operator('mmd_tools.apply_additioinal_transform')
+        col.operator('mmd_tools.bake_constraints')
+        col.operator('mmd_tools.toggle_skinning_preview')
 
         col = self.layout.column(align=True)
         col.label('Import/Export:')
@@ -5,8 +5,13 @@ from bpy.props import StringProperty, IntProperty, BoolProperty, FloatProperty,
 
 from mmd_tools.core.bone import FnBone
 
+def _markAdditionalTransformDirty(prop):
+    arm = prop.id_data
+    pose_bone = arm.path_resolve(prop.path_from_id().rsplit('.', 1)[0])
+    FnBone.mark_additional_transform_dirty(pose_bone)
+
 def _updateMMDBoneAdditionalTransform(prop, context):
-    prop['is_additional_transform_dirty'] = True
+    _markAdditionalTransformDirty(prop)
 
 def _getAdditionalTransformBone(prop):
     arm = prop.id_data
@@ -20,7 +25,7 @@ def _getAdditionalTransformBone(prop):
 
 def _setAdditionalTransformBone(prop, value):
     arm = prop.id_data
-    prop['is_additional_transform_dirty'] = True
+    _markAdditionalTransformDirty(prop)
     if value not in arm.pose.bones.keys():
         prop['additional_transform_bone_id'] = -1
         return
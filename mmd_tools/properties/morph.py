@@ -93,7 +93,7 @@ class BoneMorph(PropertyGroup):
         )
 
 def _get_material(prop):
-    mat_id = prop.get('material_id')
+    mat_id = prop.get('material_id', -1)
     if mat_id < 0:
         return ''
     fnMat = FnMaterial.from_material_id(mat_id)
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from bpy.types import PropertyGroup
-from bpy.props import StringProperty, IntProperty, BoolVectorProperty, EnumProperty, FloatVectorProperty
+from bpy.props import StringProperty, IntProperty, BoolProperty, BoolVectorProperty, EnumProperty, FloatVectorProperty
 
 from mmd_tools.core import rigid_body
 
+def _markDirty(prop, context):
+    prop['is_dirty'] = True
+
 class MMDRigidBody(PropertyGroup):
     name_j = StringProperty(
         name='Name',
@@ -23,12 +26,14 @@ class MMDRigidBody(PropertyGroup):
         min=0,
         max=16,
         default=1,
+        update=_markDirty,
         )
 
     collision_group_mask = BoolVectorProperty(
         name='Collision Group Mask',
         size=16,
         subtype='LAYER',
+        update=_markDirty,
         )
 
     type = EnumProperty(
@@ -38,6 +43,7 @@ class MMDRigidBody(PropertyGroup):
             (str(rigid_body.MODE_DYNAMIC), 'Dynamic', '', 2),
             (str(rigid_body.MODE_DYNAMIC_BONE), 'Dynamic&BoneTrack', '', 3),
             ],
+        update=_markDirty,
         )
 
     shape = EnumProperty(
@@ -47,12 +53,19 @@ class MMDRigidBody(PropertyGroup):
             ('BOX', 'Box', '', 2),
             ('CAPSULE', 'Capsule', '', 3),
             ],
+        update=_markDirty,
         )
 
     bone = StringProperty(
         name='Bone',
         description='',
         default='',
+        update=_markDirty,
+        )
+
+    is_dirty = BoolProperty(
+        name='',
+        default=True,
         )
 
 class MMDJoint(PropertyGroup):
@@ -73,6 +86,7 @@ class MMDJoint(PropertyGroup):
         size=3,
         min=0,
         step=0.1,
+        update=_markDirty,
         )
 
     spring_angular = FloatVectorProperty(
@@ -80,4 +94,10 @@ class MMDJoint(PropertyGroup):
         size=3,
         min=0,
         step=0.1,
+        update=_markDirty,
+        )
+
+    is_dirty = BoolProperty(
+        name='',
+        default=True,
         )
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import os
+import tempfile
+import unittest
+
+# mmd_tools/__init__.py requires bpy, so load the vmd module from its file.
+_VMD_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'mmd_tools', 'core', 'vmd', '__init__.py')
+_spec = importlib.util.spec_from_file_location('mmd_tools_vmd', _VMD_PATH)
+vmd = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(vmd)
+
+
+class TestCameraRoundTrip(unittest.TestCase):
+    def __newKey(self, frame, persp):
+        key = vmd.CameraKeyFrameKey()
+        key.frame_number = frame
+        key.distance = -45.0
+        key.location = [1.0, 10.0, -2.5]
+        key.rotation = [0.25, -0.5, 0.0]
+        key.interp = list(range(20, 44))
+        key.angle = 30
+        key.persp = persp
+        return key
+
+    def test_persp_byte(self):
+        # the last byte is 0 if the camera is perspective
+        self.assertEqual(self.__newKey(0, True).pack()[-1:], b'\x00')
+        self.assertEqual(self.__newKey(0, False).pack()[-1:], b'\x01')
+
+    def test_round_trip(self):
+        f = vmd.File()
+        f.header = vmd.Header()
+        f.header.model_name = 'camera'
+        f.cameraAnimation = vmd.CameraAnimation()
+        f.cameraAnimation.extend([self.__newKey(0, True), self.__newKey(15, False)])
+
+        fd, path = tempfile.mkstemp(suffix='.vmd')
+        os.close(fd)
+        try:
+            f.save(filepath=path)
+            loaded = vmd.File()
+            loaded.load(filepath=path)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(len(loaded.boneAnimation), 0)
+        self.assertEqual(len(loaded.cameraAnimation), 2)
+        for a, b in zip(f.cameraAnimation, loaded.cameraAnimation):
+            self.assertEqual(a.frame_number, b.frame_number)
+            self.assertAlmostEqual(a.distance, b.distance, places=5)
+            for x, y in zip(a.location + a.rotation, b.location + b.rotation):
+                self.assertAlmostEqual(x, y, places=5)
+            self.assertEqual(a.interp, b.interp)
+            self.assertEqual(a.angle, b.angle)
+            self.assertEqual(a.persp, b.persp)
+
+
+if __name__ == '__main__':
+    unittest.main()